@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+上游API并发控制
+限制同时进行的Deepseek API调用数量，超出上限的请求按到达顺序（FIFO）排队等待，
+排队已满或等待超时时拒绝请求并给出建议的重试时间，使突发流量下的服务降级可预期。
+同步请求（线程）和异步请求（asyncio）共用同一个队列。
+"""
+
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Dict, Any, Optional
+
+
+class AdmissionRejected(Exception):
+    """请求未被接纳"""
+
+    def __init__(self, message: str, retry_after: int):
+        """
+        参数:
+            message: 错误信息
+            retry_after: 建议客户端等待的秒数（用于Retry-After响应头）
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(AdmissionRejected):
+    """排队人数已满"""
+
+
+class QueueTimeoutError(AdmissionRejected):
+    """排队等待超时"""
+
+
+class AdmissionTicket:
+    """一个已获得的执行名额，release()可以安全地重复调用"""
+
+    def __init__(self, controller: "AdmissionController", wait_time: float):
+        self.controller = controller
+        self.wait_time = wait_time
+        self.acquired_at = time.monotonic()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.controller._release(time.monotonic() - self.acquired_at)
+
+    def transfer(self) -> Optional["AdmissionTicket"]:
+        """
+        把名额交给新的持有者（如读取上游的后台线程）
+
+        返回:
+            新的AdmissionTicket，由它负责归还名额；此后本票据的release()不再生效。
+            本票据的名额已经归还时返回None
+        """
+        with self._lock:
+            if self._released:
+                return None
+            self._released = True
+        ticket = AdmissionTicket(self.controller, self.wait_time)
+        ticket.acquired_at = self.acquired_at
+        return ticket
+
+    def __enter__(self) -> "AdmissionTicket":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class _AsyncWaiter:
+    """
+    异步请求在等待队列中的占位，接口与threading.Event相同（set/is_set）
+
+    名额可能由其他线程归还并移交，因此通过call_soon_threadsafe唤醒事件循环中的等待者。
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._future = loop.create_future()
+        self._set = False
+
+    def set(self) -> None:
+        self._set = True
+        try:
+            self._loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    def _wake(self) -> None:
+        if not self._future.done():
+            self._future.set_result(None)
+
+    def is_set(self) -> bool:
+        return self._set
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class AdmissionController:
+    """带FIFO等待队列的并发上限控制器"""
+
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 32, queue_timeout: float = 10.0):
+        """
+        参数:
+            max_concurrent: 同时进行的上游调用上限
+            max_queue: 等待队列长度上限，队列已满时立即拒绝
+            queue_timeout: 在队列中等待的最长时间（秒）
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._waiters = deque()  # 等待中的threading.Event，按到达顺序排列
+        self._lock = threading.Lock()
+        self._stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_full": 0,
+            "rejected_timeout": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0,
+            "total_hold": 0.0,
+            "completed": 0,
+        }
+
+    def _retry_after(self) -> int:
+        # 调用方需持有self._lock；按平均占用时间估算排到当前队尾所需的时间
+        completed = self._stats["completed"]
+        avg_hold = self._stats["total_hold"] / completed if completed else self.queue_timeout
+        rounds = (len(self._waiters) + 1) / max(1, self.max_concurrent)
+        return max(1, int(avg_hold * rounds + 0.5))
+
+    def acquire(self, timeout: Optional[float] = None) -> AdmissionTicket:
+        """
+        获取一个执行名额，必要时排队等待
+
+        参数:
+            timeout: 最长等待时间（秒），为None时使用queue_timeout
+
+        返回:
+            AdmissionTicket，调用结束后必须调用其release()
+
+        异常:
+            QueueFullError: 等待队列已满
+            QueueTimeoutError: 等待超时
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        waiter = threading.Event()
+        ticket = self._enter(waiter)
+        if ticket is not None:
+            return ticket
+        return self._admit(waiter, waiter.wait(timeout), start)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> AdmissionTicket:
+        """
+        获取一个执行名额（异步版本，排队时不占用线程）
+
+        参数和异常与acquire()相同；等待期间被取消（如客户端断开）时退出队列，已移交的名额立即归还。
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        waiter = _AsyncWaiter(asyncio.get_running_loop())
+        ticket = self._enter(waiter)
+        if ticket is not None:
+            return ticket
+        try:
+            granted = await waiter.wait(timeout)
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.is_set():
+                    self._hand_over()
+                else:
+                    self._waiters.remove(waiter)
+            raise
+        return self._admit(waiter, granted, start)
+
+    def _enter(self, waiter) -> Optional[AdmissionTicket]:
+        """有空闲名额时直接返回AdmissionTicket，否则把waiter加入等待队列并返回None"""
+        with self._lock:
+            # 有空闲名额且没有人在排队时直接进入，保证先来先服务
+            if self._active < self.max_concurrent and not self._waiters:
+                self._active += 1
+                self._stats["admitted"] += 1
+                return AdmissionTicket(self, 0.0)
+            if len(self._waiters) >= self.max_queue:
+                self._stats["rejected_full"] += 1
+                raise QueueFullError("服务繁忙，排队人数已满", self._retry_after())
+            self._waiters.append(waiter)
+            self._stats["queued"] += 1
+        return None
+
+    def _admit(self, waiter, granted: bool, start: float) -> AdmissionTicket:
+        """等待结束：得到名额时返回AdmissionTicket，否则退出队列并抛出QueueTimeoutError"""
+        with self._lock:
+            # 名额在超时判定之后才到达时仍视为成功，避免名额丢失
+            if not granted and not waiter.is_set():
+                self._waiters.remove(waiter)
+                self._stats["rejected_timeout"] += 1
+                raise QueueTimeoutError("服务繁忙，排队等待超时", self._retry_after())
+            wait_time = time.monotonic() - start
+            self._stats["admitted"] += 1
+            self._stats["total_wait"] += wait_time
+            self._stats["max_wait"] = max(self._stats["max_wait"], wait_time)
+        return AdmissionTicket(self, wait_time)
+
+    def _release(self, hold_time: float) -> None:
+        with self._lock:
+            self._stats["completed"] += 1
+            self._stats["total_hold"] += hold_time
+            self._hand_over()
+
+    def _hand_over(self) -> None:
+        # 调用方需持有self._lock；名额直接移交给队首的请求，_active不变
+        if self._waiters:
+            self._waiters.popleft().set()
+        else:
+            self._active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """返回当前并发数、队列长度以及接纳、拒绝和等待时间统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active"] = self._active
+            stats["queue_depth"] = len(self._waiters)
+        stats["max_concurrent"] = self.max_concurrent
+        stats["max_queue"] = self.max_queue
+        queued_admitted = stats["queued"] - stats["rejected_timeout"] - stats["queue_depth"]
+        stats["avg_wait"] = stats["total_wait"] / queued_admitted if queued_admitted > 0 else 0.0
+        stats["avg_hold"] = stats["total_hold"] / stats["completed"] if stats["completed"] else 0.0
+        return stats
+
+
+# 进程级默认控制器，按环境变量配置
+_default_controller: Optional[AdmissionController] = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> Optional[AdmissionController]:
+    """
+    获取进程级默认控制器
+
+    返回:
+        AdmissionController实例；环境变量UPSTREAM_MAX_CONCURRENT为0时不限制并发，返回None
+    """
+    global _default_controller
+    if _default_controller is None:
+        with _controller_lock:
+            if _default_controller is None:
+                try:
+                    max_concurrent = int(os.environ.get("UPSTREAM_MAX_CONCURRENT", 8))
+                    max_queue = int(os.environ.get("UPSTREAM_MAX_QUEUE", 32))
+                    queue_timeout = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", 10))
+                except ValueError:
+                    max_concurrent, max_queue, queue_timeout = 8, 32, 10.0
+                if max_concurrent <= 0:
+                    return None
+                _default_controller = AdmissionController(max_concurrent, max_queue, queue_timeout)
+    return _default_controller
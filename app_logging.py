@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+结构化日志
+所有模块通过get_logger获取"stylist"下的日志记录器。日志先进入内存队列，由后台线程
+统一写出，请求路径上不直接进行终端/文件写入；支持文本和JSON两种格式、日志级别，
+以及对高频调试日志按比例采样。
+
+环境变量:
+    LOG_LEVEL: 日志级别（DEBUG / INFO / WARNING / ERROR），默认INFO
+    LOG_FORMAT: text（默认）或json
+    LOG_SAMPLE_RATE: 标记为可采样的日志（见sampled()）的保留比例，默认0.01
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+from typing import Dict, Any
+
+LOGGER_NAME = "stylist"
+
+_configured = False
+_config_lock = threading.Lock()
+_listener = None
+
+
+class SamplingFilter(logging.Filter):
+    """按比例丢弃标记为可采样的日志"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sample", False):
+            return self.rate >= 1 or random.random() < self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行JSON，附带的字段（fields）作为顶层键"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """文本格式，附带的字段以key=value形式追加在消息后"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+def configure_logging(level: str = None, fmt: str = None, sample_rate: float = None) -> None:
+    """
+    配置"stylist"日志记录器（只在首次调用时生效，get_logger会自动调用）
+
+    参数:
+        level: 日志级别，为None时读取LOG_LEVEL
+        fmt: "text"或"json"，为None时读取LOG_FORMAT
+        sample_rate: 可采样日志的保留比例，为None时读取LOG_SAMPLE_RATE
+    """
+    global _configured, _listener
+    with _config_lock:
+        if _configured:
+            return
+        _configured = True
+
+        level = (level or os.environ.get("LOG_LEVEL", "INFO")).upper()
+        fmt = (fmt or os.environ.get("LOG_FORMAT", "text")).lower()
+        if sample_rate is None:
+            try:
+                sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+            except ValueError:
+                sample_rate = 0.01
+
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+        # 请求线程只把日志放入队列，由监听线程负责格式化和写出
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(SamplingFilter(sample_rate))
+        _listener = logging.handlers.QueueListener(log_queue, output)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.setLevel(getattr(logging, level, logging.INFO))
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """获取模块的日志记录器（如get_logger("deepseek_client")）"""
+    configure_logging()
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def fields(**values) -> Dict[str, Any]:
+    """附带结构化字段，用法: logger.info("...", extra=fields(status=200))"""
+    return {"fields": values}
+
+
+def sampled(**values) -> Dict[str, Any]:
+    """附带结构化字段并标记为可采样，用于高频日志"""
+    return {"fields": values, "sample": True}
+
+
+def mask_key(api_key: str) -> str:
+    """遮蔽API密钥，只保留前缀和末尾两位"""
+    if not api_key:
+        return ""
+    return f"{api_key[:3]}***{api_key[-2:]}" if len(api_key) > 8 else "***"
+
+
+def elapsed_ms(start: float) -> float:
+    """从time.monotonic()的起点到现在的毫秒数"""
+    return round((time.monotonic() - start) * 1000, 1)
@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stylist4deepseek - ASGI服务模式
+基于Starlette提供与webapp.py相同的页面和接口。/get_recommendation通过AsyncDeepseekClient在事件循环中
+转发上游令牌，排队等待和流式输出都不占用线程，单个进程即可保持大量打开的流式连接。
+关闭时停止接受新连接，等待进行中的流发送完毕（最长SHUTDOWN_GRACE_SECONDS秒）后再退出。
+
+用法:
+    python asgi_app.py --host 0.0.0.0 --port 8000 --workers 2
+    uvicorn asgi_app:app --timeout-graceful-shutdown 30
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import contextlib
+from email.utils import format_datetime, parsedate_to_datetime
+
+import anyio
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response, JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from webapp import (
+    get_cached_page, users_page, users_cache_control, user_exists, session_user, load_user_specific_data, component_stats,
+    prepare_recommendation, finish_recommendation, stream_example_events, ResponseStage,
+    streaming_headers, stream_registry, recommendation_key,
+)
+from deepseek_client import AsyncDeepseekClient
+from response_cache import wrap_async_client, get_response_cache
+from admission import get_admission_controller, AdmissionRejected
+from circuit_breaker import get_circuit_breaker, CircuitOpenError, STATE_OPEN
+from stream_utils import coalesce_chunks_async, get_flush_settings, get_heartbeat_interval
+from stream_protocol import (
+    EVENT_STATUS, EVENT_DELTA, EVENT_ERROR, EVENT_DONE, EVENT_USAGE, STREAM_FORMATS, HEARTBEAT_FRAMES,
+    negotiate_format, parse_last_event_id, encode_events_async, resume_events_async,
+)
+from app_logging import get_logger, fields, sampled, elapsed_ms
+from tracing import RequestTrace, activate, span
+from session_state import SELECTION_COOKIE, sign_selection, selection_max_age
+from metrics import REGISTRY, HTTP_REQUESTS, HTTP_DURATION
+
+logger = get_logger("asgi_app")
+
+
+class StreamTracker:
+    """进行中的流式响应计数，关闭时等待全部结束"""
+
+    def __init__(self):
+        self.active = 0
+        self.total = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def opened(self) -> None:
+        self.active += 1
+        self.total += 1
+        self._idle.clear()
+
+    def closed(self) -> None:
+        self.active -= 1
+        if self.active == 0:
+            self._idle.set()
+
+    async def drain(self, timeout: float) -> int:
+        """
+        等待进行中的流结束
+
+        返回:
+            超时后仍未结束的流数量
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.active
+
+
+streams = StreamTracker()
+
+
+def shutdown_grace_seconds() -> float:
+    try:
+        return float(os.environ.get("SHUTDOWN_GRACE_SECONDS", 30))
+    except ValueError:
+        return 30.0
+
+
+def collect_stream_stats():
+    yield "stylist_open_streams", "gauge", "进行中的流式响应数（ASGI模式）", {}, streams.active
+
+REGISTRY.register_collector(collect_stream_stats)
+
+
+class RecommendationStream(StreamingResponse):
+    """
+    流式穿搭建议响应
+    无论服务器支持哪个ASGI版本，都同时监听http.disconnect：客户端断开后立即停止发送并退出读取；
+    后台生产方在STREAM_RESUME_GRACE_SECONDS秒内没有客户端重连时取消上游请求（即使还在等待首个令牌）。
+    长时间没有事件时发送心跳帧。结束后关闭事件序列、归还尚未转交给生产方的并发名额并更新流计数。
+    """
+
+    def __init__(self, content, ticket=None, heartbeat_frame=None, **kwargs):
+        """
+        参数:
+            content: 编码后的事件序列
+            ticket: 上游并发名额，结束时归还
+            heartbeat_frame: 心跳帧（见stream_protocol.HEARTBEAT_FRAMES），为None时不发送心跳
+        """
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+        self.heartbeat_frame = heartbeat_frame
+
+    async def stream_response(self, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        interval = get_heartbeat_interval() if self.heartbeat_frame else 0
+        iterator = self.body_iterator.__aiter__()
+        pending = None
+        try:
+            while True:
+                # 取下一帧放在单独的任务中，等待超时只发送心跳，不会打断正在进行的上游读取
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=interval if interval > 0 else None)
+                if not done:
+                    await send({"type": "http.response.body", "body": self.heartbeat_frame.encode(self.charset),
+                                "more_body": True})
+                    continue
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+                if not isinstance(chunk, (bytes, memoryview)):
+                    chunk = chunk.encode(self.charset)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if pending is not None:
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def __call__(self, scope, receive, send) -> None:
+        streams.opened()
+        try:
+            async with anyio.create_task_group() as task_group:
+                async def run(func, *args):
+                    try:
+                        await func(*args)
+                    except OSError:
+                        pass  # 支持ASGI 2.4的服务器在写入已断开的连接时抛出OSError，同样视为客户端断开
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(run, self.listen_for_disconnect, receive)
+                await run(self.stream_response, send)
+        finally:
+            if hasattr(self.body_iterator, "aclose"):
+                await self.body_iterator.aclose()
+            if self.ticket is not None:
+                self.ticket.release()
+            streams.closed()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    # 每个工作进程（事件循环）各自持有一个异步客户端及其连接池
+    api_key = os.environ.get("DEEPSEEK_API_KEY", "").strip()
+    client = None
+    if os.environ.get("USE_DEEPSEEK_API", "").lower() in ['true', '1', 'yes'] and api_key:
+        client = AsyncDeepseekClient(api_key=api_key,
+                                     api_base=os.environ.get("DEEPSEEK_API_BASE") or "https://api.deepseek.com/v1")
+    app.state.client = wrap_async_client(client) if client is not None else None
+    logger.info("ASGI服务启动", extra=fields(use_api=client is not None, pid=os.getpid()))
+    try:
+        yield
+    finally:
+        # 服务器通常已在关闭连接前等待过进行中的流；这里兜底等待，仍未结束的流随事件循环一起取消
+        if streams.active:
+            logger.info("等待进行中的流结束", extra=fields(streams=streams.active))
+            remaining = await streams.drain(shutdown_grace_seconds())
+            if remaining:
+                logger.warning("关闭时仍有流未结束", extra=fields(streams=remaining))
+        if client is not None:
+            await client.aclose()
+        logger.info("ASGI服务已关闭", extra=fields(streams_served=streams.total))
+
+
+# 请求的If-None-Match是否包含etag
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match', '')
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+# 返回内存中的页面，支持ETag/Last-Modified条件请求和gzip压缩
+def serve_page(request: Request, name: str) -> Response:
+    page = get_cached_page(name)
+    use_gzip = 'gzip' in request.headers.get('accept-encoding', '')
+    etag = f'"{page.etag}{"-gz" if use_gzip else ""}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(page.last_modified, usegmt=True),
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",
+    }
+    if request.headers.get('if-none-match'):
+        not_modified = etag_matches(request, etag)
+    else:
+        try:
+            since = parsedate_to_datetime(request.headers.get('if-modified-since', ''))
+            not_modified = since is not None and page.last_modified <= since
+        except (TypeError, ValueError):
+            not_modified = False
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return Response(page.gzip_body if use_gzip else page.body, media_type="text/html; charset=utf-8",
+                    headers=headers)
+
+
+async def index(request: Request) -> Response:
+    return serve_page(request, 'index')
+
+
+async def debug(request: Request) -> Response:
+    return serve_page(request, 'debug')
+
+
+async def get_users(request: Request) -> Response:
+    page, etag = await run_in_threadpool(users_page, request.query_params.get('offset'),
+                                         request.query_params.get('limit'))
+    headers = {"ETag": f'"{etag}"', "Cache-Control": users_cache_control()}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(page, headers=headers)
+
+
+async def get_session(request: Request) -> Response:
+    user_id = await run_in_threadpool(session_user, request.cookies.get(SELECTION_COOKIE))
+    return JSONResponse({"selected_user": user_id}, headers={"Cache-Control": "private, no-store"})
+
+
+async def get_user_data(request: Request) -> Response:
+    user_data = await run_in_threadpool(load_user_specific_data, request.path_params['user_id'])
+    return JSONResponse(user_data)
+
+
+async def select_user(request: Request) -> Response:
+    try:
+        data = await request.json()
+        user_id = data.get('user_id')
+
+        if not await run_in_threadpool(user_exists, user_id):
+            return JSONResponse({"success": False, "error": "用户不存在"}, status_code=404)
+
+        # 选择只保存在访问者自己的签名Cookie中
+        response = JSONResponse({"success": True, "selected_user": user_id},
+                                headers={"Cache-Control": "private, no-store"})
+        response.set_cookie(SELECTION_COOKIE, sign_selection(user_id), max_age=selection_max_age(),
+                            samesite="lax", secure=request.url.scheme == "https")
+        return response
+    except Exception as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+async def cache_stats(request: Request) -> Response:
+    stats = component_stats()
+    stats["streams"] = {"active": streams.active, "total": streams.total}
+    return JSONResponse(stats)
+
+
+async def metrics(request: Request) -> Response:
+    return Response(REGISTRY.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# 为即将发起的API调用申请并发名额（异步排队，不占用线程）；命中响应缓存时不占用名额
+async def acquire_upstream_slot_async(prompt, system_prompt, prompt_report):
+    controller = get_admission_controller()
+    if controller is None:
+        return None
+    cache = get_response_cache()
+    key = recommendation_key(prompt, system_prompt, prompt_report["max_tokens"])
+    if cache is not None and await run_in_threadpool(cache.contains, key):
+        return None
+    # 熔断器打开时不会调用API，无需排队
+    breaker = get_circuit_breaker()
+    if breaker is not None and breaker.state == STATE_OPEN:
+        return None
+    ticket = await controller.acquire_async()
+    if ticket.wait_time > 0:
+        logger.info("排队等待后获得API调用名额", extra=fields(wait_ms=round(ticket.wait_time * 1000)))
+    return ticket
+
+
+# 穿搭建议的事件序列（recommendation_events的异步版本）
+async def recommendation_events_async(client, prompt, prompt_report=None, system_prompt=None):
+    use_api = client is not None
+    logger.debug("流式响应开始", extra=sampled(use_api=use_api))
+    start = time.monotonic()
+
+    yield EVENT_STATUS, {"message": "正在准备您的穿搭建议..."}
+
+    full_length = 0
+    frame_count = 0
+    source = "example"
+    api_usage = {}
+    fallback = False
+
+    if use_api:
+        try:
+            max_tokens = prompt_report["max_tokens"] if prompt_report else 1500
+            response_generator = client.chat_stream(
+                prompt=prompt,
+                temperature=0.7,
+                top_p=0.9,
+                max_tokens=max_tokens,
+                system_prompt=system_prompt,
+                on_usage=api_usage.update
+            )
+
+            yield EVENT_STATUS, {"message": "Deepseek AI 正在生成穿搭建议..."}
+
+            has_content = False
+            source = "api"
+
+            max_bytes, max_delay = get_flush_settings()
+            frames = coalesce_chunks_async(response_generator, max_bytes=max_bytes, max_delay=max_delay)
+            try:
+                async for frame in frames:
+                    # 尚未输出内容时API就已出错（重试后仍失败），改用示例回答
+                    if not has_content and frame.startswith("\n[API错误:"):
+                        raise RuntimeError(frame.strip()[1:-1])
+                    frame_count += 1
+                    full_length += len(frame)
+                    has_content = has_content or bool(frame.strip())
+                    yield EVENT_DELTA, {"text": frame}
+            finally:
+                await frames.aclose()
+
+            if not has_content:
+                logger.warning("API返回了空内容")
+                source = "example"
+                yield EVENT_STATUS, {"message": "API返回了空内容，正在切换到默认示例..."}
+                fallback = True
+
+        except CircuitOpenError as e:
+            logger.warning(str(e))
+            source = "example"
+            yield EVENT_ERROR, {"message": "AI服务暂时不可用", "recoverable": True, "retry_after": round(e.retry_after)}
+            yield EVENT_STATUS, {"message": "正在切换到默认示例..."}
+            fallback = True
+        except Exception as e:
+            logger.exception("调用API时出错: %s", e)
+            source = "example"
+            yield EVENT_ERROR, {"message": f"API调用出错: {str(e)}", "recoverable": True}
+            yield EVENT_STATUS, {"message": "正在切换到默认示例..."}
+            fallback = True
+    else:
+        if os.environ.get("USE_DEEPSEEK_API", "").lower() not in ['true', '1', 'yes']:
+            logger.debug("未启用API，使用示例回答")
+            yield EVENT_STATUS, {"message": "使用默认示例穿搭建议"}
+        else:
+            logger.warning("未提供API密钥，使用示例回答")
+            yield EVENT_STATUS, {"message": "未设置API密钥，使用默认示例"}
+        fallback = True
+
+    if fallback:
+        frame_count = 0
+        full_length = 0
+        for event_type, data in stream_example_events(prompt):
+            frame_count += 1
+            full_length += len(data["text"])
+            yield event_type, data
+
+    yield EVENT_USAGE, finish_recommendation(start, source, frame_count, full_length, prompt_report, api_usage)
+    yield EVENT_DONE, {"message": "穿搭建议生成完毕"}
+
+
+# 在事件序列上记录推送阶段并在结束前发送timing事件（generate_recommendation_events的异步版本）
+async def generate_recommendation_events_async(client, prompt, prompt_report, system_prompt, trace, ticket=None):
+    # 生产方在客户端断开后仍可能继续生成，并发名额改由事件序列持有到结束
+    owned = ticket.transfer() if ticket is not None else None
+    events = recommendation_events_async(client, prompt, prompt_report, system_prompt)
+    stage = ResponseStage(trace)
+    outcome = "cancelled"
+    try:
+        while True:
+            with activate(trace):
+                try:
+                    event, data = await events.__anext__()
+                except StopAsyncIteration:
+                    break
+            extra = stage.before(event, data)
+            if extra is not None:
+                yield extra
+            yield event, data
+        outcome = "success"
+    finally:
+        with activate(trace):
+            await events.aclose()  # 不再等待重连时关闭上游流，并在链路中记录取消
+        stage.finish(outcome)
+        if owned is not None:
+            owned.release()
+
+
+# 断线重连：按Last-Event-ID回放尚未送达的事件，原始流仍在生成时继续接收
+def resume_recommendation(last_event_id: str, stream_format: str) -> Response:
+    content_type, formatter = STREAM_FORMATS[stream_format]
+    parsed = parse_last_event_id(last_event_id)
+    session = stream_registry.get(parsed[0]) if parsed else None
+    if session is None:
+        return JSONResponse({"error": "流已过期或不存在，请重新获取穿搭建议"}, status_code=410)
+    return RecommendationStream(resume_events_async(session, parsed[1], formatter), media_type=content_type,
+                                heartbeat_frame=HEARTBEAT_FRAMES[stream_format],
+                                headers=streaming_headers(session.stream_id))
+
+
+async def get_recommendation(request: Request) -> Response:
+    try:
+        data = await request.json()
+
+        stream_format = negotiate_format(request.headers.get('accept'), request.query_params.get('format'))
+
+        last_event_id = request.headers.get('last-event-id') or data.get('last_event_id')
+        if last_event_id:
+            return resume_recommendation(last_event_id, stream_format)
+
+        # 未指定用户时使用访问者选定的用户；指定的用户必须存在
+        user_id = data.get('user_id') or await run_in_threadpool(session_user, request.cookies.get(SELECTION_COOKIE))
+        if data.get('user_id') and not await run_in_threadpool(user_exists, user_id):
+            return JSONResponse({"error": "用户不存在"}, status_code=404)
+        scenario = data.get('scenario', '')
+        query = data.get('query', '')
+        client = request.app.state.client
+
+        logger.info("穿搭建议请求", extra=fields(user_id=user_id, scenario=scenario,
+                                                   query_chars=len(query), use_api=client is not None))
+
+        trace = RequestTrace(request.headers.get('x-request-id'), name="get_recommendation")
+        trace.root.set(user_id=user_id, use_api=client is not None)
+
+        # 读取文件和构建提示词在线程池中执行，不阻塞事件循环
+        prepared = await run_in_threadpool(prepare_recommendation, user_id, scenario, query, trace)
+        if prepared is None:
+            trace.finish(outcome="error")
+            return JSONResponse({"error": "无法加载所需数据文件。"}, status_code=500)
+        system_prompt, prompt, prompt_report = prepared
+
+        ticket = None
+        if client is not None:
+            try:
+                with activate(trace), span("admission_wait"):
+                    ticket = await acquire_upstream_slot_async(prompt, system_prompt, prompt_report)
+            except AdmissionRejected as e:
+                trace.finish(outcome="rejected")
+                logger.warning("拒绝请求: %s", e, extra=fields(retry_after=e.retry_after))
+                return JSONResponse({"error": str(e), "retry_after": e.retry_after}, status_code=429,
+                                    headers={"Retry-After": str(e.retry_after)})
+
+        try:
+            content_type, formatter = STREAM_FORMATS[stream_format]
+            session = stream_registry.create()
+            events = generate_recommendation_events_async(client, prompt, prompt_report, system_prompt, trace,
+                                                          ticket)
+            headers = streaming_headers(session.stream_id)
+            headers["X-Request-ID"] = trace.request_id
+            headers["Server-Timing"] = trace.server_timing()
+            return RecommendationStream(encode_events_async(session, events, formatter), ticket=ticket,
+                                        heartbeat_frame=HEARTBEAT_FRAMES[stream_format],
+                                        media_type=content_type, headers=headers)
+        except Exception:
+            if ticket is not None:
+                ticket.release()
+            raise
+
+    except Exception as e:
+        logger.exception("生成穿搭建议时出错: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+class RequestMetricsMiddleware:
+    """记录每个请求的处理时间（到开始发送响应为止）和状态码，按路由模板区分接口"""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.endpoints = {route.endpoint: route.path for route in routes}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.monotonic()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                endpoint = self.endpoints.get(scope.get("endpoint"), "unmatched")
+                status = message["status"]
+                HTTP_REQUESTS.inc(endpoint=endpoint, method=scope["method"], status=status)
+                HTTP_DURATION.observe(time.monotonic() - start, endpoint=endpoint)
+                if status >= 500:
+                    logger.warning("请求失败", extra=fields(endpoint=endpoint, status=status,
+                                                          duration_ms=elapsed_ms(start)))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+routes = [
+    Route('/', index),
+    Route('/debug', debug),
+    Route('/api/users', get_users),
+    Route('/api/session', get_session),
+    Route('/api/user-data/{user_id}', get_user_data),
+    Route('/api/select-user', select_user, methods=['POST']),
+    Route('/api/cache-stats', cache_stats),
+    Route('/metrics', metrics),
+    Route('/get_recommendation', get_recommendation, methods=['POST']),
+]
+
+app = RequestMetricsMiddleware(Starlette(routes=routes, lifespan=lifespan), routes)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='Stylist4deepseek ASGI服务')
+    parser.add_argument('--host', type=str, default=os.environ.get("ASGI_HOST", "0.0.0.0"), help='监听地址')
+    parser.add_argument('--port', type=int, default=int(os.environ.get("ASGI_PORT", 8000)), help='监听端口')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get("ASGI_WORKERS", 1)),
+                        help='工作进程数，每个进程一个事件循环')
+    parser.add_argument('--backlog', type=int, default=int(os.environ.get("ASGI_BACKLOG", 2048)),
+                        help='等待接受的连接队列长度')
+    parser.add_argument('--graceful-timeout', type=float, default=shutdown_grace_seconds(),
+                        help='关闭时等待进行中的流结束的最长秒数')
+    args = parser.parse_args()
+
+    # 多进程时由各工作进程按模块路径导入，单进程时直接使用本模块中的app，避免重复导入
+    uvicorn.run(
+        app if args.workers == 1 else "asgi_app:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        backlog=args.backlog,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        access_log=False,  # 请求已记入/metrics，流式请求也有独立日志
+    )
+
+
+if __name__ == "__main__":
+    main()
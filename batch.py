@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+批量生成穿搭建议
+按清单（用户 × 场景 × 需求）并发生成穿搭建议，所有任务共用一个带连接池、响应缓存和熔断器的客户端，
+按设定的速率向API发送请求，结果逐条写入JSONL文件（含每条的耗时和令牌用量），中断后可以续跑。
+
+清单为JSON文件，users和scenarios可以写"all"，分别表示用户存储中的全部用户和界面中的全部场景:
+    {"users": "all", "scenarios": "all", "queries": ["今日穿搭建议"]}
+也可以直接列出任务:
+    {"items": [{"user_id": "user1", "scenario": "约会", "query": "周末晚餐"}]}
+
+用法:
+    python stylist_app.py --batch manifest.json --output results.jsonl --workers 8 --rate-limit 5
+    python stylist_app.py --batch all --output daily.jsonl
+"""
+
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional, Iterable, Set
+
+from stylist_app import load_user_specific_data, load_file_content, create_prompt_with_budget
+from response_cache import get_cached_client
+from user_store import get_user_store
+from context_bundle import get_context_bundles, create_prompt_from_bundle
+from deepseek_client import summarize_usage
+from example_responses import get_outfit_example
+from wardrobe import filter_wardrobe, filter_settings, SCENARIO_KEYWORDS
+from app_logging import get_logger
+
+logger = get_logger("batch")
+
+# 清单未指定需求时使用的默认需求
+DEFAULT_QUERY = "请推荐今天的穿搭"
+
+
+def list_users() -> List[str]:
+    """用户存储中的全部用户ID（按加入顺序）"""
+    users, _ = get_user_store().list_users()
+    return [user["id"] for user in users]
+
+
+def expand_manifest(manifest: Dict[str, Any]) -> List[Dict[str, str]]:
+    """
+    把清单展开为任务列表
+
+    参数:
+        manifest: {"users", "scenarios", "queries"}（取笛卡尔积）或{"items": [...]}
+
+    返回:
+        [{"user_id", "scenario", "query"}, ...]
+    """
+    if "items" in manifest:
+        return [{"user_id": item["user_id"], "scenario": item.get("scenario", ""),
+                 "query": item.get("query", DEFAULT_QUERY)} for item in manifest["items"]]
+
+    users = manifest.get("users", "all")
+    scenarios = manifest.get("scenarios", "all")
+    queries = manifest.get("queries") or [DEFAULT_QUERY]
+    if users == "all":
+        users = list_users()
+    if scenarios == "all":
+        scenarios = list(SCENARIO_KEYWORDS)
+    return [{"user_id": user_id, "scenario": scenario, "query": query}
+            for user_id in users for scenario in scenarios for query in queries]
+
+
+def load_manifest(source: str) -> List[Dict[str, str]]:
+    """读取清单文件；source为"all"时生成全部用户 × 全部场景的任务"""
+    if source == "all":
+        return expand_manifest({})
+    with open(source, 'r', encoding='utf-8') as f:
+        return expand_manifest(json.load(f))
+
+
+def item_key(item: Dict[str, Any]) -> str:
+    return f"{item['user_id']}|{item['scenario']}|{item['query']}"
+
+
+def completed_keys(output_path: str) -> Set[str]:
+    """输出文件中已成功完成的任务，用于续跑"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 上次中断时写了一半的行
+            if record.get("status") == "ok":
+                done.add(item_key(record))
+    return done
+
+
+class RateLimiter:
+    """令牌桶限速器，多个线程共用"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        参数:
+            rate: 每秒允许的请求数，0表示不限速
+            burst: 允许的突发请求数
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        等待直到可以发送一个请求
+
+        返回:
+            等待的秒数
+        """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class BatchRunner:
+    """并发执行批量任务"""
+
+    def __init__(self, use_api: bool = True, api_key: Optional[str] = None, workers: int = 8,
+                 rate_limit: float = 0.0, stylist_template: Optional[str] = None):
+        """
+        参数:
+            use_api: 是否调用API，为False时写入示例回答（用于检查清单和输出格式）
+            api_key: API密钥，为None时从环境变量获取
+            workers: 并发任务数
+            rate_limit: 每秒最多发送的API请求数，0表示不限速
+            stylist_template: 穿搭顾问模板，为None时读取fashion_stylist_agent.md
+        """
+        self.use_api = use_api
+        self.client = get_cached_client(api_key=api_key) if use_api else None
+        self.workers = max(1, workers)
+        self.limiter = RateLimiter(rate_limit, burst=self.workers)
+        self.default_template = stylist_template is None
+        self.stylist_template = stylist_template or load_file_content('fashion_stylist_agent.md')
+
+    def build_prompt(self, item: Dict[str, str]):
+        """
+        构建一条任务的提示词：同一用户的各个任务共用预先生成的上下文包（未启用上下文包或指定了模板时直接读取文件）
+
+        返回:
+            (系统消息, 用户消息, 统计报告)
+        """
+        full_query = f"场景：{item['scenario']}\n具体需求：{item['query']}"
+        filter_enabled, top_n, token_budget = filter_settings()
+        bundles = get_context_bundles() if self.default_template else None
+        if bundles is not None:
+            bundle, origin = bundles.get(item["user_id"])
+            if bundle is None:
+                reason = "不存在" if origin == "unknown" else "缺少数据文件"
+                raise ValueError(f"用户 {item['user_id']} {reason}")
+            wardrobe = bundle.filtered_wardrobe(item["scenario"], item["query"], top_n, token_budget) \
+                if filter_enabled else None
+            return create_prompt_from_bundle(bundle, full_query, wardrobe)
+
+        user_data = load_user_specific_data(item["user_id"])
+        wardrobe_data = user_data["wardrobe_data"]
+        if filter_enabled:
+            wardrobe_data = filter_wardrobe(wardrobe_data, scenario=item["scenario"],
+                                            weather_data=user_data["weather_data"], query=item["query"],
+                                            top_n=top_n, token_budget=token_budget)
+        return create_prompt_with_budget(full_query, user_data["body_data"], wardrobe_data,
+                                         user_data["weather_data"], self.stylist_template)
+
+    def run_item(self, item: Dict[str, str]) -> Dict[str, Any]:
+        """生成一条穿搭建议，返回写入JSONL的记录（出错时status为"error"）"""
+        start = time.monotonic()
+        record: Dict[str, Any] = dict(item)
+        try:
+            system_prompt, prompt, report = self.build_prompt(item)
+            prompt_done = time.monotonic()
+            record["prompt_tokens_estimate"] = report["total_tokens"]
+            if report.get("context_hash"):
+                record["context_hash"] = report["context_hash"]
+
+            if not self.use_api:
+                record.update(status="ok", source="example", recommendation=get_outfit_example(prompt))
+                api_start = api_done = prompt_done
+                rate_wait = 0.0
+            else:
+                rate_wait = self.limiter.acquire()
+                api_start = time.monotonic()
+                response = self.client.generate_completion(prompt=prompt, model="deepseek-chat",
+                                                           max_tokens=report["max_tokens"], temperature=0.7,
+                                                           system_prompt=system_prompt)
+                api_done = time.monotonic()
+                text = self.client.extract_completion_text(response)
+                if "error" in response:
+                    record.update(status="error", source="api", error=str(response["error"]))
+                else:
+                    record.update(status="ok", source="api", recommendation=text,
+                                  usage=summarize_usage(response.get("usage")))
+            record["timing"] = {
+                "prompt_ms": round((prompt_done - start) * 1000, 1),
+                "rate_wait_ms": round(rate_wait * 1000, 1),
+                "api_ms": round((api_done - api_start) * 1000, 1),
+                "total_ms": round((time.monotonic() - start) * 1000, 1),
+            }
+        except Exception as e:
+            logger.exception("批量任务出错: %s", item_key(item))
+            record.update(status="error", error=f"{type(e).__name__}: {e}",
+                          timing={"total_ms": round((time.monotonic() - start) * 1000, 1)})
+        record["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        return record
+
+    def run(self, items: Iterable[Dict[str, str]], output_path: str, resume: bool = False) -> Dict[str, Any]:
+        """
+        执行全部任务，每完成一条立即追加写入output_path
+
+        参数:
+            items: 任务列表
+            output_path: JSONL输出文件
+            resume: 为True时跳过输出文件中已成功完成的任务
+
+        返回:
+            汇总统计
+        """
+        items = list(items)
+        skipped = 0
+        if resume:
+            done = completed_keys(output_path)
+            pending = [item for item in items if item_key(item) not in done]
+            skipped = len(items) - len(pending)
+            items = pending
+        else:
+            open(output_path, 'w', encoding='utf-8').close()
+
+        stats = {"total": len(items) + skipped, "skipped": skipped, "ok": 0, "errors": 0,
+                 "prompt_tokens": 0, "completion_tokens": 0, "prompt_cache_hit_tokens": 0}
+        start = time.monotonic()
+        with open(output_path, 'a', encoding='utf-8') as output, \
+                ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.run_item, item) for item in items]
+            for count, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                stats["ok" if record["status"] == "ok" else "errors"] += 1
+                for key in ("prompt_tokens", "completion_tokens", "prompt_cache_hit_tokens"):
+                    stats[key] += record.get("usage", {}).get(key, 0)
+                if count % 10 == 0 or count == len(futures):
+                    logger.info("批量进度 %d/%d", count, len(futures))
+        elapsed = time.monotonic() - start
+        stats["elapsed_s"] = round(elapsed, 2)
+        stats["items_per_second"] = round(len(items) / elapsed, 2) if elapsed > 0 else None
+        return stats
+
+
+def run_batch_cli(manifest: str, output: str, workers: int, rate_limit: float, resume: bool,
+                  use_api: bool, api_key: Optional[str]) -> int:
+    """
+    命令行批量模式（stylist_app.py --batch）
+
+    返回:
+        进程退出码：全部成功为0，有失败的任务为1
+    """
+    items = load_manifest(manifest)
+    if not items:
+        print("错误：清单中没有任务")
+        return 1
+    if use_api and not (api_key or os.environ.get("DEEPSEEK_API_KEY")):
+        print("错误：批量模式调用API需要API密钥")
+        return 1
+
+    print(f"\n批量生成: {len(items)} 个任务，并发 {workers}，"
+          f"{f'每秒最多 {rate_limit} 个请求' if rate_limit > 0 else '不限速'}，"
+          f"{'调用API' if use_api else '使用示例回答'}")
+    runner = BatchRunner(use_api=use_api, api_key=api_key, workers=workers, rate_limit=rate_limit)
+    stats = runner.run(items, output, resume=resume)
+
+    print(f"\n完成: 成功 {stats['ok']}，失败 {stats['errors']}，跳过 {stats['skipped']}，"
+          f"耗时 {stats['elapsed_s']}s（{stats['items_per_second']} 个/秒）")
+    if stats["prompt_tokens"]:
+        print(f"令牌用量: 输入 {stats['prompt_tokens']}（上下文缓存命中 {stats['prompt_cache_hit_tokens']}），"
+              f"输出 {stats['completion_tokens']}")
+    print(f"结果已写入 {output}")
+    return 0 if stats["errors"] == 0 else 1
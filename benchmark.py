@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+离线性能基准测试
+启动本地模拟的Deepseek API（见mock_deepseek.py），按指定并发分别驱动:
+    client  DeepseekClient.chat_stream（流式）
+    app     stylist_app.generate_outfit_recommendation（非流式）
+    web     Flask的/get_recommendation接口（经本地HTTP服务，流式）
+输出吞吐量、延迟和首个令牌时间的p50/p95/p99，以及每个流占用的内存。不需要API密钥和网络。
+另外，--target sse只比较上游SSE的两种解析方式（逐行解码+json.loads与增量解析+快速路径）的单事件耗时，
+不启动模拟服务。
+
+用法:
+    python benchmark.py --target web --requests 200 --concurrency 20
+    python benchmark.py --target client --json result.json
+    python benchmark.py --target client --baseline result.json --max-regression 0.2
+    python benchmark.py --target sse --events 50000
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import logging
+import argparse
+import resource
+import random
+import tracemalloc
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Callable
+
+from mock_deepseek import MockDeepseekServer, add_mock_arguments, config_from_args
+
+TARGETS = ("client", "app", "web", "sse")
+
+
+class Result:
+    """一次请求的测量结果"""
+
+    __slots__ = ("ok", "latency", "ttft", "chars", "error", "source")
+
+    def __init__(self, ok: bool, latency: float, ttft: Optional[float] = None, chars: int = 0,
+                 error: Optional[str] = None, source: Optional[str] = None):
+        self.ok = ok
+        self.latency = latency
+        self.ttft = ttft
+        self.chars = chars
+        self.error = error
+        self.source = source
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩法计算百分位数，values为空时返回None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def load_prompt_sources() -> Dict[str, str]:
+    """读取项目根目录的示例用户数据，用于构造真实大小的提示词"""
+    from stylist_app import load_file_content
+    return {
+        "body_data": load_file_content('body_data.md'),
+        "wardrobe_data": load_file_content('wardrobe.md'),
+        "weather_data": load_file_content('weather_forecast.md'),
+        "stylist_template": load_file_content('fashion_stylist_agent.md'),
+    }
+
+
+def build_prompt(sources: Dict[str, str], index: int, same_prompt: bool):
+    """构建第index个请求的提示词；same_prompt为False时每个请求的提示词都不同，不会命中缓存或被合并"""
+    from stylist_app import create_prompt_with_budget
+    query = "工作日通勤穿搭" if same_prompt else f"工作日通勤穿搭（请求{index}）"
+    return create_prompt_with_budget(query, sources["body_data"], sources["wardrobe_data"],
+                                     sources["weather_data"], sources["stylist_template"])
+
+
+def client_runner(api_base: str, same_prompt: bool) -> Callable[[int], Result]:
+    """直接驱动DeepseekClient.chat_stream"""
+    from deepseek_client import DeepseekClient
+    client = DeepseekClient(api_key="benchmark", api_base=api_base)
+    sources = load_prompt_sources()
+
+    def run(index: int) -> Result:
+        system_prompt, prompt, report = build_prompt(sources, index, same_prompt)
+        start = time.monotonic()
+        ttft = None
+        chars = 0
+        for chunk in client.chat_stream(prompt, max_tokens=report["max_tokens"], system_prompt=system_prompt):
+            if chunk.startswith("\n[API错误:"):
+                return Result(False, time.monotonic() - start, ttft, chars, chunk.strip())
+            if ttft is None:
+                ttft = time.monotonic() - start
+            chars += len(chunk)
+        return Result(True, time.monotonic() - start, ttft, chars)
+
+    return run
+
+
+def app_runner(api_base: str, same_prompt: bool) -> Callable[[int], Result]:
+    """驱动stylist_app.generate_outfit_recommendation（经响应缓存和熔断器）"""
+    from stylist_app import generate_outfit_recommendation
+    from example_responses import get_outfit_example
+    sources = load_prompt_sources()
+
+    def run(index: int) -> Result:
+        system_prompt, prompt, report = build_prompt(sources, index, same_prompt)
+        start = time.monotonic()
+        text = generate_outfit_recommendation(prompt, use_api=True, api_key="benchmark",
+                                              max_tokens=report["max_tokens"], system_prompt=system_prompt)
+        latency = time.monotonic() - start
+        # API出错时返回示例回答，计为失败
+        if text == get_outfit_example(prompt):
+            return Result(False, latency, latency, len(text), "fallback", "example")
+        return Result(True, latency, latency, len(text), source="api")
+
+    return run
+
+
+def web_runner(api_base: str, same_prompt: bool) -> Callable[[int], Result]:
+    """经本地HTTP服务驱动/get_recommendation，按SSE事件计算首个正文帧时间"""
+    import requests
+    from werkzeug.serving import make_server
+    from webapp import app
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # 不输出每个请求的访问日志
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/get_recommendation"
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=256))
+
+    def run(index: int) -> Result:
+        query = "工作日通勤穿搭" if same_prompt else f"工作日通勤穿搭（请求{index}）"
+        start = time.monotonic()
+        ttft = None
+        chars = 0
+        source = None
+        event = None
+        try:
+            with session.post(url, json={"user_id": "user1", "scenario": "工作场合", "query": query},
+                              stream=True, timeout=120) as response:
+                if response.status_code != 200:
+                    return Result(False, time.monotonic() - start, error=f"HTTP {response.status_code}")
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event: "):
+                        event = line[7:]
+                    elif line.startswith("data: "):
+                        data = json.loads(line[6:])
+                        if event == "delta":
+                            if ttft is None:
+                                ttft = time.monotonic() - start
+                            chars += len(data.get("text", ""))
+                        elif event == "usage":
+                            source = data.get("source")
+        except requests.RequestException as e:
+            return Result(False, time.monotonic() - start, ttft, chars, str(e))
+        latency = time.monotonic() - start
+        # 改用示例回答说明API调用失败
+        return Result(source == "api", latency, ttft, chars, None if source == "api" else "fallback", source)
+
+    return run
+
+
+RUNNERS = {"client": client_runner, "app": app_runner, "web": web_runner}
+
+
+def synthetic_stream(events: int, seed: int = 0) -> List[bytes]:
+    """
+    生成与Deepseek流式响应格式相同的SSE数据（紧凑JSON，每个事件1~3个字符），
+    并按随机大小切分成网络上收到的数据块（会截断行和多字节字符）
+    """
+    rng = random.Random(seed)
+    text = load_prompt_sources()["stylist_template"] or "穿搭建议"
+    parts = []
+    for index in range(events):
+        offset = index % len(text)
+        chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 1700000000, "model": "deepseek-chat",
+                 "choices": [{"index": 0, "delta": {"content": text[offset:offset + rng.randint(1, 3)]},
+                              "logprobs": None, "finish_reason": None}]}
+        parts.append(b"data: " + json.dumps(chunk, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n\n")
+    usage = {"prompt_tokens": 1000, "completion_tokens": events, "total_tokens": 1000 + events}
+    parts.append(b"data: " + json.dumps({"choices": [], "usage": usage}).encode("utf-8") + b"\n\n")
+    parts.append(b"data: [DONE]\n\n")
+    payload = b"".join(parts)
+
+    chunks, position = [], 0
+    while position < len(payload):
+        size = rng.randint(16, 1500)
+        chunks.append(payload[position:position + size])
+        position += size
+    return chunks
+
+
+def _legacy_parse(chunks: List[bytes]) -> str:
+    """原先的解析方式：requests.iter_lines逐行切分，每行解码、去掉"data: "前缀后json.loads"""
+    def iter_lines():
+        # 与requests.Response.iter_lines相同的切分逻辑
+        pending = None
+        for chunk in chunks:
+            if pending is not None:
+                chunk = pending + chunk
+            lines = chunk.splitlines()
+            if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+                pending = lines.pop()
+            else:
+                pending = None
+            yield from lines
+        if pending is not None:
+            yield pending
+
+    contents = []
+    for line in iter_lines():
+        if not line:
+            continue
+        line = line.decode('utf-8')
+        if not line.startswith('data: '):
+            continue
+        data = line[6:]
+        if data == '[DONE]':
+            break
+        chunk = json.loads(data)
+        if chunk.get('choices') and 'content' in chunk['choices'][0].get('delta', {}):
+            contents.append(chunk['choices'][0]['delta']['content'])
+    return "".join(contents)
+
+
+def _incremental_parse(chunks: List[bytes]) -> str:
+    """现在的解析方式：与deepseek_client._StreamAttempt相同"""
+    from sse_parser import SSEParser
+    from deepseek_client import _parse_event_data
+
+    parser = SSEParser()
+    contents = []
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            done, content, _ = _parse_event_data(event.data)
+            if done:
+                return "".join(contents)
+            if content:
+                contents.append(content)
+    return "".join(contents)
+
+
+def run_parse_benchmark(events: int, rounds: int = 5, seed: int = 0) -> Dict[str, Any]:
+    """
+    比较两种SSE解析方式处理同一份数据的耗时（各取rounds轮中最快的一轮）
+
+    返回:
+        汇总统计
+    """
+    chunks = synthetic_stream(events, seed)
+    if _legacy_parse(chunks) != _incremental_parse(chunks):
+        raise AssertionError("两种解析方式的结果不一致")
+
+    def best(parse):
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            parse(chunks)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    legacy, incremental = best(_legacy_parse), best(_incremental_parse)
+    return {
+        "events": events,
+        "bytes": sum(len(chunk) for chunk in chunks),
+        "network_chunks": len(chunks),
+        "legacy_us_per_event": round(legacy / events * 1e6, 3),
+        "incremental_us_per_event": round(incremental / events * 1e6, 3),
+        "speedup": round(legacy / incremental, 2) if incremental > 0 else None,
+    }
+
+
+def run_benchmark(run: Callable[[int], Result], requests_total: int, concurrency: int,
+                  trace_memory: bool = False) -> Dict[str, Any]:
+    """
+    按指定并发执行全部请求并汇总结果
+
+    参数:
+        run: 执行第i个请求并返回Result的函数
+        requests_total: 请求总数
+        concurrency: 并发数
+        trace_memory: 是否用tracemalloc统计Python对象的峰值内存（更精确，但会明显降低吞吐量）
+
+    返回:
+        汇总统计
+    """
+    if trace_memory:
+        tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, range(requests_total)))
+    elapsed = time.monotonic() - start
+    rss_growth_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    peak_kb = None
+    if trace_memory:
+        peak_kb = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+
+    ok = [r for r in results if r.ok]
+    latencies = [r.latency for r in ok]
+    ttfts = [r.ttft for r in ok if r.ttft is not None]
+    chars = sum(r.chars for r in ok)
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r.ok:
+            errors[r.error or "unknown"] = errors.get(r.error or "unknown", 0) + 1
+
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    summary = {
+        "requests": requests_total,
+        "concurrency": concurrency,
+        "succeeded": len(ok),
+        "failed": requests_total - len(ok),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+        "tokens_per_second": round(chars / elapsed, 1) if elapsed > 0 else None,
+        "rss_growth_kb_per_stream": round(rss_growth_kb / concurrency, 1),
+        "peak_traced_kb_per_stream": round(peak_kb / concurrency, 1) if peak_kb is not None else None,
+    }
+    for name, values in (("latency", latencies), ("ttft", ttfts)):
+        for p in (50, 95, 99):
+            summary[f"{name}_p{p}_ms"] = ms(percentile(values, p))
+    return summary
+
+
+# 与基准结果比较时检查的指标：名称 -> 数值越大越好
+COMPARED_METRICS = {
+    "throughput_rps": True,
+    "latency_p95_ms": False,
+    "ttft_p95_ms": False,
+}
+
+
+def compare(summary: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """
+    与基准结果比较
+
+    返回:
+        退化超过max_regression（比例）的指标说明，没有退化时为空列表
+    """
+    regressions = []
+    for name, higher_is_better in COMPARED_METRICS.items():
+        current, previous = summary.get(name), baseline.get(name)
+        if not current or not previous:
+            continue
+        change = (previous - current) / previous if higher_is_better else (current - previous) / previous
+        if change > max_regression:
+            regressions.append(f"{name}: {previous} -> {current}（退化{change:.0%}）")
+    return regressions
+
+
+def format_summary(target: str, summary: Dict[str, Any]) -> str:
+    lines = [f"\n==== 基准测试结果: {target} ====",
+             f"请求: {summary['succeeded']}/{summary['requests']} 成功，并发 {summary['concurrency']}，"
+             f"耗时 {summary['elapsed_s']}s"]
+    if summary["errors"]:
+        lines.append("错误: " + "，".join(f"{name} ×{count}" for name, count in summary["errors"].items()))
+    lines.append(f"吞吐量: {summary['throughput_rps']} 请求/秒，{summary['tokens_per_second']} 令牌/秒")
+    for name, label in (("latency", "总延迟"), ("ttft", "首个令牌")):
+        lines.append(f"{label}(ms): p50={summary[f'{name}_p50_ms']} p95={summary[f'{name}_p95_ms']} "
+                     f"p99={summary[f'{name}_p99_ms']}")
+    memory = f"内存(KB/流): RSS增长 {summary['rss_growth_kb_per_stream']}"
+    if summary["peak_traced_kb_per_stream"] is not None:
+        memory += f"，Python对象峰值 {summary['peak_traced_kb_per_stream']}"
+    lines.append(memory)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stylist4deepseek 离线性能基准测试')
+    parser.add_argument('--target', choices=TARGETS, default='web', help='测试对象')
+    parser.add_argument('--requests', type=int, default=100, help='请求总数')
+    parser.add_argument('--concurrency', type=int, default=10, help='并发数')
+    parser.add_argument('--same-prompt', action='store_true',
+                        help='所有请求使用相同的提示词（测量响应缓存和请求合并的效果）')
+    parser.add_argument('--mock-url', type=str,
+                        help='使用单独运行的模拟服务（python mock_deepseek.py），避免与被测代码争用同一进程')
+    parser.add_argument('--trace-memory', action='store_true', help='用tracemalloc统计每个流的内存')
+    parser.add_argument('--json', type=str, help='把结果写入JSON文件')
+    parser.add_argument('--baseline', type=str, help='与之前保存的JSON结果比较，退化超过阈值时返回非零退出码')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='允许的退化比例')
+    parser.add_argument('--events', type=int, default=20000, help='--target sse时解析的事件数')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    if args.target == "sse":
+        summary = run_parse_benchmark(args.events, seed=args.seed or 0)
+        print(f"\n==== SSE解析: {summary['events']} 个事件，{summary['bytes']} 字节，"
+              f"{summary['network_chunks']} 个数据块 ====")
+        print(f"逐行解码+json.loads: {summary['legacy_us_per_event']} µs/事件")
+        print(f"增量解析+快速路径: {summary['incremental_us_per_event']} µs/事件（{summary['speedup']}倍）")
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+        return
+
+    mock = None
+    if args.mock_url:
+        api_base = args.mock_url.rstrip("/")
+    else:
+        mock = MockDeepseekServer(config_from_args(args)).start()
+        api_base = mock.api_base
+
+    # 在导入被测模块之前配置环境：指向模拟服务，默认关闭响应缓存，使每个请求都真正调用API
+    os.environ["DEEPSEEK_API_BASE"] = api_base
+    os.environ["DEEPSEEK_API_KEY"] = "benchmark"
+    os.environ["USE_DEEPSEEK_API"] = "true"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if not args.same_prompt:
+        os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+
+    run = RUNNERS[args.target](api_base, args.same_prompt)
+    run(-1)  # 预热：建立连接、加载文件
+    summary = run_benchmark(run, args.requests, args.concurrency, args.trace_memory)
+    summary["target"] = args.target
+    if mock is not None:
+        summary["mock"] = mock.stats()
+        mock.stop()
+
+    print(format_summary(args.target, summary))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(summary, json.load(f), args.max_regression)
+        if regressions:
+            print("\n性能退化:\n- " + "\n- ".join(regressions))
+            sys.exit(1)
+        print("\n与基准结果相比没有明显退化")
+
+
+if __name__ == "__main__":
+    main()
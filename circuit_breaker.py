@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Deepseek API 熔断器
+统计最近一段时间内API调用的失败率和慢调用比例，超过阈值时打开熔断器，
+在冷却期内直接拒绝调用，让调用方在几毫秒内改用本地示例回答；冷却期结束后放行
+少量探测请求（半开状态），探测成功则恢复正常，失败则重新打开。
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from typing import Dict, Any, Optional, Generator, AsyncIterator
+
+from deepseek_client import DeepseekClient, AsyncDeepseekClient, _env_int, _env_float
+from app_logging import get_logger
+from metrics import UPSTREAM_REQUESTS
+
+logger = get_logger("circuit_breaker")
+
+# 熔断器状态
+STATE_CLOSED = "closed"        # 正常放行
+STATE_OPEN = "open"            # 拒绝所有调用
+STATE_HALF_OPEN = "half_open"  # 只放行探测请求
+
+
+class CircuitOpenError(Exception):
+    """熔断器已打开，调用被拒绝"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Deepseek API暂时不可用（熔断器已打开），{retry_after:.0f}秒后重试")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """基于滑动时间窗口失败率和慢调用比例的熔断器"""
+
+    def __init__(self, failure_rate: float = 0.5, slow_call_rate: float = 0.8, slow_call_seconds: float = 15.0,
+                 min_calls: int = 5, window: float = 60.0, open_seconds: float = 30.0, half_open_probes: int = 1):
+        """
+        参数:
+            failure_rate: 窗口内失败调用占比达到该值时打开熔断器
+            slow_call_rate: 窗口内慢调用占比达到该值时打开熔断器
+            slow_call_seconds: 超过该时长（秒，流式调用按首个令牌计算）的调用视为慢调用
+            min_calls: 窗口内至少有这么多次调用才会计算比例
+            window: 统计窗口（秒）
+            open_seconds: 打开后拒绝调用的冷却时间（秒）
+            half_open_probes: 半开状态下同时放行的探测请求数
+        """
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._state = STATE_CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._calls = deque()  # (时间, 是否成功, 是否慢调用)
+        self._lock = threading.Lock()
+        self._stats = {
+            "allowed": 0,
+            "rejected": 0,
+            "successes": 0,
+            "failures": 0,
+            "slow_calls": 0,
+            "opened": 0,
+        }
+
+    def _refresh(self, now: float) -> None:
+        # 调用方需持有self._lock；冷却期结束后进入半开状态
+        if self._state == STATE_OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = STATE_HALF_OPEN
+            self._probes = 0
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+
+    def _open(self, now: float) -> None:
+        # 调用方需持有self._lock
+        self._state = STATE_OPEN
+        self._opened_at = now
+        self._probes = 0
+        self._calls.clear()
+        self._stats["opened"] += 1
+        logger.warning("熔断器打开，%.0f秒内直接使用本地回答", self.open_seconds)
+
+    @property
+    def state(self) -> str:
+        """当前状态（closed / open / half_open）"""
+        with self._lock:
+            self._refresh(time.monotonic())
+            return self._state
+
+    def retry_after(self) -> float:
+        """距离冷却期结束的秒数（未打开时为0）"""
+        with self._lock:
+            now = time.monotonic()
+            self._refresh(now)
+            if self._state != STATE_OPEN:
+                return 0.0
+            return max(0.0, self.open_seconds - (now - self._opened_at))
+
+    def allow(self) -> bool:
+        """
+        申请一次调用
+
+        返回:
+            是否放行；放行后必须调用record()或release()
+        """
+        with self._lock:
+            self._refresh(time.monotonic())
+            if self._state == STATE_CLOSED:
+                allowed = True
+            elif self._state == STATE_HALF_OPEN and self._probes < self.half_open_probes:
+                self._probes += 1
+                allowed = True
+            else:
+                allowed = False
+            self._stats["allowed" if allowed else "rejected"] += 1
+            return allowed
+
+    def record(self, success: bool, latency: float) -> None:
+        """
+        记录一次放行调用的结果
+
+        参数:
+            success: 调用是否成功
+            latency: 调用耗时（秒，流式调用为首个令牌的到达时间）
+        """
+        slow = success and latency >= self.slow_call_seconds
+        now = time.monotonic()
+        with self._lock:
+            self._stats["successes" if success else "failures"] += 1
+            if slow:
+                self._stats["slow_calls"] += 1
+            self._refresh(now)
+
+            if self._state == STATE_HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if success and not slow:
+                    logger.info("探测请求成功，熔断器关闭")
+                    self._state = STATE_CLOSED
+                    self._calls.clear()
+                else:
+                    self._open(now)
+                return
+            if self._state == STATE_OPEN:
+                return  # 打开前已放行的调用，结果不再计入
+
+            self._calls.append((now, success, slow))
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for _, ok, _ in self._calls if not ok)
+            slow_calls = sum(1 for _, _, is_slow in self._calls if is_slow)
+            if failures / total >= self.failure_rate or slow_calls / total >= self.slow_call_rate:
+                self._open(now)
+
+    def release(self) -> None:
+        """放行的调用在得出结果前被放弃（如客户端断开）时归还探测名额"""
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回当前状态、窗口内调用数以及放行、拒绝、失败和打开次数"""
+        with self._lock:
+            now = time.monotonic()
+            self._refresh(now)
+            stats = dict(self._stats)
+            stats["state"] = self._state
+            stats["window_calls"] = len(self._calls)
+            stats["window_failures"] = sum(1 for _, ok, _ in self._calls if not ok)
+            stats["retry_after"] = max(0.0, self.open_seconds - (now - self._opened_at)) \
+                if self._state == STATE_OPEN else 0.0
+        return stats
+
+
+class GuardedDeepseekClient:
+    """
+    带熔断器的Deepseek客户端
+
+    包装一个DeepseekClient，接口保持不变；熔断器打开时generate_completion立即返回错误，
+    chat_stream立即抛出CircuitOpenError，不再等待连接超时。
+    """
+
+    def __init__(self, client: DeepseekClient, breaker: CircuitBreaker):
+        """
+        参数:
+            client: 实际发送请求的客户端
+            breaker: 熔断器
+        """
+        self.client = client
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def generate_completion(self, *args, **kwargs) -> Dict[Any, Any]:
+        """生成文本完成，熔断器打开时返回带circuit_open标记的错误"""
+        if not self.breaker.allow():
+            error = CircuitOpenError(self.breaker.retry_after())
+            logger.debug(str(error))
+            UPSTREAM_REQUESTS.inc(kind="completion", outcome="circuit_open")
+            return {"error": str(error), "circuit_open": True}
+
+        start = time.monotonic()
+        response = self.client.generate_completion(*args, **kwargs)
+        self.breaker.record("error" not in response, time.monotonic() - start)
+        return response
+
+    def chat_stream(self, *args, **kwargs) -> Generator[str, None, None]:
+        """
+        生成流式文本完成
+
+        以首个片段判断成败：首个片段是"[API错误: ...]"时记为失败，否则按首个令牌的到达时间记为成功。
+
+        异常:
+            CircuitOpenError: 熔断器已打开（在产生任何内容之前抛出）
+        """
+        if not self.breaker.allow():
+            UPSTREAM_REQUESTS.inc(kind="stream", outcome="circuit_open")
+            raise CircuitOpenError(self.breaker.retry_after())
+
+        start = time.monotonic()
+        recorded = False
+        try:
+            for chunk in self.client.chat_stream(*args, **kwargs):
+                if not recorded:
+                    self.breaker.record(not chunk.startswith("\n[API错误:"), time.monotonic() - start)
+                    recorded = True
+                yield chunk
+            if not recorded:
+                self.breaker.record(True, time.monotonic() - start)
+                recorded = True
+        finally:
+            if not recorded:
+                self.breaker.release()
+
+
+class AsyncGuardedDeepseekClient:
+    """GuardedDeepseekClient的异步版本，包装AsyncDeepseekClient，与同步客户端共用同一个熔断器"""
+
+    def __init__(self, client: AsyncDeepseekClient, breaker: CircuitBreaker):
+        self.client = client
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def generate_completion(self, *args, **kwargs) -> Dict[Any, Any]:
+        """生成文本完成，熔断器打开时返回带circuit_open标记的错误"""
+        if not self.breaker.allow():
+            error = CircuitOpenError(self.breaker.retry_after())
+            logger.debug(str(error))
+            UPSTREAM_REQUESTS.inc(kind="completion", outcome="circuit_open")
+            return {"error": str(error), "circuit_open": True}
+
+        start = time.monotonic()
+        response = await self.client.generate_completion(*args, **kwargs)
+        self.breaker.record("error" not in response, time.monotonic() - start)
+        return response
+
+    async def chat_stream(self, *args, **kwargs) -> AsyncIterator[str]:
+        """
+        生成流式文本完成（成败的判断方式与GuardedDeepseekClient.chat_stream相同）
+
+        异常:
+            CircuitOpenError: 熔断器已打开（在产生任何内容之前抛出）
+        """
+        if not self.breaker.allow():
+            UPSTREAM_REQUESTS.inc(kind="stream", outcome="circuit_open")
+            raise CircuitOpenError(self.breaker.retry_after())
+
+        start = time.monotonic()
+        recorded = False
+        chunks = self.client.chat_stream(*args, **kwargs)
+        try:
+            async for chunk in chunks:
+                if not recorded:
+                    self.breaker.record(not chunk.startswith("\n[API错误:"), time.monotonic() - start)
+                    recorded = True
+                yield chunk
+            if not recorded:
+                self.breaker.record(True, time.monotonic() - start)
+                recorded = True
+        finally:
+            if not recorded:
+                self.breaker.release()
+            await chunks.aclose()
+
+
+# 进程级熔断器，按环境变量配置
+_default_breaker: Optional[CircuitBreaker] = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker() -> Optional[CircuitBreaker]:
+    """
+    获取进程级熔断器
+
+    返回:
+        CircuitBreaker实例；环境变量CIRCUIT_BREAKER_ENABLED为false时返回None
+    """
+    global _default_breaker
+    if os.environ.get("CIRCUIT_BREAKER_ENABLED", "true").lower() not in ['true', '1', 'yes']:
+        return None
+    if _default_breaker is None:
+        with _breaker_lock:
+            if _default_breaker is None:
+                _default_breaker = CircuitBreaker(
+                    failure_rate=_env_float("CIRCUIT_FAILURE_RATE", 0.5),
+                    slow_call_rate=_env_float("CIRCUIT_SLOW_CALL_RATE", 0.8),
+                    slow_call_seconds=_env_float("CIRCUIT_SLOW_CALL_SECONDS", 15),
+                    min_calls=_env_int("CIRCUIT_MIN_CALLS", 5),
+                    window=_env_float("CIRCUIT_WINDOW_SECONDS", 60),
+                    open_seconds=_env_float("CIRCUIT_OPEN_SECONDS", 30),
+                    half_open_probes=max(1, _env_int("CIRCUIT_HALF_OPEN_PROBES", 1)),
+                )
+    return _default_breaker
+
+
+def guard_client(client: DeepseekClient):
+    """
+    为客户端加上进程级熔断器
+
+    返回:
+        启用熔断器时为GuardedDeepseekClient，否则原样返回
+    """
+    breaker = get_circuit_breaker()
+    if breaker is None:
+        return client
+    return GuardedDeepseekClient(client, breaker)
+
+
+def guard_async_client(client: AsyncDeepseekClient):
+    """
+    为异步客户端加上进程级熔断器（与同步客户端共用）
+
+    返回:
+        启用熔断器时为AsyncGuardedDeepseekClient，否则原样返回
+    """
+    breaker = get_circuit_breaker()
+    if breaker is None:
+        return client
+    return AsyncGuardedDeepseekClient(client, breaker)
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+用户上下文包
+把每个用户的个人信息、衣橱和天气（以及共用的穿搭顾问模板）预先整理成"上下文包"：规范化空白，
+统计各部分的令牌数，渲染好提示词中与需求无关的部分，并计算内容哈希。
+源文件变化后自动重建；上下文包保存在内存中，同时写入磁盘（CONTEXT_BUNDLE_DIR，按最近使用保留有限个），
+重启后源文件未变化时直接载入。只为用户存储中存在的用户生成，未知的用户ID不会占用内存和磁盘。
+
+请求时只需在预先渲染好的内容后追加用户需求；启用衣橱筛选时再加上按场景和需求筛选出的衣橱，
+每个上下文包缓存最近的筛选结果。内容哈希在源文件不变时保持不变，可以作为下游缓存键的一部分。
+
+用法:
+    python context_bundle.py build               # 为用户存储中的全部用户生成
+    python context_bundle.py build --user user1
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+from typing import Dict, Any, Optional, List, Tuple, Callable
+
+from stylist_app import (
+    load_file_content, create_prompt_with_budget, prompt_layout, SECTION_TITLES, PROMPT_INTRO,
+    OUTPUT_FORMAT_SPEC, STABLE_SYSTEM_SECTIONS,
+)
+from prompt_budget import estimate_tokens, input_token_budget, adaptive_max_tokens, format_report
+from wardrobe import filter_wardrobe, season_from_weather
+from app_logging import get_logger, fields
+
+logger = get_logger("context_bundle")
+
+# 磁盘格式版本，格式或渲染方式变化时增加
+BUNDLE_VERSION = 1
+
+# 上下文包中的各部分 -> (用户目录中的文件名, 缺少时使用的默认文件)
+SOURCE_FILES = {
+    "body_data": ("body_data.md", "body_data.md"),
+    "wardrobe": ("wardrobe.md", "wardrobe.md"),
+    "weather": ("weather_forecast.md", "weather_forecast.md"),
+}
+TEMPLATE_FILE = "fashion_stylist_agent.md"
+
+
+def normalize_text(text: str) -> str:
+    """去掉行尾空白，统一换行符，把连续的空行合并为一行，并去掉首尾空行"""
+    lines = []
+    blank = False
+    for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n"):
+        line = line.rstrip()
+        if not line:
+            if not blank and lines:
+                lines.append("")
+            blank = True
+            continue
+        blank = False
+        lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return "\n".join(lines)
+
+
+def source_paths(user_id: str) -> Dict[str, str]:
+    """
+    上下文包的源文件，与stylist_app.load_user_specific_data的选择规则相同
+
+    返回:
+        {部分名称: 文件路径}，包括共用的stylist_template
+    """
+    paths = {}
+    for name, (file_name, default) in SOURCE_FILES.items():
+        path = os.path.join("users", user_id, file_name)
+        paths[name] = path if os.path.isfile(path) and os.path.getsize(path) > 0 else default
+    paths["stylist_template"] = TEMPLATE_FILE
+    return paths
+
+
+def source_signature(paths: Dict[str, str]) -> Dict[str, List]:
+    """各源文件的(路径, 修改时间, 大小)，文件不存在时修改时间和大小为None"""
+    signature = {}
+    for name, path in paths.items():
+        try:
+            st = os.stat(path)
+            signature[name] = [path, st.st_mtime_ns, st.st_size]
+        except OSError:
+            signature[name] = [path, None, None]
+    return signature
+
+
+def _block(name: str, text: str) -> str:
+    # 与stylist_app.render_messages中每个部分的格式相同
+    return f"# {SECTION_TITLES[name]}\n{text}\n\n"
+
+
+class ContextBundle:
+    """一个用户预先整理好的提示词上下文"""
+
+    def __init__(self, user_id: str, texts: Dict[str, str], sources: Dict[str, List], built_at: float,
+                 tokens: Optional[Dict[str, int]] = None):
+        """
+        参数:
+            user_id: 用户ID
+            texts: 规范化后的body_data、wardrobe、weather和stylist_template
+            sources: 构建时各源文件的签名（见source_signature）
+            built_at: 构建时间（Unix时间戳）
+            tokens: 各部分的令牌数，为None时重新统计（从磁盘载入时沿用）
+        """
+        self.user_id = user_id
+        self.texts = texts
+        self.sources = sources
+        self.built_at = built_at
+        self.tokens = tokens or {name: estimate_tokens(text) for name, text in texts.items()}
+        self.tokens.setdefault("output_format", estimate_tokens(OUTPUT_FORMAT_SPEC))
+        material = json.dumps([BUNDLE_VERSION, texts.get("body_data"), texts.get("wardrobe"),
+                               texts.get("weather"), texts.get("stylist_template"), OUTPUT_FORMAT_SPEC],
+                              ensure_ascii=False)
+        self.content_hash = hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+        # 稳定布局中与需求无关的部分：系统消息对所有用户相同，用户消息前缀为个人信息、衣橱和天气
+        system_parts = [PROMPT_INTRO, "\n\n"]
+        for name in STABLE_SYSTEM_SECTIONS:
+            if name == "output_format":
+                system_parts.append(OUTPUT_FORMAT_SPEC)
+                system_parts.append("\n")
+            else:
+                system_parts.append(_block(name, texts[name]))
+        self.system_prompt = "".join(system_parts)
+        self.blocks = {name: _block(name, texts[name]) for name in ("body_data", "wardrobe", "weather")}
+        self.block_tokens = {name: estimate_tokens(block) for name, block in self.blocks.items()}
+        self.block_tokens["system"] = estimate_tokens(self.system_prompt)
+        self.seasons = season_from_weather(texts["weather"])
+
+        self._filtered: "OrderedDict[Tuple, Tuple[str, int, int]]" = OrderedDict()
+        self._filtered_size = 32
+        self._lock = threading.Lock()
+        self.filter_hits = 0
+        self.filter_misses = 0
+
+    @property
+    def body_data(self) -> str:
+        return self.texts["body_data"]
+
+    @property
+    def wardrobe_data(self) -> str:
+        return self.texts["wardrobe"]
+
+    @property
+    def weather_data(self) -> str:
+        return self.texts["weather"]
+
+    @property
+    def stylist_template(self) -> str:
+        return self.texts["stylist_template"]
+
+    def filtered_wardrobe(self, scenario: str, query: str, top_n: int, token_budget: int) -> Tuple[str, int, int]:
+        """
+        按场景和需求筛选衣橱，结果按参数缓存在上下文包中
+
+        返回:
+            (筛选后的衣橱文本, 其令牌数, 渲染成提示词中一部分后的令牌数)
+        """
+        key = (scenario, query, top_n, token_budget)
+        with self._lock:
+            result = self._filtered.get(key)
+            if result is not None:
+                self._filtered.move_to_end(key)
+                self.filter_hits += 1
+                return result
+        text = filter_wardrobe(self.wardrobe_data, scenario=scenario, query=query, top_n=top_n,
+                               token_budget=token_budget, seasons=self.seasons)
+        result = (text, estimate_tokens(text), estimate_tokens(_block("wardrobe", text)))
+        with self._lock:
+            self.filter_misses += 1
+            self._filtered[key] = result
+            while len(self._filtered) > self._filtered_size:
+                self._filtered.popitem(last=False)
+        return result
+
+    def to_dict(self) -> Dict[str, Any]:
+        """写入磁盘的内容（渲染结果和筛选缓存在载入时重新生成）"""
+        return {
+            "version": BUNDLE_VERSION,
+            "tokenizer": os.environ.get("DEEPSEEK_TOKENIZER_PATH", ""),
+            "user_id": self.user_id,
+            "built_at": self.built_at,
+            "content_hash": self.content_hash,
+            "sources": self.sources,
+            "texts": self.texts,
+            "tokens": self.tokens,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> Optional["ContextBundle"]:
+        """从磁盘内容恢复；版本或分词器配置不同时返回None"""
+        if data.get("version") != BUNDLE_VERSION or \
+                data.get("tokenizer") != os.environ.get("DEEPSEEK_TOKENIZER_PATH", ""):
+            return None
+        return cls(data["user_id"], data["texts"], data["sources"], data["built_at"], tokens=data["tokens"])
+
+
+def build_bundle(user_id: str) -> Optional[ContextBundle]:
+    """
+    读取源文件并构建上下文包
+
+    返回:
+        ContextBundle；缺少任何一部分数据时返回None
+    """
+    paths = source_paths(user_id)
+    # 先取签名再读取：读取期间文件被修改时，下次检查会发现签名变化并重建
+    signature = source_signature(paths)
+    texts = {}
+    for name, path in paths.items():
+        content = load_file_content(path)
+        if not content:
+            return None
+        texts[name] = normalize_text(content)
+    return ContextBundle(user_id, texts, signature, time.time())
+
+
+class ContextBundleCache:
+    """
+    上下文包缓存
+    每个用户最多每隔check_interval秒检查一次源文件（os.stat），变化时重建；
+    内存中按最近使用保留max_bundles个，配置了disk_dir时同时写入磁盘，磁盘上按最近使用保留max_disk_bundles个。
+    """
+
+    def __init__(self, disk_dir: Optional[str] = None, check_interval: float = 1.0, max_bundles: int = 1024,
+                 max_disk_bundles: int = 10000, is_known: Optional[Callable[[str], bool]] = None):
+        """
+        参数:
+            disk_dir: 磁盘目录，为None时只保存在内存中
+            check_interval: 检查源文件是否变化的最短间隔（秒）
+            max_bundles: 内存中最多保留的上下文包数
+            max_disk_bundles: 磁盘上最多保留的上下文包数，超出后删除最久未使用的
+            is_known: 判断用户ID是否存在的函数，返回False时不生成上下文包；为None时不检查
+        """
+        self.disk_dir = disk_dir
+        self.check_interval = check_interval
+        self.max_bundles = max(1, max_bundles)
+        self.max_disk_bundles = max(1, max_disk_bundles)
+        self.is_known = is_known
+        self._entries: "OrderedDict[str, Tuple[ContextBundle, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "builds": 0, "rebuilds": 0, "disk_loads": 0, "missing": 0, "unknown": 0,
+                       "disk_evictions": 0}
+        self._disk_count = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_count = len(self._scan_disk())
+
+    def get(self, user_id: str) -> Tuple[Optional[ContextBundle], str]:
+        """
+        获取用户的上下文包
+
+        返回:
+            (上下文包, 来源)；来源为"memory"、"disk"、"built"或"rebuilt"，
+            用户不存在时上下文包为None、来源为"unknown"，缺少数据时上下文包为None、来源为"missing"
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                if now - entry[1] < self.check_interval:
+                    self._stats["hits"] += 1
+                    return entry[0], "memory"
+
+        if entry is not None and source_signature(source_paths(user_id)) == entry[0].sources:
+            with self._lock:
+                self._stats["hits"] += 1
+                self._entries[user_id] = (entry[0], now)
+            return entry[0], "memory"
+
+        # 先确认用户存在，再读取磁盘或生成，任意的用户ID不会写入磁盘
+        if entry is None and self.is_known is not None and not self.is_known(user_id):
+            with self._lock:
+                self._stats["unknown"] += 1
+            return None, "unknown"
+
+        origin = "rebuilt" if entry is not None else "built"
+        bundle = None
+        if entry is None:
+            bundle = self._load_disk(user_id)
+            if bundle is not None:
+                origin = "disk"
+        if bundle is None:
+            bundle = build_bundle(user_id)
+            if bundle is None:
+                with self._lock:
+                    self._stats["missing"] += 1
+                    self._entries.pop(user_id, None)
+                return None, "missing"
+            self._save_disk(bundle)
+            logger.info("已生成上下文包", extra=fields(user_id=user_id, rebuilt=entry is not None,
+                                                        content_hash=bundle.content_hash[:12],
+                                                        tokens=sum(bundle.tokens.values())))
+
+        with self._lock:
+            self._stats["disk_loads" if origin == "disk" else ("rebuilds" if origin == "rebuilt" else "builds")] += 1
+            self._entries[user_id] = (bundle, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_bundles:
+                self._entries.popitem(last=False)
+        return bundle, origin
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        """使指定用户（为None时为全部用户）的上下文包在下次使用时重新检查"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def _disk_path(self, user_id: str) -> str:
+        return os.path.join(self.disk_dir, f"{quote(user_id, safe='')}.json")
+
+    def _scan_disk(self) -> List[Tuple[str, float]]:
+        """列出磁盘上的上下文包文件 (路径, 修改时间)"""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                entries.append((path, os.stat(path).st_mtime))
+            except OSError:
+                continue
+        return entries
+
+    def _evict_disk(self) -> None:
+        """按修改时间（载入时会更新）从旧到新删除文件，直到回到数量上限以内"""
+        entries = sorted(self._scan_disk(), key=lambda e: e[1])
+        remaining = len(entries)
+        for path, _ in entries:
+            if remaining <= self.max_disk_bundles:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            remaining -= 1
+            with self._lock:
+                self._stats["disk_evictions"] += 1
+        with self._lock:
+            self._disk_count = remaining
+
+    def _load_disk(self, user_id: str) -> Optional[ContextBundle]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(user_id)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                bundle = ContextBundle.from_dict(json.load(f))
+            os.utime(path)  # 记录最近使用，淘汰时保留
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("无法载入上下文包 %s: %s", user_id, e)
+            return None
+        if bundle is None or source_signature(source_paths(user_id)) != bundle.sources:
+            return None
+        return bundle
+
+    def _save_disk(self, bundle: ContextBundle) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(bundle.user_id)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            existed = os.path.exists(path)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(bundle.to_dict(), f, ensure_ascii=False)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning("无法写入上下文包 %s: %s", bundle.user_id, e)
+            return
+        if existed:
+            return
+        with self._lock:
+            self._disk_count += 1
+            over_limit = self._disk_count > self.max_disk_bundles
+        if over_limit:
+            self._evict_disk()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            bundles = [entry[0] for entry in self._entries.values()]
+        stats["entries"] = len(bundles)
+        stats["disk_entries"] = self._disk_count
+        stats["filter_hits"] = sum(bundle.filter_hits for bundle in bundles)
+        stats["filter_misses"] = sum(bundle.filter_misses for bundle in bundles)
+        return stats
+
+
+def create_prompt_from_bundle(bundle: ContextBundle, user_query: str, wardrobe: Optional[Tuple[str, int, int]] = None,
+                              budget: Optional[int] = None, layout: Optional[str] = None):
+    """
+    用上下文包创建提示词
+
+    稳定布局且不超出令牌预算时，直接拼接预先渲染好的部分和用户需求，令牌数也取自上下文包；
+    其他情况（legacy布局或需要压缩）交给create_prompt_with_budget，结果与之完全相同。
+
+    参数:
+        bundle: 上下文包
+        user_query: 用户需求（含场景）
+        wardrobe: ContextBundle.filtered_wardrobe的结果，为None时使用完整衣橱
+        budget: 输入令牌预算，为None时使用环境变量PROMPT_TOKEN_BUDGET
+        layout: 提示词布局，为None时使用环境变量PROMPT_LAYOUT
+
+    返回:
+        (系统消息, 用户消息, 统计报告)，报告中的context_hash为上下文包的内容哈希
+    """
+    layout = layout or prompt_layout()
+    budget = input_token_budget() if budget is None else budget
+    if wardrobe is None:
+        wardrobe_text, wardrobe_tokens = bundle.wardrobe_data, bundle.tokens["wardrobe"]
+        wardrobe_block, wardrobe_block_tokens = bundle.blocks["wardrobe"], bundle.block_tokens["wardrobe"]
+    else:
+        wardrobe_text, wardrobe_tokens, wardrobe_block_tokens = wardrobe
+        wardrobe_block = None
+
+    query_block = f"# {SECTION_TITLES['query']}\n{user_query}".rstrip("\n") + "\n"
+    query_tokens = estimate_tokens(user_query)
+    total = (bundle.block_tokens["system"] + bundle.block_tokens["body_data"] + wardrobe_block_tokens +
+             bundle.block_tokens["weather"] + estimate_tokens(query_block))
+
+    if layout != "stable" or (budget > 0 and total > budget):
+        system_prompt, prompt, report = create_prompt_with_budget(
+            user_query, bundle.body_data, wardrobe_text, bundle.weather_data, bundle.stylist_template,
+            budget=budget, layout=layout)
+        report["context_hash"] = bundle.content_hash
+        return system_prompt, prompt, report
+
+    if wardrobe_block is None:
+        wardrobe_block = _block("wardrobe", wardrobe_text)
+    prompt = "".join((bundle.blocks["body_data"], wardrobe_block, bundle.blocks["weather"], query_block))
+
+    section_tokens = {
+        "query": query_tokens,
+        "body_data": bundle.tokens["body_data"],
+        "wardrobe": wardrobe_tokens,
+        "weather": bundle.tokens["weather"],
+        "stylist_template": bundle.tokens["stylist_template"],
+        "output_format": bundle.tokens["output_format"],
+    }
+    report = {
+        "sections": {name: {"tokens": tokens, "original_tokens": tokens, "action": None}
+                     for name, tokens in section_tokens.items()},
+        "overhead_tokens": max(0, total - sum(section_tokens.values())),
+        "total_tokens": total,
+        "budget": budget,
+        "within_budget": True,
+        "max_tokens": adaptive_max_tokens(total, section_tokens["output_format"]),
+        "layout": layout,
+        "context_hash": bundle.content_hash,
+    }
+    logger.info(format_report(report))
+    return bundle.system_prompt, prompt, report
+
+
+def is_known_user(user_id: str) -> bool:
+    """用户存储中是否有该用户；空ID表示没有任何用户时使用的默认数据，同样允许"""
+    from user_store import get_user_store
+    return user_id == "" or get_user_store().get_user(user_id) is not None
+
+
+# 进程级上下文包缓存，按环境变量配置
+_default_cache: Optional[ContextBundleCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_context_bundles() -> Optional[ContextBundleCache]:
+    """
+    获取进程级上下文包缓存
+
+    返回:
+        ContextBundleCache实例；环境变量CONTEXT_BUNDLES_ENABLED为false时返回None
+    """
+    global _default_cache
+    if os.environ.get("CONTEXT_BUNDLES_ENABLED", "true").lower() not in ['true', '1', 'yes']:
+        return None
+    if _default_cache is None:
+        with _cache_lock:
+            if _default_cache is None:
+                try:
+                    check_interval = float(os.environ.get("CONTEXT_BUNDLE_CHECK_SECONDS", 1))
+                except ValueError:
+                    check_interval = 1.0
+                try:
+                    max_bundles = int(os.environ.get("CONTEXT_BUNDLE_MAX", 1024))
+                except ValueError:
+                    max_bundles = 1024
+                try:
+                    max_disk_bundles = int(os.environ.get("CONTEXT_BUNDLE_DISK_MAX", 10000))
+                except ValueError:
+                    max_disk_bundles = 10000
+                _default_cache = ContextBundleCache(
+                    disk_dir=os.environ.get("CONTEXT_BUNDLE_DIR", ".context_bundles") or None,
+                    check_interval=check_interval,
+                    max_bundles=max_bundles,
+                    max_disk_bundles=max_disk_bundles,
+                    is_known=is_known_user,
+                )
+    return _default_cache
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="预先生成用户上下文包")
+    parser.add_argument("command", choices=["build"], help="build: 生成（源文件未变化时跳过）")
+    parser.add_argument("--user", action="append", help="只生成指定用户，可重复；默认为全部用户")
+    args = parser.parse_args()
+
+    cache = get_context_bundles() or ContextBundleCache(disk_dir=os.environ.get("CONTEXT_BUNDLE_DIR") or None)
+    if args.user:
+        user_ids = args.user
+    else:
+        from user_store import get_user_store
+        users, _ = get_user_store().list_users()
+        user_ids = [user["id"] for user in users]
+
+    failed = 0
+    for user_id in user_ids:
+        bundle, origin = cache.get(user_id)
+        if bundle is None:
+            failed += 1
+            print(f"{user_id}: {'用户不存在' if origin == 'unknown' else '缺少数据文件'}")
+        else:
+            print(f"{user_id}: {origin} {bundle.content_hash[:12]} ({sum(bundle.tokens.values())} 令牌)")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,29 +8,617 @@ Deepseek API 客户端
 
 import os
 import json
+import time
+import queue
+import random
+import asyncio
+import threading
 import requests
-from typing import Dict, Any, Optional, Iterator, Generator
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, Optional, Iterator, Generator, Tuple, AsyncIterator, List, Callable
+
+from app_logging import get_logger, fields, sampled, mask_key
+from tracing import current_trace, propagation_headers
+from sse_parser import SSEParser, DEFAULT_EVENT, fast_delta_content
+from metrics import (
+    UPSTREAM_REQUESTS, UPSTREAM_DURATION, UPSTREAM_TTFT, UPSTREAM_TOKENS_PER_SECOND, UPSTREAM_CHUNKS,
+    UPSTREAM_ERRORS, UPSTREAM_RETRIES, UPSTREAM_HEDGES, UPSTREAM_CANCELLED, UPSTREAM_TOKENS_SAVED,
+    error_class, record_usage,
+)
+
+try:
+    import httpx  # 异步客户端依赖，可选
+except ImportError:
+    httpx = None
+
+logger = get_logger("deepseek_client")
+
+
+def _env_int(name: str, default: int) -> int:
+    """读取整数类型的环境变量，格式错误时使用默认值"""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    """读取浮点类型的环境变量，格式错误时使用默认值"""
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class TransportConfig:
+    """HTTP传输层配置（连接池大小、超时等）"""
+
+    def __init__(self, pool_connections: int = 4, pool_maxsize: int = 32, pool_block: bool = False,
+                 connect_timeout: float = 5.0, read_timeout: float = 120.0, keep_alive: bool = True):
+        """
+        参数:
+            pool_connections: 缓存的主机连接池数量（每个主机一个池）
+            pool_maxsize: 每个主机连接池中保留的最大连接数
+            pool_block: 连接池耗尽时是否阻塞等待空闲连接（否则临时新建连接）
+            connect_timeout: 建立连接的超时时间（秒）
+            read_timeout: 两次读取之间的超时时间（秒），流式响应按单个数据块计算
+            keep_alive: 是否保持长连接
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+
+    @classmethod
+    def from_env(cls) -> "TransportConfig":
+        """从环境变量创建配置"""
+        return cls(
+            pool_connections=_env_int("DEEPSEEK_POOL_CONNECTIONS", 4),
+            pool_maxsize=_env_int("DEEPSEEK_POOL_MAXSIZE", 32),
+            pool_block=os.environ.get("DEEPSEEK_POOL_BLOCK", "").lower() in ['true', '1', 'yes'],
+            connect_timeout=_env_float("DEEPSEEK_CONNECT_TIMEOUT", 5.0),
+            read_timeout=_env_float("DEEPSEEK_READ_TIMEOUT", 120.0),
+            keep_alive=os.environ.get("DEEPSEEK_KEEP_ALIVE", "true").lower() in ['true', '1', 'yes'],
+        )
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        """requests使用的(连接超时, 读取超时)元组"""
+        return (self.connect_timeout, self.read_timeout)
+
+
+# 进程级共享的HTTP会话，所有客户端实例复用同一个连接池
+_shared_session: Optional[requests.Session] = None
+_shared_config: Optional[TransportConfig] = None
+_session_lock = threading.Lock()
+
+
+def get_shared_session(config: Optional[TransportConfig] = None) -> requests.Session:
+    """
+    获取进程级共享的HTTP会话
+
+    首次调用时按配置创建带连接池的会话，之后所有调用返回同一个会话，
+    从而复用已建立的TCP/TLS连接，避免每次请求重新握手。
+
+    参数:
+        config: 传输层配置，仅在会话首次创建时生效；为None时从环境变量读取
+
+    返回:
+        共享的requests.Session对象
+    """
+    global _shared_session, _shared_config
+    if _shared_session is None:
+        with _session_lock:
+            if _shared_session is None:
+                _shared_config = config or TransportConfig.from_env()
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=_shared_config.pool_connections,
+                    pool_maxsize=_shared_config.pool_maxsize,
+                    pool_block=_shared_config.pool_block,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                if not _shared_config.keep_alive:
+                    session.headers["Connection"] = "close"
+                _shared_session = session
+    return _shared_session
+
+
+def get_transport_config() -> TransportConfig:
+    """获取共享会话当前使用的传输层配置"""
+    get_shared_session()
+    return _shared_config
+
+
+def close_shared_session() -> None:
+    """关闭共享会话并释放连接池中的所有连接（进程退出或重新配置时使用）"""
+    global _shared_session, _shared_config
+    with _session_lock:
+        if _shared_session is not None:
+            _shared_session.close()
+        _shared_session = None
+        _shared_config = None
+
+
+def _log_request(endpoint: str, model: str, max_tokens: int, temperature: float, stream: bool) -> None:
+    """记录请求参数（DEBUG级别，每次请求都会调用，按LOG_SAMPLE_RATE采样；同步与异步客户端共用，不记录API密钥）"""
+    logger.debug("发送API请求", extra=sampled(endpoint=endpoint, model=model, max_tokens=max_tokens,
+                                             temperature=temperature, stream=stream))
+
+
+class _CompletionLength:
+    """
+    成功的流式调用平均生成的令牌数（指数移动平均）
+    用于估算中途取消的流式调用节省了多少输出令牌；还没有成功的调用时按max_tokens估算。
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self.average: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def update(self, completion_tokens: int) -> None:
+        with self._lock:
+            if self.average is None:
+                self.average = float(completion_tokens)
+            else:
+                self.average += self.alpha * (completion_tokens - self.average)
+
+    def tokens_saved(self, max_tokens: int, received: int) -> int:
+        """
+        参数:
+            max_tokens: 请求的最大生成令牌数
+            received: 取消前已经收到的片段数（每个片段通常对应一个令牌）
+
+        返回:
+            估算的未生成令牌数
+        """
+        expected = max_tokens if self.average is None else min(max_tokens, self.average)
+        return max(0, int(expected - received))
+
+
+_completion_length = _CompletionLength()
+
+
+def _record_stream(outcome: str, start: float, first_token: Optional[float], chunks: int,
+                   usage: Dict[str, int], max_tokens: int) -> None:
+    """一次流式调用结束时记录指标和一条汇总日志（同步与异步客户端共用）"""
+    end = time.monotonic()
+    UPSTREAM_REQUESTS.inc(kind="stream", outcome=outcome)
+    UPSTREAM_DURATION.observe(end - start, kind="stream")
+    UPSTREAM_CHUNKS.inc(chunks)
+    # 只有一两个片段时生成时间接近0，算出的速度没有意义
+    if first_token is not None and chunks > 1 and usage.get("completion_tokens") and end - first_token >= 0.05:
+        UPSTREAM_TOKENS_PER_SECOND.observe(usage["completion_tokens"] / (end - first_token))
+    tokens_saved = None
+    if outcome == "success" and usage.get("completion_tokens"):
+        _completion_length.update(usage["completion_tokens"])
+    elif outcome == "cancelled":
+        # 调用方（通常是已断开的客户端）不再读取，关闭连接后上游停止生成剩余的令牌
+        tokens_saved = _completion_length.tokens_saved(max_tokens, chunks)
+        UPSTREAM_CANCELLED.inc(phase="streaming" if first_token is not None else "before_first_token")
+        UPSTREAM_TOKENS_SAVED.inc(tokens_saved)
+    message = f"流式API调用结束: {format_usage(usage)}" if usage else "流式API调用结束"
+    logger.info(message, extra=fields(
+        outcome=outcome,
+        duration_ms=round((end - start) * 1000, 1),
+        ttft_ms=round((first_token - start) * 1000, 1) if first_token is not None else None,
+        chunks=chunks,
+        tokens_saved=tokens_saved,
+    ))
+
+
+def _record_completion(outcome: str, start: float, usage: Dict[str, int]) -> None:
+    """一次非流式调用结束时记录指标和一条汇总日志"""
+    end = time.monotonic()
+    duration = end - start
+    trace = current_trace()
+    if trace is not None:
+        trace.record("upstream.completion", start, end, outcome=outcome, **usage)
+    UPSTREAM_REQUESTS.inc(kind="completion", outcome=outcome)
+    UPSTREAM_DURATION.observe(duration, kind="completion")
+    if usage:
+        record_usage(usage)
+    message = f"API调用结束: {format_usage(usage)}" if usage else "API调用结束"
+    logger.info(message, extra=fields(outcome=outcome, duration_ms=round(duration * 1000, 1)))
+
+
+def _start_stream_span(model: str, max_tokens: int):
+    """在当前请求链路中开始upstream.stream阶段，没有链路时返回None"""
+    trace = current_trace()
+    if trace is None:
+        return None
+    return trace.start_span("upstream.stream", model=model, max_tokens=max_tokens)
+
+
+def _trace_attempt(stage, attempt: "_StreamAttempt", retry: int) -> None:
+    """补记一次请求的连接（到收到响应头）和等待首个令牌两个阶段"""
+    if stage is None:
+        return
+    trace = current_trace()
+    if trace is None or trace.trace_id != stage.trace_id:
+        return
+    trace.record("upstream.connect", attempt.sent_at, attempt.headers_at, parent=stage,
+                 attempt=retry + 1, hedged=attempt.hedged)
+    trace.record("upstream.first_token", attempt.headers_at, attempt.first_token_at, parent=stage)
+
+
+def _finish_stream_span(stage, outcome: str, first_token: Optional[float], chunks: int, received_bytes: int,
+                        parse_seconds: float, retries: int, usage: Dict[str, int]) -> None:
+    """结束upstream.stream阶段；SSE解析分散在整个生成过程中，按累计耗时补记为一个阶段"""
+    if stage is None:
+        return
+    end = time.monotonic()
+    trace = current_trace()
+    if trace is not None and trace.trace_id == stage.trace_id and first_token is not None:
+        trace.record("upstream.generate", first_token, end, parent=stage)
+        trace.record("upstream.sse_parse", first_token, first_token + parse_seconds, parent=stage)
+    stage.set(outcome=outcome, chunks=chunks, bytes=received_bytes, retries=retries,
+              parse_ms=round(parse_seconds * 1000, 2), **usage)
+    if first_token is not None:
+        stage.set(ttft_ms=round((first_token - stage.start) * 1000, 1))
+        if usage.get("completion_tokens") and end - first_token > 0:
+            stage.set(tokens_per_second=round(usage["completion_tokens"] / (end - first_token), 1))
+    stage.finish(end)
+
+
+def _build_messages(prompt: str, system_prompt: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    构建messages列表
+
+    参数:
+        prompt: 用户消息
+        system_prompt: 系统消息，为None时只发送一条用户消息
+
+    返回:
+        Chat Completions接口的messages参数
+    """
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def summarize_usage(usage: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    提取API响应usage字段中的令牌统计
+
+    Deepseek会在usage中返回上下文硬盘缓存的命中情况（prompt_cache_hit_tokens /
+    prompt_cache_miss_tokens），其他兼容接口没有这些字段时对应项不出现。
+
+    返回:
+        只包含整数统计项的字典，usage为空时返回空字典
+    """
+    if not isinstance(usage, dict):
+        return {}
+    keys = ("prompt_tokens", "completion_tokens", "total_tokens",
+            "prompt_cache_hit_tokens", "prompt_cache_miss_tokens")
+    return {key: usage[key] for key in keys if isinstance(usage.get(key), int)}
+
+
+def format_usage(usage: Dict[str, int]) -> str:
+    """把令牌统计格式化为一行日志"""
+    line = f"API令牌用量: 输入{usage.get('prompt_tokens', '?')}，输出{usage.get('completion_tokens', '?')}"
+    if "prompt_cache_hit_tokens" in usage:
+        hit = usage["prompt_cache_hit_tokens"]
+        total = hit + usage.get("prompt_cache_miss_tokens", 0)
+        ratio = f"{hit / total:.0%}" if total else "0%"
+        line += f"，上下文缓存命中{hit}（{ratio}）"
+    return line
+
+
+def _parse_event_data(data: str) -> Tuple[bool, Optional[str], Optional[Dict[str, Any]]]:
+    """
+    解析一个SSE事件的data（同步与异步客户端共用）
+
+    参数:
+        data: 事件的data文本（多行data已按规范用换行连接）
+
+    返回:
+        (是否收到结束标记[DONE], 事件携带的增量文本或None, 事件携带的usage或None)
+    """
+    # 结束标记
+    if data == '[DONE]':
+        return True, None, None
+    
+    # 只含增量文本的数据块（绝大多数）不构建完整的JSON对象
+    content = fast_delta_content(data)
+    if content is not None:
+        return False, content, None
+    
+    try:
+        # 解析响应并提取内容
+        chunk = json.loads(data)
+        # 开启stream_options.include_usage后，最后一个数据块携带整次请求的usage
+        usage = chunk.get('usage') or None
+        
+        if 'choices' in chunk and len(chunk['choices']) > 0:
+            choice = chunk['choices'][0]
+            
+            if 'delta' in choice and 'content' in choice['delta']:
+                return False, choice['delta']['content'], usage
+        
+        return False, None, usage
+    
+    except (json.JSONDecodeError, AttributeError) as e:
+        logger.warning("SSE数据JSON解析失败: %s", e, extra=fields(data=data[:200]))
+    
+    return False, None, None
+
+
+def _report_usage(usage: Dict[str, Any], on_usage: Optional[Callable[[Dict[str, int]], None]]) -> None:
+    """记录流式响应中的usage统计并通知调用方"""
+    usage = summarize_usage(usage)
+    if not usage:
+        return
+    record_usage(usage)
+    if on_usage is not None:
+        on_usage(usage)
+
+
+def _release_response(response: requests.Response, reuse: bool) -> None:
+    """
+    释放流式响应占用的连接
+
+    参数:
+        response: 流式请求返回的响应对象
+        reuse: 响应已完整读取时为True，剩余数据读尽后将连接归还连接池；
+               为False时（如中途放弃）直接关闭连接，避免继续接收无用数据
+    """
+    try:
+        if reuse:
+            response.raw.drain_conn()
+            response.raw.release_conn()
+        else:
+            response.close()
+    except Exception:
+        response.close()
+
+
+class APIStatusError(Exception):
+    """API返回了非200状态码"""
+
+    def __init__(self, status_code: int, body: str, retry_after: Optional[float] = None):
+        super().__init__(f"API返回错误: {status_code} - {body}")
+        self.status_code = status_code
+        self.body = body
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After响应头（秒数或HTTP日期），无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """
+    重试与对冲请求策略
+
+    只重试暂时性故障：连接失败、超时，以及408/429/5xx状态码；400/401/403等请求本身的错误不重试。
+    两次重试之间按指数退避并加入随机抖动（full jitter），服务端给出Retry-After时至少等待该时长。
+    """
+
+    def __init__(self, max_retries: int = 2, base_delay: float = 0.5, max_delay: float = 8.0,
+                 max_retry_after: float = 30.0, hedge_after: float = 0.0,
+                 retry_statuses: Tuple[int, ...] = (408, 409, 429, 500, 502, 503, 504)):
+        """
+        参数:
+            max_retries: 首次请求失败后最多重试的次数
+            base_delay: 第一次重试前的退避上限（秒），之后每次翻倍
+            max_delay: 单次退避时间的上限（秒）
+            max_retry_after: 可以接受的Retry-After上限（秒），服务端要求等待更久时不再重试
+            hedge_after: 流式请求在这么多秒内没有收到第一个令牌时，再发起一个相同的请求，
+                         采用先产生令牌的那个；0表示不使用对冲请求
+            retry_statuses: 视为暂时性故障的HTTP状态码
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.hedge_after = hedge_after
+        self.retry_statuses = retry_statuses
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """从环境变量创建策略"""
+        return cls(
+            max_retries=_env_int("DEEPSEEK_MAX_RETRIES", 2),
+            base_delay=_env_float("DEEPSEEK_RETRY_BASE_DELAY", 0.5),
+            max_delay=_env_float("DEEPSEEK_RETRY_MAX_DELAY", 8.0),
+            hedge_after=_env_float("DEEPSEEK_HEDGE_AFTER_MS", 0) / 1000.0,
+        )
+
+    def is_transient(self, error: Exception) -> bool:
+        """判断错误是否值得重试"""
+        if isinstance(error, APIStatusError):
+            return error.status_code in self.retry_statuses
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              requests.exceptions.ChunkedEncodingError)):
+            return True
+        return httpx is not None and isinstance(error, httpx.TransportError)
+
+    def backoff(self, retry: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """
+        计算第retry次重试（从0开始）前的等待时间
+
+        返回:
+            等待秒数；Retry-After超过max_retry_after时返回None，表示不应重试
+        """
+        if retry_after is not None and retry_after > self.max_retry_after:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class _StreamAttempt:
+    """一次流式请求：读到第一个令牌后才交给调用方，便于重试和对冲"""
+
+    def __init__(self, response: requests.Response, hedged: bool = False, sent_at: Optional[float] = None,
+                 chunks=None):
+        self.response = response
+        self.hedged = hedged
+        # 按网络上到达的原始字节块读取，由增量解析器切分事件
+        self.chunks = response.iter_content(chunk_size=None) if chunks is None else chunks
+        self.parser = SSEParser()
+        self.buffered = []
+        self.usages = []
+        self.finished = False
+        # 链路追踪用的时间点和计数
+        self.headers_at = time.monotonic()
+        self.sent_at = self.headers_at if sent_at is None else sent_at
+        self.first_token_at = self.headers_at
+        self.bytes = 0
+        self.parse_seconds = 0.0
+
+    def _consume(self, chunk: Optional[bytes]) -> List[str]:
+        """
+        解析一个字节块（None表示数据流结束），返回其中完整事件携带的非空文本；
+        收到[DONE]后忽略之后的全部数据
+        """
+        parse_start = time.perf_counter()
+        events = self.parser.feed(chunk) if chunk is not None else self.parser.close()
+        contents = []
+        for event in events:
+            if event.event != DEFAULT_EVENT:
+                continue  # Chat Completions只使用默认的message事件
+            done, content, usage = _parse_event_data(event.data)
+            if usage:
+                self.usages.append(usage)
+            if done:
+                self.finished = True
+                break
+            if content:  # 跳过空内容
+                contents.append(content)
+        self.parse_seconds += time.perf_counter() - parse_start
+        if chunk is not None:
+            self.bytes += len(chunk)
+        return contents
+
+    def prime(self) -> None:
+        """读取到第一个令牌（或流结束）为止"""
+        try:
+            for chunk in self.chunks:
+                self.buffered.extend(self._consume(chunk))
+                if self.buffered or self.finished:
+                    return
+            self.buffered.extend(self._consume(None))
+            self.finished = True
+        finally:
+            self.first_token_at = time.monotonic()
+
+    def contents(self, on_usage) -> Generator[str, None, None]:
+        """产生剩余的全部文本片段"""
+        yield from self.buffered
+        self.buffered = []
+        if not self.finished:
+            for chunk in self.chunks:
+                yield from self._consume(chunk)
+                if self.finished:
+                    break
+            else:
+                yield from self._consume(None)
+                self.finished = True
+        for usage in self.usages:
+            _report_usage(usage, on_usage)
+
+    def close(self) -> None:
+        _release_response(self.response, reuse=self.finished)
+
+
+class _AsyncStreamAttempt(_StreamAttempt):
+    """_StreamAttempt的异步版本"""
+
+    def __init__(self, response: "httpx.Response", hedged: bool = False, sent_at: Optional[float] = None):
+        super().__init__(response, hedged, sent_at, chunks=response.aiter_bytes())
+
+    async def prime(self) -> None:
+        try:
+            async for chunk in self.chunks:
+                self.buffered.extend(self._consume(chunk))
+                if self.buffered or self.finished:
+                    return
+            self.buffered.extend(self._consume(None))
+            self.finished = True
+        finally:
+            self.first_token_at = time.monotonic()
+
+    async def contents(self, on_usage) -> AsyncIterator[str]:
+        for content in self.buffered:
+            yield content
+        self.buffered = []
+        if not self.finished:
+            async for chunk in self.chunks:
+                for content in self._consume(chunk):
+                    yield content
+                if self.finished:
+                    break
+            else:
+                for content in self._consume(None):
+                    yield content
+                self.finished = True
+        for usage in self.usages:
+            _report_usage(usage, on_usage)
+
+    async def close(self) -> None:
+        # 收到[DONE]后读尽剩余数据，使连接可以归还连接池；中途放弃时直接关闭
+        try:
+            if self.finished:
+                async for _ in self.chunks:
+                    pass
+        except Exception:
+            pass
+        await self.response.aclose()
+
 
 class DeepseekClient:
     """Deepseek API 客户端类"""
     
-    def __init__(self, api_key: Optional[str] = None, api_base: str = "https://api.deepseek.com/v1"):
+    def __init__(self, api_key: Optional[str] = None, api_base: str = "https://api.deepseek.com/v1",
+                 session: Optional[requests.Session] = None, timeout: Optional[Tuple[float, float]] = None,
+                 retry_policy: Optional[RetryPolicy] = None):
         """
         初始化Deepseek API客户端
         
         参数:
             api_key: Deepseek API密钥，如果为None则尝试从环境变量获取
             api_base: API基础URL
+            session: 使用的HTTP会话，为None时使用进程级共享的连接池会话
+            timeout: (连接超时, 读取超时)，为None时使用传输层配置中的值
+            retry_policy: 重试与对冲请求策略，为None时从环境变量读取
         """
         self.api_key = api_key or os.environ.get("DEEPSEEK_API_KEY")
         if not self.api_key:
-            print("警告: 未提供Deepseek API密钥，请通过参数或环境变量DEEPSEEK_API_KEY设置")
+            logger.warning("未提供Deepseek API密钥，请通过参数或环境变量DEEPSEEK_API_KEY设置")
         else:
             # 检查并清理API密钥格式
             self.api_key = self.api_key.strip()  # 移除可能的空格
-            print(f"API密钥设置成功，长度: {len(self.api_key)}")
+            logger.info("创建Deepseek客户端", extra=fields(api_base=api_base, api_key=mask_key(self.api_key)))
         
         self.api_base = api_base
+        self.session = session or get_shared_session()
+        self.timeout = timeout or get_transport_config().timeout
+        self.retry_policy = retry_policy or RetryPolicy.from_env()
+        self.retry_stats = {"retries": 0, "hedged_requests": 0, "hedge_wins": 0}
+        self._stats_lock = threading.Lock()
         
         # 设置请求头
         self.headers = {
@@ -39,146 +627,233 @@ class DeepseekClient:
         
         if self.api_key:
             self.headers["Authorization"] = f"Bearer {self.api_key}"
-            print("认证头部已设置")
-        else:
-            print("警告: 未设置认证头部")
     
     def generate_completion(self, prompt: str, model: str = "deepseek-reasoner", max_tokens: int = 2000, 
-                          temperature: float = 0.7) -> Dict[Any, Any]:
+                          temperature: float = 0.7, system_prompt: Optional[str] = None) -> Dict[Any, Any]:
         """
         生成文本完成
         
         参数:
-            prompt: 提示词
+            prompt: 提示词（用户消息）
             model: 模型名称
             max_tokens: 最大生成的令牌数
             temperature: 温度参数，控制随机性
+            system_prompt: 系统消息，放置各次请求相同的内容以命中服务端的上下文缓存
             
         返回:
             API响应的JSON对象
         """
         endpoint = f"{self.api_base}/chat/completions"
         
-        # 打印API密钥信息（注意：生产环境应移除）
-        if self.api_key:
-            masked_key = self.api_key[:4] + "*" * (len(self.api_key) - 8) + self.api_key[-4:]
-            print(f"使用API密钥: {masked_key}")
-            print(f"API密钥长度: {len(self.api_key)}")
-        else:
-            print("警告: 未设置API密钥")
-        
-        # 打印请求信息
-        print(f"请求API端点: {endpoint}")
-        print(f"使用模型: {model}")
-        print(f"最大令牌数: {max_tokens}")
-        print(f"温度参数: {temperature}")
+        _log_request(endpoint, model, max_tokens, temperature, stream=False)
         
         payload = {
             "model": model,
-            "messages": [{"role": "user", "content": prompt}],
+            "messages": _build_messages(prompt, system_prompt),
             "max_tokens": max_tokens,
             "temperature": temperature
         }
         
-        try:
-            print("正在发送API请求...")
-            response = requests.post(endpoint, headers=self.headers, json=payload)
-            
-            print(f"收到响应状态码: {response.status_code}")
-            if response.status_code != 200:
-                print(f"响应内容: {response.text}")
+        headers = {**self.headers, **propagation_headers()}
+        retry = 0
+        start = time.monotonic()
+        while True:
+            try:
+                response = self.session.post(endpoint, headers=headers, json=payload, timeout=self.timeout)
+                if response.status_code != 200:
+                    raise APIStatusError(response.status_code, response.text,
+                                         _parse_retry_after(response.headers.get("Retry-After")))
                 
-            response.raise_for_status()  # 检查HTTP错误
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"API请求错误: {str(e)}")
-            if hasattr(e, 'response') and e.response:
-                print(f"响应内容: {e.response.text}")
-            return {"error": str(e)}
+                result = response.json()
+                _record_completion("success", start, summarize_usage(result.get("usage")))
+                return result
+            except (requests.exceptions.RequestException, APIStatusError) as e:
+                UPSTREAM_ERRORS.inc(error_class=error_class(e))
+                delay = self._retry_delay(e, retry)
+                if delay is not None:
+                    retry += 1
+                    time.sleep(delay)
+                    continue
+                logger.error("API请求错误: %s", e, extra=fields(error_class=error_class(e)))
+                _record_completion("error", start, {})
+                return {"error": str(e)}
+    
+    def _retry_delay(self, error: Exception, retry: int) -> Optional[float]:
+        """
+        判断失败的请求是否重试
+
+        返回:
+            重试前的等待秒数，不重试时返回None
+        """
+        policy = self.retry_policy
+        if retry >= policy.max_retries or not policy.is_transient(error):
+            return None
+        delay = policy.backoff(retry, getattr(error, "retry_after", None))
+        if delay is None:
+            return None
+        with self._stats_lock:
+            self.retry_stats["retries"] += 1
+        UPSTREAM_RETRIES.inc()
+        logger.warning("请求失败（%s），%.2f秒后进行第%d次重试", error, delay, retry + 1)
+        return delay
+    
+    def _send_stream_request(self, endpoint: str, payload: Dict[str, Any], hedged: bool = False,
+                             headers: Optional[Dict[str, str]] = None) -> _StreamAttempt:
+        """发送流式请求并读取到第一个令牌"""
+        sent_at = time.monotonic()
+        response = self.session.post(endpoint, headers=headers or self.headers, json=payload, stream=True,
+                                     timeout=self.timeout)
+        if response.status_code != 200:
+            body = response.text
+            response.close()
+            raise APIStatusError(response.status_code, body, _parse_retry_after(response.headers.get("Retry-After")))
+        
+        attempt = _StreamAttempt(response, hedged, sent_at)
+        try:
+            attempt.prime()
+        except Exception:
+            attempt.close()
+            raise
+        return attempt
+    
+    def _open_stream(self, endpoint: str, payload: Dict[str, Any],
+                     headers: Optional[Dict[str, str]] = None) -> _StreamAttempt:
+        """
+        打开流式请求；启用对冲时，首个令牌超过hedge_after秒未到达则再发起一个相同的请求，
+        采用先产生令牌的那个，另一个被关闭
+        """
+        hedge_after = self.retry_policy.hedge_after
+        if hedge_after <= 0:
+            return self._send_stream_request(endpoint, payload, headers=headers)
+        
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {"winner": None}
+        
+        def run(hedged):
+            try:
+                attempt = self._send_stream_request(endpoint, payload, hedged, headers)
+            except Exception as e:
+                results.put((False, e))
+                return
+            with lock:
+                won = state["winner"] is None
+                if won:
+                    state["winner"] = attempt
+            if won:
+                results.put((True, attempt))
+            else:
+                attempt.close()  # 另一个请求已先产生令牌
+        
+        threading.Thread(target=run, args=(False,), daemon=True).start()
+        pending, hedged, error = 1, False, None
+        while pending:
+            try:
+                ok, value = results.get(timeout=None if hedged else hedge_after)
+            except queue.Empty:
+                logger.info("首个令牌超过%.0fms未到达，发起对冲请求", hedge_after * 1000)
+                with self._stats_lock:
+                    self.retry_stats["hedged_requests"] += 1
+                UPSTREAM_HEDGES.inc(result="started")
+                threading.Thread(target=run, args=(True,), daemon=True).start()
+                pending, hedged = pending + 1, True
+                continue
+            pending -= 1
+            if ok:
+                if value.hedged:
+                    with self._stats_lock:
+                        self.retry_stats["hedge_wins"] += 1
+                    UPSTREAM_HEDGES.inc(result="won")
+                return value
+            error = value
+            if not hedged:
+                break
+        raise error
     
     def chat_stream(self, prompt: str, model: str = "deepseek-chat", max_tokens: int = 2000,
-                   temperature: float = 0.7, top_p: float = 0.9) -> Generator[str, None, None]:
+                   temperature: float = 0.7, top_p: float = 0.9, system_prompt: Optional[str] = None,
+                   on_usage: Optional[Callable[[Dict[str, int]], None]] = None) -> Generator[str, None, None]:
         """
         生成流式文本完成，逐字返回生成内容
         
+        尚未产生任何内容时遇到暂时性故障会按重试策略自动重试；已经产生内容后不再重试，
+        以免调用方收到重复的文本。
+        
         参数:
-            prompt: 提示词
+            prompt: 提示词（用户消息）
             model: 模型名称
             max_tokens: 最大生成的令牌数
             temperature: 温度参数，控制随机性
             top_p: 核采样参数
+            system_prompt: 系统消息，放置各次请求相同的内容以命中服务端的上下文缓存
+            on_usage: 收到usage统计（见summarize_usage）时调用的回调
             
         返回:
             一个生成器，逐字产生生成的文本内容
         """
         endpoint = f"{self.api_base}/chat/completions"
         
-        # 打印API密钥信息（调试用）
-        if self.api_key:
-            masked_key = self.api_key[:4] + "*" * (len(self.api_key) - 8) + self.api_key[-4:]
-            print(f"使用API密钥(流式): {masked_key}")
-            print(f"API密钥长度: {len(self.api_key)}")
-        else:
-            print("警告: 未设置API密钥")
-        
-        # 打印请求信息
-        print(f"请求流式API端点: {endpoint}")
-        print(f"使用模型: {model}")
-        print(f"最大令牌数: {max_tokens}")
-        print(f"温度参数: {temperature}")
+        _log_request(endpoint, model, max_tokens, temperature, stream=True)
         
         payload = {
             "model": model,
-            "messages": [{"role": "user", "content": prompt}],
+            "messages": _build_messages(prompt, system_prompt),
             "max_tokens": max_tokens,
             "temperature": temperature,
             "top_p": top_p,
-            "stream": True  # 启用流式传输
+            "stream": True,  # 启用流式传输
+            "stream_options": {"include_usage": True}  # 在最后一个数据块中返回usage
         }
         
+        retry = 0
+        start = time.monotonic()
+        first_token = None
+        chunks = 0
+        received_bytes = 0
+        parse_seconds = 0.0
+        outcome = "cancelled"  # 调用方中途停止读取时保持该值
+        usage = {}
+        stage = _start_stream_span(model, max_tokens)
+        headers = {**self.headers, **propagation_headers(stage)}
+        
+        def collect_usage(values):
+            usage.update(values)
+            if on_usage is not None:
+                on_usage(values)
+        
         try:
-            print("正在发送流式API请求...")
-            response = requests.post(endpoint, headers=self.headers, json=payload, stream=True)
-            
-            print(f"收到响应状态码: {response.status_code}")
-            if response.status_code != 200:
-                print(f"响应错误: {response.text}")
-                raise Exception(f"API返回错误: {response.status_code} - {response.text}")
-            
-            # 逐行处理SSE流式响应
-            for line in response.iter_lines():
-                if line:
-                    # 跳过"data: "前缀并解析JSON
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
-                        line = line[6:]  # 去除"data: "前缀
-                        
-                        # 跳过心跳消息
-                        if line == '[DONE]':
-                            print("流式响应完成")
-                            break
-                        
-                        try:
-                            # 解析响应并提取内容
-                            data = json.loads(line)
-                            
-                            if 'choices' in data and len(data['choices']) > 0:
-                                choice = data['choices'][0]
-                                
-                                if 'delta' in choice and 'content' in choice['delta']:
-                                    content = choice['delta']['content']
-                                    if content:  # 跳过空内容
-                                        yield content
-                                
-                        except json.JSONDecodeError as e:
-                            print(f"JSON解析错误: {e}")
-                            print(f"原始行: {line}")
-                            
-        except Exception as e:
-            import traceback
-            print(f"流式API请求错误: {str(e)}")
-            print(traceback.format_exc())
-            yield f"\n[API错误: {str(e)}]"
+            while True:
+                attempt = None
+                try:
+                    attempt = self._open_stream(endpoint, payload, headers)
+                    first_token = time.monotonic()
+                    _trace_attempt(stage, attempt, retry)
+                    UPSTREAM_TTFT.observe(first_token - start)
+                    # 片段只在本地计数，结束时一次性记录指标
+                    for content in attempt.contents(collect_usage):
+                        chunks += 1
+                        yield content
+                    outcome = "success"
+                    return
+                except Exception as e:
+                    UPSTREAM_ERRORS.inc(error_class=error_class(e))
+                    delay = None if chunks else self._retry_delay(e, retry)
+                    if delay is None:
+                        outcome = "error"
+                        logger.error("流式API请求错误: %s", e, exc_info=not isinstance(e, APIStatusError),
+                                     extra=fields(error_class=error_class(e)))
+                        yield f"\n[API错误: {str(e)}]"
+                        return
+                finally:
+                    if attempt is not None:
+                        attempt.close()
+                        received_bytes += attempt.bytes
+                        parse_seconds += attempt.parse_seconds
+                retry += 1
+                time.sleep(delay)
+        finally:
+            _finish_stream_span(stage, outcome, first_token, chunks, received_bytes, parse_seconds, retry, usage)
+            _record_stream(outcome, start, first_token, chunks, usage, max_tokens)
     
     def extract_completion_text(self, response: Dict[Any, Any]) -> str:
         """
@@ -191,14 +866,6 @@ class DeepseekClient:
             生成的文本内容
         """
         try:
-            # 打印响应结构（调试用）
-            print("响应结构:")
-            if isinstance(response, dict):
-                for key in response.keys():
-                    print(f" - 包含键: {key}")
-            else:
-                print(f" - 响应不是字典类型，而是: {type(response)}")
-                
             # 检查错误
             if "error" in response:
                 return f"错误: {response['error']}"
@@ -206,37 +873,325 @@ class DeepseekClient:
             # Deepseek API响应解析 (通常是choices.0.message.content格式)
             if "choices" in response and len(response["choices"]) > 0:
                 choice = response["choices"][0]
-                print(" - 找到choices数组")
                 
                 if "message" in choice:
                     message = choice["message"]
-                    print(" - 找到message对象")
                     
                     if "content" in message:
-                        content = message["content"]
-                        print(" - 找到content内容")
-                        return content
+                        return message["content"]
                     else:
-                        print(" - message中没有content字段")
+                        logger.warning("响应的message中没有content字段")
                         return f"API响应错误: message中没有content字段\n{json.dumps(message, ensure_ascii=False, indent=2)}"
                 elif "text" in choice:
                     # 兼容可能的老版本API
-                    print(" - 找到text字段 (旧版API)")
                     return choice["text"]
                 else:
-                    print(" - 无法在choice中找到message或text字段")
+                    logger.warning("无法在choice中找到message或text字段")
                     return f"API响应错误: 无法解析choices内容\n{json.dumps(choice, ensure_ascii=False, indent=2)}"
             
             # 完全不符合预期的响应结构
-            print("警告: 响应结构不符合预期")
+            logger.warning("响应结构不符合预期", extra=fields(
+                keys=list(response.keys()) if isinstance(response, dict) else type(response).__name__))
             return f"无法提取生成内容，响应结构不符合预期:\n{json.dumps(response, ensure_ascii=False, indent=2)}"
             
         except Exception as e:
-            import traceback
-            print(f"解析响应时出错: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception("解析响应时出错: %s", e)
             return f"提取内容时出错: {str(e)}"
 
+class AsyncDeepseekClient:
+    """
+    Deepseek API 异步客户端类
+
+    基于asyncio和httpx实现，与DeepseekClient解析相同的SSE格式，
+    在错误处理和[DONE]结束标记上的行为保持一致。单个事件循环即可
+    同时处理大量并发的流式请求，无需为每个请求占用一个线程。
+
+    使用示例:
+        async with AsyncDeepseekClient() as client:
+            async for chunk in client.chat_stream(prompt):
+                ...
+    """
+    
+    def __init__(self, api_key: Optional[str] = None, api_base: str = "https://api.deepseek.com/v1",
+                 http_client: Optional["httpx.AsyncClient"] = None,
+                 transport_config: Optional[TransportConfig] = None,
+                 retry_policy: Optional[RetryPolicy] = None):
+        """
+        初始化Deepseek API异步客户端
+        
+        参数:
+            api_key: Deepseek API密钥，如果为None则尝试从环境变量获取
+            api_base: API基础URL
+            http_client: 使用的httpx.AsyncClient，为None时在首次请求时按传输层配置创建
+            transport_config: 传输层配置（连接池大小、超时），为None时从环境变量读取
+            retry_policy: 重试与对冲请求策略，为None时从环境变量读取
+        """
+        if httpx is None:
+            raise ImportError("AsyncDeepseekClient需要httpx，请先执行: pip install httpx")
+        
+        self.api_key = api_key or os.environ.get("DEEPSEEK_API_KEY")
+        if not self.api_key:
+            logger.warning("未提供Deepseek API密钥，请通过参数或环境变量DEEPSEEK_API_KEY设置")
+        else:
+            self.api_key = self.api_key.strip()
+            logger.info("创建异步Deepseek客户端", extra=fields(api_base=api_base, api_key=mask_key(self.api_key)))
+        
+        self.api_base = api_base
+        self.config = transport_config or TransportConfig.from_env()
+        self._http_client = http_client
+        self._owns_http_client = http_client is None
+        self.retry_policy = retry_policy or RetryPolicy.from_env()
+        self.retry_stats = {"retries": 0, "hedged_requests": 0, "hedge_wins": 0}
+        
+        # 设置请求头
+        self.headers = {
+            "Content-Type": "application/json"
+        }
+        if self.api_key:
+            self.headers["Authorization"] = f"Bearer {self.api_key}"
+    
+    @property
+    def http_client(self) -> "httpx.AsyncClient":
+        """底层的httpx异步客户端（带连接池），首次访问时创建"""
+        if self._http_client is None:
+            limits = httpx.Limits(
+                max_connections=self.config.pool_maxsize,
+                max_keepalive_connections=self.config.pool_maxsize if self.config.keep_alive else 0,
+            )
+            timeout = httpx.Timeout(self.config.read_timeout, connect=self.config.connect_timeout)
+            self._http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        return self._http_client
+    
+    async def aclose(self) -> None:
+        """关闭客户端自行创建的连接池"""
+        if self._http_client is not None and self._owns_http_client:
+            await self._http_client.aclose()
+            self._http_client = None
+    
+    async def __aenter__(self) -> "AsyncDeepseekClient":
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+    
+    async def generate_completion(self, prompt: str, model: str = "deepseek-reasoner", max_tokens: int = 2000,
+                                  temperature: float = 0.7, system_prompt: Optional[str] = None) -> Dict[Any, Any]:
+        """
+        生成文本完成（异步版本，参数、返回值和重试行为与DeepseekClient.generate_completion一致）
+        """
+        endpoint = f"{self.api_base}/chat/completions"
+        _log_request(endpoint, model, max_tokens, temperature, stream=False)
+        
+        payload = {
+            "model": model,
+            "messages": _build_messages(prompt, system_prompt),
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+        
+        headers = {**self.headers, **propagation_headers()}
+        retry = 0
+        start = time.monotonic()
+        while True:
+            try:
+                response = await self.http_client.post(endpoint, headers=headers, json=payload)
+                if response.status_code != 200:
+                    raise APIStatusError(response.status_code, response.text,
+                                         _parse_retry_after(response.headers.get("Retry-After")))
+                
+                result = response.json()
+                _record_completion("success", start, summarize_usage(result.get("usage")))
+                return result
+            except (httpx.HTTPError, APIStatusError, ValueError) as e:
+                UPSTREAM_ERRORS.inc(error_class=error_class(e))
+                delay = self._retry_delay(e, retry)
+                if delay is not None:
+                    retry += 1
+                    await asyncio.sleep(delay)
+                    continue
+                logger.error("API请求错误: %s", e, extra=fields(error_class=error_class(e)))
+                _record_completion("error", start, {})
+                return {"error": str(e)}
+    
+    def _retry_delay(self, error: Exception, retry: int) -> Optional[float]:
+        """判断失败的请求是否重试，返回重试前的等待秒数，不重试时返回None"""
+        policy = self.retry_policy
+        if retry >= policy.max_retries or not policy.is_transient(error):
+            return None
+        delay = policy.backoff(retry, getattr(error, "retry_after", None))
+        if delay is None:
+            return None
+        self.retry_stats["retries"] += 1
+        UPSTREAM_RETRIES.inc()
+        logger.warning("请求失败（%s），%.2f秒后进行第%d次重试", error, delay, retry + 1)
+        return delay
+    
+    async def _send_stream_request(self, endpoint: str, payload: Dict[str, Any], hedged: bool = False,
+                                   headers: Optional[Dict[str, str]] = None) -> _AsyncStreamAttempt:
+        """发送流式请求并读取到第一个令牌"""
+        sent_at = time.monotonic()
+        request = self.http_client.build_request("POST", endpoint, headers=headers or self.headers, json=payload)
+        response = await self.http_client.send(request, stream=True)
+        if response.status_code != 200:
+            body = (await response.aread()).decode('utf-8', errors='replace')
+            await response.aclose()
+            raise APIStatusError(response.status_code, body, _parse_retry_after(response.headers.get("Retry-After")))
+        
+        attempt = _AsyncStreamAttempt(response, hedged, sent_at)
+        try:
+            await attempt.prime()
+        except BaseException:
+            await response.aclose()
+            raise
+        return attempt
+    
+    async def _open_stream(self, endpoint: str, payload: Dict[str, Any],
+                           headers: Optional[Dict[str, str]] = None) -> _AsyncStreamAttempt:
+        """打开流式请求，对冲逻辑与DeepseekClient._open_stream一致"""
+        hedge_after = self.retry_policy.hedge_after
+        if hedge_after <= 0:
+            return await self._send_stream_request(endpoint, payload, headers=headers)
+        
+        tasks = {asyncio.ensure_future(self._send_stream_request(endpoint, payload, headers=headers))}
+        hedged, error = False, None
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=None if hedged else hedge_after,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info("首个令牌超过%.0fms未到达，发起对冲请求", hedge_after * 1000)
+                    self.retry_stats["hedged_requests"] += 1
+                    UPSTREAM_HEDGES.inc(result="started")
+                    tasks.add(asyncio.ensure_future(self._send_stream_request(endpoint, payload, True, headers)))
+                    hedged = True
+                    continue
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        await task.result().close()  # 两个请求同时产生令牌时只保留一个
+                if winner is not None:
+                    if winner.hedged:
+                        self.retry_stats["hedge_wins"] += 1
+                        UPSTREAM_HEDGES.inc(result="won")
+                    return winner
+                if not hedged:
+                    break
+            raise error
+        finally:
+            # 取消尚未产生令牌的另一个请求
+            for task in tasks:
+                task.cancel()
+    
+    async def chat_stream(self, prompt: str, model: str = "deepseek-chat", max_tokens: int = 2000,
+                          temperature: float = 0.7, top_p: float = 0.9, system_prompt: Optional[str] = None,
+                          on_usage: Optional[Callable[[Dict[str, int]], None]] = None) -> AsyncIterator[str]:
+        """
+        生成流式文本完成（异步迭代器版本，参数和重试行为与DeepseekClient.chat_stream一致）
+        
+        返回:
+            一个异步迭代器，逐段产生生成的文本内容；出错时产生一条"[API错误: ...]"文本
+        """
+        endpoint = f"{self.api_base}/chat/completions"
+        _log_request(endpoint, model, max_tokens, temperature, stream=True)
+        
+        payload = {
+            "model": model,
+            "messages": _build_messages(prompt, system_prompt),
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "stream": True,  # 启用流式传输
+            "stream_options": {"include_usage": True}  # 在最后一个数据块中返回usage
+        }
+        
+        retry = 0
+        start = time.monotonic()
+        first_token = None
+        chunks = 0
+        received_bytes = 0
+        parse_seconds = 0.0
+        outcome = "cancelled"  # 调用方中途停止读取时保持该值
+        usage = {}
+        stage = _start_stream_span(model, max_tokens)
+        headers = {**self.headers, **propagation_headers(stage)}
+        
+        def collect_usage(values):
+            usage.update(values)
+            if on_usage is not None:
+                on_usage(values)
+        
+        try:
+            while True:
+                attempt = None
+                delay = None
+                try:
+                    attempt = await self._open_stream(endpoint, payload, headers)
+                    first_token = time.monotonic()
+                    _trace_attempt(stage, attempt, retry)
+                    UPSTREAM_TTFT.observe(first_token - start)
+                    async for content in attempt.contents(collect_usage):
+                        chunks += 1
+                        yield content
+                    outcome = "success"
+                    return
+                except Exception as e:
+                    UPSTREAM_ERRORS.inc(error_class=error_class(e))
+                    delay = None if chunks else self._retry_delay(e, retry)
+                    if delay is None:
+                        outcome = "error"
+                        logger.error("流式API请求错误: %s", e, exc_info=not isinstance(e, APIStatusError),
+                                     extra=fields(error_class=error_class(e)))
+                        yield f"\n[API错误: {str(e)}]"
+                        return
+                finally:
+                    if attempt is not None:
+                        await attempt.close()
+                        received_bytes += attempt.bytes
+                        parse_seconds += attempt.parse_seconds
+                retry += 1
+                await asyncio.sleep(delay)
+        finally:
+            _finish_stream_span(stage, outcome, first_token, chunks, received_bytes, parse_seconds, retry, usage)
+            _record_stream(outcome, start, first_token, chunks, usage, max_tokens)
+    
+    # 响应解析逻辑与同步客户端完全相同
+    extract_completion_text = DeepseekClient.extract_completion_text
+
+
+# 长期复用的客户端实例，按(API密钥, API基础URL)区分
+_clients: Dict[Tuple[Optional[str], str], DeepseekClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key: Optional[str] = None, api_base: Optional[str] = None) -> DeepseekClient:
+    """
+    获取长期复用的Deepseek客户端
+
+    相同API密钥和基础URL的调用返回同一个实例，避免每次请求重新构造客户端。
+
+    参数:
+        api_key: Deepseek API密钥，如果为None则尝试从环境变量获取
+        api_base: API基础URL，如果为None则读取环境变量DEEPSEEK_API_BASE（如指向本地模拟服务），
+                  未设置时使用官方地址
+
+    返回:
+        DeepseekClient实例
+    """
+    api_base = api_base or os.environ.get("DEEPSEEK_API_BASE") or "https://api.deepseek.com/v1"
+    key = (api_key or os.environ.get("DEEPSEEK_API_KEY"), api_base)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = DeepseekClient(api_key=key[0], api_base=api_base)
+                _clients[key] = client
+    return client
+
 # 简单的使用示例
 if __name__ == "__main__":
     client = DeepseekClient()
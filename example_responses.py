@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+示例穿搭建议
+未启用API、API不可用或熔断器打开时使用的本地回答，不依赖网络，可以立即返回。
+"""
+
+# 示例穿搭方案（工作日通勤场景）
+EXAMPLE_OUTFIT = """
+【穿搭设计方案】#001
+
+▶ 场景定位：工作日通勤
+▶ 风格基调：极简都市风 + 法式优雅元素
+▶ 体型优化：强调腰线、平衡梨形身材比例
+▶ 季节适应：春季 | 5-20℃ | 多云转晴
+
+━━━━━━━━━━ 单品组合 ━━━━━━━━━━
+
+➊ 上装：真丝飘带衬衫 + 优质真丝 + 浅蓝色 + 立领设计 [衣橱已有]
+   • 亮点：飘带元素增添女性柔美气质
+   • 搭配理由：立领修饰颈部线条，飘带可多种系法变化造型
+   • 衣橱状态：用户衣橱中有一件浅蓝色真丝立领衬衫，带有可拆卸飘带，是去年购买的高质量单品
+
+➋ 下装：高腰九分烟管裤 + 挺括面料 + 黑色 + 直筒剪裁 [衣橱已有]
+   • 亮点：高腰设计拉长腿部比例
+   • 搭配理由：修身但不紧绷的剪裁平衡下半身比例，黑色显瘦
+   • 衣橱状态：用户衣橱中有两条高腰黑色直筒裤，选择那条九分款更适合春季穿着
+
+➌ 外套：收腰短款西装 + 精致羊毛混纺 + 黑色 + 短款设计 [建议购买]
+   • 亮点：收腰设计强调腰线
+   • 搭配理由：短款西装与高腰裤搭配创造黄金比例，增添专业感
+   • 衣橱状态：用户衣橱中有一件常规版型的黑色西装，但缺少收腰设计的短款西装，建议购买以更好地突出腰线
+
+➍ 鞋履：裸色尖头高跟鞋 + 优质皮革 + 肤色 + 7cm粗跟 [衣橱已有]
+   • 亮点：视觉延伸腿部线条
+   • 搭配理由：粗跟设计兼顾稳定性和舒适度，肤色增加腿部延伸感
+   • 衣橱状态：用户衣橱中有一双与描述完全匹配的裸色粗跟高跟鞋，状态良好
+
+➎ 包袋：结构化通勤托特包 + 小牛皮 + 深酒红色 + 金属五金 [建议购买]
+   • 亮点：专业大气，实用性强，酒红色增添高级感
+   • 搭配理由：容量适中可容纳电脑，色彩为黑蓝基础搭配注入活力
+   • 衣橱状态：用户衣橱中有黑色和米色托特包，但缺少能为穿搭增添色彩的款式，深酒红色是安全但有品味的选择
+
+➏ 配饰：18K金珍珠锁骨链 + 优雅珍珠 + 金白搭配 + 简约设计 [衣橱已有]
+   • 亮点：低调优雅的点缀
+   • 搭配理由：珍珠元素与飘带衬衫呼应，增添女性柔美气质
+   • 衣橱状态：用户珠宝盒中有一条珍珠锁骨链，为家传饰品，品质优良且具有情感价值
+
+━━━━━━━━━━ 穿搭解析 ━━━━━━━━━━
+
+⚡ 色彩和谐：浅蓝+黑色基础配色 | 肤色鞋履温和过渡 | 金色饰品点缀 | 酒红包袋提亮整体
+⚡ 比例构建：高腰裤+短款外套应用3:7黄金比例 | 视觉重心在腰部
+⚡ 材质互动：硬挺西装+柔软真丝+皮革形成质感层次 | 正式感与柔美平衡
+⚡ 风格统一：都市极简为基调 | 飘带与珍珠增添法式风情 | 整体简约大气
+⚡ 与用户喜好匹配：根据用户个人信息，她偏爱简约优雅的风格，且对法式元素有好感。这套穿搭使用她喜欢的蓝色系作为主色调，并通过立领、飘带等细节呼应她对精致细节的欣赏
+
+━━━━━━━━━━ 实用建议 ━━━━━━━━━━
+
+✓ 穿着顺序：内搭衬衫 → 高腰裤 → 短款西装 → 配饰点缀
+✓ 变体拓展：
+  1. 天气转暖可脱去西装，领口飘带换系法增添变化 [全部为衣橱已有]
+  2. 下班约会可更换真丝裹身中长裙 [建议购买]，保留相同上装与配饰 [衣橱已有]
+  3. 周末休闲版本：将上装换为白色棉质T恤 [衣橱已有]，配同色系休闲夹克 [建议购买]
+✓ 注意事项：真丝衬衫避免使用普通洗衣粉，建议手洗或干洗
+✓ 购买建议：
+  - 收腰短款西装：建议关注季末折扣，预算2000-3000元，优先选择羊毛含量高的款式
+  - 酒红色托特包：可考虑二线轻奢品牌，预算1500-2500元，注意选择结构挺括、有内部分隔的款式
+  - 真丝裹身裙：建议选择可调节腰带的设计，预算800-1500元
+
+━━━━━━━━━━ 总结 ━━━━━━━━━━
+
+✓ 已有单品利用：本套穿搭充分利用了用户已有的高质量基础单品（真丝衬衫、高腰裤、珍珠配饰和裸色高跟鞋），这些单品都是经典款式，组合起来已具备职场优雅感
+✓ 推荐购买理由：建议购买的三件单品（收腰西装、酒红包袋和真丝裹身裙）都是能够提升整体衣橱价值的投资款。收腰西装强调用户优势腰线；酒红包袋为多套穿搭增添色彩活力；真丝裹身裙则增加了下装选择，使工作-约会的场景切换更为顺畅。这三件单品都具有较高的性价比和多种搭配可能性。
+"""
+
+
+def get_outfit_example(prompt: str = "") -> str:
+    """
+    获取示例穿搭建议
+
+    参数:
+        prompt: 提示词（目前只有一套通用示例，保留该参数便于以后按场景选择）
+
+    返回:
+        示例穿搭建议文本
+    """
+    return EXAMPLE_OUTFIT
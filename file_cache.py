@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+数据文件内存缓存
+缓存用户信息、衣橱、天气和穿搭顾问模板等Markdown文件的内容，
+每次读取时通过stat检查修改时间和文件大小，文件变化后自动重新加载。
+"""
+
+import os
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+
+class FileCache:
+    """按(修改时间, 文件大小)校验的线程安全文件内容缓存"""
+
+    def __init__(self, encoding: str = 'utf-8'):
+        """
+        参数:
+            encoding: 文件编码
+        """
+        self.encoding = encoding
+        self._entries: Dict[str, Tuple[int, int, str]] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "reloads": 0,
+        }
+
+    def read(self, file_path: str) -> str:
+        """
+        读取文件内容，文件未变化时直接返回内存中的内容
+
+        参数:
+            file_path: 文件路径
+
+        返回:
+            文件内容
+
+        异常:
+            文件不存在或无法读取时抛出OSError（失败结果不会被缓存）
+        """
+        path = os.path.abspath(file_path)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self._stats["hits"] += 1
+                return entry[2]
+
+        # 以打开后的fstat结果为准，避免读取过程中文件被替换导致版本信息与内容不一致
+        with open(path, 'r', encoding=self.encoding) as file:
+            st = os.fstat(file.fileno())
+            content = file.read()
+
+        with self._lock:
+            if entry is None:
+                self._stats["misses"] += 1
+            else:
+                self._stats["reloads"] += 1
+            self._entries[path] = (st.st_mtime_ns, st.st_size, content)
+        return content
+
+    def invalidate(self, file_path: Optional[str] = None) -> None:
+        """使指定文件（为None时为全部文件）的缓存失效"""
+        with self._lock:
+            if file_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(file_path), None)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中、未命中和重新加载次数"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["chars"] = sum(len(entry[2]) for entry in self._entries.values())
+        lookups = stats["hits"] + stats["misses"] + stats["reloads"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+# 进程级共享的文件缓存
+file_cache = FileCache()
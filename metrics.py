@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+运行指标
+进程内的计数器和直方图，以及导出时才从各组件统计计算的仪表（见register_collector），以Prometheus文本格式（/metrics）导出。
+指标在请求结束时按次记录，流式输出的每个片段只在本地累加，不在令牌路径上加锁或写出。
+"""
+
+import bisect
+import threading
+from typing import Dict, Any, List, Tuple, Callable, Iterable, Optional
+
+# 默认的耗时直方图分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 生成速度直方图分桶（令牌/秒）
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类，按标签值分别保存数据"""
+
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[Any, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[Any, ...]:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in items]
+
+
+class Histogram(_Metric):
+    """分桶直方图"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(key, (list(entry[0]), entry[1], entry[2])) for key, entry in self._values.items()]
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, Dict[str, Any], float]]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, Dict[str, Any], float]]]) -> None:
+        """
+        注册导出时才计算的指标
+
+        参数:
+            collector: 返回若干(名称, 类型, 说明, 标签, 数值)的函数，用于导出缓存、队列等已有的统计信息
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """以Prometheus文本格式导出全部指标"""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        seen = set()
+        for collector in collectors:
+            try:
+                samples = list(collector())
+            except Exception:
+                continue
+            for name, type_name, help_text, labels, value in samples:
+                if value is None:
+                    continue
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {type_name}")
+                names = tuple(labels)
+                lines.append(f"{name}{_format_labels(names, tuple(labels[n] for n in names))} "
+                             f"{_format_value(float(value))}")
+        return "\n".join(lines) + "\n"
+
+
+# 进程级注册表
+REGISTRY = MetricsRegistry()
+
+# Deepseek API调用
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "stylist_upstream_requests_total", "Deepseek API调用次数", ("kind", "outcome"))
+UPSTREAM_DURATION = REGISTRY.histogram(
+    "stylist_upstream_request_duration_seconds", "Deepseek API调用总耗时", ("kind",))
+UPSTREAM_TTFT = REGISTRY.histogram(
+    "stylist_upstream_time_to_first_token_seconds", "流式调用首个令牌的到达时间")
+UPSTREAM_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "stylist_upstream_tokens_per_second", "流式调用首个令牌之后的生成速度", buckets=RATE_BUCKETS)
+UPSTREAM_TOKENS = REGISTRY.counter(
+    "stylist_upstream_tokens_total", "API返回的令牌用量", ("type",))
+UPSTREAM_CHUNKS = REGISTRY.counter(
+    "stylist_upstream_stream_chunks_total", "流式调用收到的内容片段数")
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "stylist_upstream_errors_total", "Deepseek API调用错误（按错误类别）", ("error_class",))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "stylist_upstream_retries_total", "重试次数")
+UPSTREAM_HEDGES = REGISTRY.counter(
+    "stylist_upstream_hedged_requests_total", "对冲请求次数及其中先产生令牌的次数", ("result",))
+UPSTREAM_CANCELLED = REGISTRY.counter(
+    "stylist_upstream_cancelled_total", "调用方中途放弃的流式调用（按放弃时所处阶段）", ("phase",))
+UPSTREAM_TOKENS_SAVED = REGISTRY.counter(
+    "stylist_upstream_tokens_saved_total", "中途取消流式调用估算节省的输出令牌数")
+
+# 穿搭建议请求
+RECOMMENDATIONS = REGISTRY.counter(
+    "stylist_recommendations_total", "穿搭建议请求数（按回答来源）", ("source",))
+RECOMMENDATION_DURATION = REGISTRY.histogram(
+    "stylist_recommendation_duration_seconds", "穿搭建议流式响应的总时长", ("source",))
+RECOMMENDATION_FRAMES = REGISTRY.counter(
+    "stylist_recommendation_frames_total", "发送给客户端的正文帧数")
+RECOMMENDATIONS_CANCELLED = REGISTRY.counter(
+    "stylist_recommendations_cancelled_total", "客户端中途断开的穿搭建议流（按断开时所处阶段）", ("phase",))
+
+# HTTP接口
+HTTP_REQUESTS = REGISTRY.counter(
+    "stylist_http_requests_total", "HTTP请求数", ("endpoint", "method", "status"))
+HTTP_DURATION = REGISTRY.histogram(
+    "stylist_http_request_duration_seconds", "HTTP请求处理时间（流式响应只计算到开始发送）", ("endpoint",))
+
+
+def error_class(error: Optional[BaseException]) -> str:
+    """错误类别：HTTP状态码错误为"http_<状态码>"，其他为异常类名"""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return f"http_{status}"
+    return type(error).__name__ if error is not None else "unknown"
+
+
+def record_usage(usage: Dict[str, int]) -> None:
+    """记录API返回的令牌用量（summarize_usage的结果）"""
+    for key, label in (("prompt_tokens", "prompt"), ("completion_tokens", "completion"),
+                       ("prompt_cache_hit_tokens", "prompt_cache_hit"),
+                       ("prompt_cache_miss_tokens", "prompt_cache_miss")):
+        if key in usage:
+            UPSTREAM_TOKENS.inc(usage[key], type=label)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+本地模拟的Deepseek API服务
+在本机实现/chat/completions接口（流式和非流式），首个令牌延迟、生成速度、SSE片段大小、
+错误注入和上下文缓存命中比例都可以配置，用于离线运行性能基准测试（见benchmark.py），
+不需要API密钥和网络连接。
+
+用法:
+    python mock_deepseek.py --port 8800 --ttft-ms 300 --tokens-per-second 60
+    DEEPSEEK_API_BASE=http://127.0.0.1:8800/v1 python webapp.py
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional
+
+from example_responses import EXAMPLE_OUTFIT
+
+
+class MockConfig:
+    """模拟服务的行为配置"""
+
+    def __init__(self, ttft: float = 0.2, tokens_per_second: float = 50.0, completion_tokens: int = 400,
+                 chunk_tokens: int = 1, error_rate: float = 0.0, error_status: int = 503,
+                 retry_after: Optional[int] = None, cache_hit_ratio: float = 0.0, seed: Optional[int] = None):
+        """
+        参数:
+            ttft: 收到请求到发送第一个令牌的延迟（秒）
+            tokens_per_second: 首个令牌之后的生成速度，0表示不限速
+            completion_tokens: 每次回答的令牌数（请求的max_tokens更小时以max_tokens为准）
+            chunk_tokens: 每个SSE数据块携带的令牌数
+            error_rate: 返回错误状态码的请求比例
+            error_status: 注入错误时的状态码
+            retry_after: 注入错误时返回的Retry-After（秒），为None时不返回
+            cache_hit_ratio: usage中上下文缓存命中的提示词令牌比例
+            seed: 错误注入的随机种子，便于复现
+        """
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.cache_hit_ratio = cache_hit_ratio
+        self.random = random.Random(seed)
+
+
+def _completion_text(tokens: int) -> str:
+    """按令牌数截取示例回答作为生成内容（一个字符按一个令牌计算）"""
+    text = EXAMPLE_OUTFIT.strip()
+    repeat = tokens // len(text) + 1
+    return (text * repeat)[:tokens]
+
+
+def _usage(payload: Dict[str, Any], completion_tokens: int, cache_hit_ratio: float) -> Dict[str, int]:
+    prompt_chars = sum(len(message.get("content", "")) for message in payload.get("messages", []))
+    prompt_tokens = max(1, prompt_chars // 2)
+    hit = int(prompt_tokens * cache_hit_ratio) // 64 * 64  # 服务端按64令牌为单位缓存
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_cache_hit_tokens": hit,
+        "prompt_cache_miss_tokens": prompt_tokens - hit,
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持长连接，与真实服务一致
+
+    server: "MockDeepseekServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data: bytes) -> None:
+        # HTTP/1.1分块传输编码
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+
+        config = self.server.config
+        self.server.count("requests")
+        if config.error_rate and config.random.random() < config.error_rate:
+            self.server.count("errors")
+            headers = {"Retry-After": str(config.retry_after)} if config.retry_after is not None else None
+            self._send_json(config.error_status, {"error": {"message": "injected error"}}, headers)
+            return
+
+        tokens = min(config.completion_tokens, int(payload.get("max_tokens") or config.completion_tokens))
+        text = _completion_text(tokens)
+        usage = _usage(payload, tokens, config.cache_hit_ratio)
+        time.sleep(config.ttft)
+
+        if not payload.get("stream"):
+            if config.tokens_per_second > 0:
+                time.sleep(tokens / config.tokens_per_second)
+            self._send_json(200, {
+                "id": "mock", "object": "chat.completion", "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = config.chunk_tokens / config.tokens_per_second if config.tokens_per_second > 0 else 0
+        try:
+            next_at = time.monotonic()
+            for offset in range(0, len(text), config.chunk_tokens):
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at += interval
+                chunk = {"choices": [{"index": 0, "delta": {"content": text[offset:offset + config.chunk_tokens]}}]}
+                self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if (payload.get("stream_options") or {}).get("include_usage"):
+                self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count("disconnects")  # 客户端中途断开
+            self.close_connection = True
+
+
+class MockDeepseekServer(ThreadingHTTPServer):
+    """在后台线程中运行的模拟服务"""
+
+    daemon_threads = True
+
+    def __init__(self, config: Optional[MockConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        """
+        参数:
+            config: 行为配置，为None时使用默认值
+            host: 监听地址
+            port: 监听端口，0表示自动选择空闲端口
+        """
+        super().__init__((host, port), _Handler)
+        self.config = config or MockConfig()
+        self._counts = {"requests": 0, "errors": 0, "disconnects": 0}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        """传给DeepseekClient的API基础URL"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """返回收到的请求数、注入的错误数和客户端中途断开数"""
+        with self._lock:
+            return dict(self._counts)
+
+    def start(self) -> "MockDeepseekServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "MockDeepseekServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    """添加模拟服务的命令行参数（benchmark.py共用）"""
+    parser.add_argument('--ttft-ms', type=float, default=200, help='首个令牌延迟（毫秒）')
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='生成速度，0表示不限速')
+    parser.add_argument('--completion-tokens', type=int, default=400, help='每次回答的令牌数')
+    parser.add_argument('--chunk-tokens', type=int, default=1, help='每个SSE数据块的令牌数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='注入错误的请求比例')
+    parser.add_argument('--error-status', type=int, default=503, help='注入错误的状态码')
+    parser.add_argument('--retry-after', type=int, help='注入错误时返回的Retry-After（秒）')
+    parser.add_argument('--cache-hit-ratio', type=float, default=0.0, help='上下文缓存命中比例')
+    parser.add_argument('--seed', type=int, help='错误注入的随机种子')
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        ttft=args.ttft_ms / 1000.0,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        chunk_tokens=args.chunk_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        cache_hit_ratio=args.cache_hit_ratio,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的Deepseek API服务')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=8800, help='监听端口')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockDeepseekServer(config_from_args(args), args.host, args.port)
+    print(f"模拟Deepseek API已启动: {server.api_base}")
+    print(f"使用方法: DEEPSEEK_API_BASE={server.api_base} python webapp.py")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
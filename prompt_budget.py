@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+提示词令牌预算
+估算提示词各部分的令牌数，在超出输入预算时按优先级从低到高压缩或截断各部分，
+并根据输入大小和输出格式自适应地确定max_tokens。
+"""
+
+import os
+import re
+from typing import Dict, Any, List, Optional, Callable
+
+from app_logging import get_logger
+from deepseek_client import _env_int, _env_float
+
+logger = get_logger("prompt_budget")
+
+# 可选：设置DEEPSEEK_TOKENIZER_PATH指向tokenizer.json时使用真实分词器计数
+_tokenizer = None
+_tokenizer_loaded = False
+
+
+def _get_tokenizer():
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        _tokenizer_loaded = True
+        path = os.environ.get("DEEPSEEK_TOKENIZER_PATH")
+        if path:
+            try:
+                from tokenizers import Tokenizer
+                _tokenizer = Tokenizer.from_file(path)
+            except Exception as e:
+                logger.warning("无法加载分词器 %s: %s，改用估算", path, e)
+    return _tokenizer
+
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u9fff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的令牌数
+
+    配置了本地分词器时返回精确值；否则按Deepseek官方给出的经验比例估算：
+    中文字符约0.6个令牌，其他字符约0.3个令牌。
+    """
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text).ids)
+    cjk = len(_CJK_PATTERN.findall(text))
+    return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """按整行截断文本，使其不超过max_tokens，并附加截断说明"""
+    marker = "\n……（内容过长，已截断）"
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - estimate_tokens(marker)
+    kept = []
+    used = 0
+    for line in text.splitlines():
+        cost = estimate_tokens(line + "\n")
+        if used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept) + marker if kept else ""
+
+
+def summarize_markdown(text: str) -> str:
+    """压缩Markdown文档：保留所有标题以及每个标题下的第一行内容"""
+    lines = []
+    keep_next = True
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("#"):
+            lines.append(line)
+            keep_next = True
+        elif stripped and keep_next:
+            lines.append(line)
+            keep_next = False
+    return "\n".join(lines)
+
+
+def summarize_weather(text: str) -> str:
+    """压缩天气数据：只保留标题和"今日"段落"""
+    title = next((line for line in text.splitlines() if line.startswith("# ")), "")
+    match = re.search(r"^##[^\n]*今日[^\n]*\n.*?(?=^## |\Z)", text, re.S | re.M)
+    if not match:
+        return summarize_markdown(text)
+    return f"{title}\n\n{match.group(0).strip()}" if title else match.group(0).strip()
+
+
+class PromptSection:
+    """提示词中的一个部分"""
+
+    def __init__(self, name: str, text: str, priority: int, required: bool = False,
+                 summarizer: Optional[Callable[[str], str]] = None):
+        """
+        参数:
+            name: 部分名称（用于统计，如"wardrobe"）
+            text: 内容
+            priority: 优先级，超出预算时优先级低的部分先被压缩
+            required: 为True时永不压缩（如用户需求和输出格式要求）
+            summarizer: 压缩函数，截断前先尝试用它缩短内容
+        """
+        self.name = name
+        self.text = text
+        self.priority = priority
+        self.required = required
+        self.summarizer = summarizer
+        self.original_tokens = estimate_tokens(text)
+        self.tokens = self.original_tokens
+        self.action = None  # None / "summarized" / "truncated"
+
+    def summarize(self) -> None:
+        """用压缩函数缩短内容（没有压缩函数时不变）"""
+        if self.summarizer is None or self.action is not None:
+            return
+        text = self.summarizer(self.text)
+        if estimate_tokens(text) < self.tokens:
+            self.text = text
+            self.tokens = estimate_tokens(text)
+            self.action = "summarized"
+
+    def truncate_to(self, max_tokens: int) -> None:
+        """把内容截断到不超过max_tokens"""
+        if self.tokens <= max_tokens:
+            return
+        self.text = truncate_to_tokens(self.text, max_tokens)
+        self.tokens = estimate_tokens(self.text)
+        self.action = "truncated"
+
+
+def apply_budget(sections: List[PromptSection], budget: int, overhead_tokens: int = 0) -> Dict[str, Any]:
+    """
+    按预算压缩提示词各部分
+
+    参数:
+        sections: 提示词各部分（会被原地修改）
+        budget: 输入令牌总预算，不大于0时不限制
+        overhead_tokens: 各部分之外的固定文本（标题、连接文字等）的令牌数
+
+    返回:
+        统计报告，包含每部分压缩前后的令牌数、总数和预算
+    """
+    total = overhead_tokens + sum(section.tokens for section in sections)
+    candidates = sorted((s for s in sections if not s.required), key=lambda s: s.priority)
+
+    # 第一轮：按优先级从低到高压缩（保留文档结构）；第二轮：仍超出预算时再逐个截断
+    for shrink in ("summarize", "truncate"):
+        for section in candidates:
+            over = total - budget
+            if budget <= 0 or over <= 0:
+                break
+            before = section.tokens
+            if shrink == "summarize":
+                section.summarize()
+            else:
+                section.truncate_to(max(0, before - over))
+            total -= before - section.tokens
+
+    return {
+        "sections": {
+            section.name: {
+                "tokens": section.tokens,
+                "original_tokens": section.original_tokens,
+                "action": section.action,
+            }
+            for section in sections
+        },
+        "overhead_tokens": overhead_tokens,
+        "total_tokens": total,
+        "budget": budget,
+        "within_budget": budget <= 0 or total <= budget,
+    }
+
+
+def input_token_budget() -> int:
+    """输入令牌预算（环境变量PROMPT_TOKEN_BUDGET，默认16000，0表示不限制）"""
+    return _env_int("PROMPT_TOKEN_BUDGET", 16000)
+
+
+def adaptive_max_tokens(input_tokens: int, format_tokens: int) -> int:
+    """
+    根据输入大小和输出格式确定max_tokens
+
+    预期输出约为输出格式模板的OUTPUT_EXPANSION_RATIO倍（默认2.5），限制在
+    [MIN_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS]之间，并且不超过模型上下文窗口
+    MODEL_CONTEXT_WINDOW中剩余的空间。
+
+    参数:
+        input_tokens: 提示词的令牌数
+        format_tokens: 输出格式说明的令牌数
+
+    返回:
+        本次请求使用的max_tokens
+    """
+    ratio = _env_float("OUTPUT_EXPANSION_RATIO", 2.5)
+    floor = _env_int("MIN_OUTPUT_TOKENS", 1000)
+    cap = _env_int("MAX_OUTPUT_TOKENS", 4000)
+    context_window = _env_int("MODEL_CONTEXT_WINDOW", 65536)
+
+    expected = min(cap, max(floor, int(format_tokens * ratio)))
+    available = context_window - input_tokens - 256  # 预留少量余量
+    return max(1, min(expected, available))
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """把统计报告格式化为一行日志"""
+    parts = []
+    for name, info in report["sections"].items():
+        entry = f"{name}={info['tokens']}"
+        if info["action"]:
+            entry += f"(原{info['original_tokens']}, {'已压缩' if info['action'] == 'summarized' else '已截断'})"
+        parts.append(entry)
+    budget = report["budget"] if report["budget"] > 0 else "不限"
+    line = f"提示词令牌: 总计{report['total_tokens']}/预算{budget} | " + ", ".join(parts)
+    if "max_tokens" in report:
+        line += f" | max_tokens={report['max_tokens']}"
+    return line
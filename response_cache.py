@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+穿搭建议响应缓存
+以(模型, 提示词, 温度, 最大令牌数, top_p)的哈希为键缓存已完成的回答，
+包含内存LRU层和可选的磁盘层，命中时可以通过与实时回答相同的流式接口回放。
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Generator, Tuple, Callable, AsyncIterator
+
+from deepseek_client import DeepseekClient, AsyncDeepseekClient, get_client, _env_int, _env_float
+from circuit_breaker import guard_client, guard_async_client
+from app_logging import get_logger
+
+logger = get_logger("response_cache")
+
+
+def make_cache_key(model: str, prompt: str, temperature: float, max_tokens: int,
+                   top_p: Optional[float] = None, system_prompt: Optional[str] = None) -> str:
+    """
+    计算缓存键
+
+    参数:
+        model: 模型名称
+        prompt: 提示词（用户消息）
+        temperature: 温度参数
+        max_tokens: 最大生成的令牌数
+        top_p: 核采样参数（非流式请求为None）
+        system_prompt: 系统消息（没有系统消息时为None，此时与旧版本的缓存键相同）
+
+    返回:
+        SHA-256十六进制摘要
+    """
+    fields = [model, prompt, temperature, max_tokens, top_p]
+    if system_prompt is not None:
+        fields.append(system_prompt)
+    material = json.dumps(fields, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """两级响应缓存：内存LRU + 可选的磁盘目录"""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 86400.0, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 100 * 1024 * 1024):
+        """
+        参数:
+            max_entries: 内存层最多保留的条目数，超出后淘汰最久未使用的条目
+            ttl: 条目有效期（秒），0表示永不过期
+            disk_dir: 磁盘层目录，为None时不启用磁盘层
+            disk_max_bytes: 磁盘层总大小上限（字节），超出后按修改时间淘汰最旧的文件
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "expirations": 0,
+        }
+        self._disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._scan_disk())
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _scan_disk(self):
+        """列出磁盘层的所有缓存文件 (路径, 大小, 修改时间)"""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        查询缓存
+
+        返回:
+            缓存的回答文本，未命中或已过期时返回None
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, text = entry
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return text
+                del self._memory[key]
+                self._stats["expirations"] += 1
+
+        if self.disk_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                created, text = entry
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                    self._put_memory(key, created, text)
+                return text
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def contains(self, key: str) -> bool:
+        """
+        是否有未过期的缓存（不计入命中统计，用于提前判断是否需要调用API）
+
+        磁盘层只检查文件的修改时间（即写入时间），不读取和解析文件内容。
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                return True
+        if not self.disk_dir:
+            return False
+        try:
+            written = os.stat(self._disk_path(key)).st_mtime
+        except OSError:
+            return False
+        return not self._expired(written)
+
+    def set(self, key: str, text: str) -> None:
+        """写入缓存（内存层，以及启用时的磁盘层）"""
+        created = time.time()
+        with self._lock:
+            self._put_memory(key, created, text)
+            self._stats["stores"] += 1
+        if self.disk_dir:
+            self._write_disk(key, created, text)
+
+    def _put_memory(self, key: str, created: float, text: str) -> None:
+        # 调用方需持有self._lock
+        self._memory[key] = (created, text)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["memory_evictions"] += 1
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, str]]:
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        created = data.get("created", 0)
+        if self._expired(created):
+            self._remove_disk(path)
+            with self._lock:
+                self._stats["expirations"] += 1
+            return None
+        return created, data.get("text", "")
+
+    def _write_disk(self, key: str, created: float, text: str) -> None:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"created": created, "text": text}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp_path)
+            try:
+                replaced = os.path.getsize(path)  # 覆盖已有的文件时，总大小只增加两者之差
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)  # 原子替换，避免并发读到半个文件
+        except OSError as e:
+            logger.warning("写入响应缓存文件出错: %s", e)
+            return
+
+        with self._lock:
+            self._disk_bytes += size - replaced
+            over_limit = self._disk_bytes > self.disk_max_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def _remove_disk(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes -= size
+
+    def _evict_disk(self) -> None:
+        """按修改时间从旧到新删除文件，直到磁盘层回到大小上限以内"""
+        entries = sorted(self._scan_disk(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self._stats["disk_evictions"] += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    def clear(self) -> None:
+        """清空内存层和磁盘层"""
+        with self._lock:
+            self._memory.clear()
+        if self.disk_dir:
+            for path, _, _ in self._scan_disk():
+                self._remove_disk(path)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中、未命中、淘汰等统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes if self.disk_dir else 0
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+def replay_chunks(text: str, chunk_size: int = 32) -> Generator[str, None, None]:
+    """把缓存的完整回答按固定长度切分，模拟流式输出"""
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
+
+
+class CachedDeepseekClient:
+    """
+    带响应缓存的Deepseek客户端
+
+    包装一个DeepseekClient，接口保持不变；未被包装的属性和方法直接转发给内部客户端。
+    """
+
+    def __init__(self, client: DeepseekClient, cache: ResponseCache, replay_chunk_size: int = 32):
+        """
+        参数:
+            client: 实际发送请求的客户端
+            cache: 响应缓存
+            replay_chunk_size: 流式回放缓存内容时每段的字符数
+        """
+        self.client = client
+        self.cache = cache
+        self.replay_chunk_size = replay_chunk_size
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def generate_completion(self, prompt: str, model: str = "deepseek-reasoner", max_tokens: int = 2000,
+                            temperature: float = 0.7, system_prompt: Optional[str] = None) -> Dict[Any, Any]:
+        """生成文本完成，命中缓存时直接返回缓存的回答"""
+        key = make_cache_key(model, prompt, temperature, max_tokens, system_prompt=system_prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info("响应缓存命中")
+            return {"choices": [{"message": {"role": "assistant", "content": cached}}], "cached": True}
+
+        response = self.client.generate_completion(prompt=prompt, model=model, max_tokens=max_tokens,
+                                                   temperature=temperature, system_prompt=system_prompt)
+        if "error" not in response:
+            try:
+                text = response["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                text = None
+            if text:
+                self.cache.set(key, text)
+        return response
+
+    def chat_stream(self, prompt: str, model: str = "deepseek-chat", max_tokens: int = 2000,
+                    temperature: float = 0.7, top_p: float = 0.9, system_prompt: Optional[str] = None,
+                    on_usage: Optional[Callable[[Dict[str, int]], None]] = None) -> Generator[str, None, None]:
+        """
+        生成流式文本完成，命中缓存时通过同一个流式接口回放缓存的回答
+
+        命中缓存时没有调用API，因此不会调用on_usage。
+        """
+        key = make_cache_key(model, prompt, temperature, max_tokens, top_p, system_prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info("响应缓存命中，回放缓存内容")
+            yield from replay_chunks(cached, self.replay_chunk_size)
+            return
+
+        parts = []
+        failed = False
+        for chunk in self.client.chat_stream(prompt=prompt, model=model, max_tokens=max_tokens,
+                                             temperature=temperature, top_p=top_p,
+                                             system_prompt=system_prompt, on_usage=on_usage):
+            if chunk.startswith("\n[API错误:"):
+                failed = True
+            parts.append(chunk)
+            yield chunk
+
+        # 只缓存完整且没有出错的回答（中途断开时不会执行到这里）
+        text = "".join(parts)
+        if not failed and text.strip():
+            self.cache.set(key, text)
+
+
+class AsyncCachedDeepseekClient:
+    """CachedDeepseekClient的异步版本，包装AsyncDeepseekClient，与同步客户端共用同一个缓存"""
+
+    def __init__(self, client: AsyncDeepseekClient, cache: ResponseCache, replay_chunk_size: int = 32):
+        self.client = client
+        self.cache = cache
+        self.replay_chunk_size = replay_chunk_size
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def generate_completion(self, prompt: str, model: str = "deepseek-reasoner", max_tokens: int = 2000,
+                                  temperature: float = 0.7, system_prompt: Optional[str] = None) -> Dict[Any, Any]:
+        """生成文本完成，命中缓存时直接返回缓存的回答"""
+        key = make_cache_key(model, prompt, temperature, max_tokens, system_prompt=system_prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info("响应缓存命中")
+            return {"choices": [{"message": {"role": "assistant", "content": cached}}], "cached": True}
+
+        response = await self.client.generate_completion(prompt=prompt, model=model, max_tokens=max_tokens,
+                                                         temperature=temperature, system_prompt=system_prompt)
+        if "error" not in response:
+            try:
+                text = response["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                text = None
+            if text:
+                self.cache.set(key, text)
+        return response
+
+    async def chat_stream(self, prompt: str, model: str = "deepseek-chat", max_tokens: int = 2000,
+                          temperature: float = 0.7, top_p: float = 0.9, system_prompt: Optional[str] = None,
+                          on_usage: Optional[Callable[[Dict[str, int]], None]] = None) -> AsyncIterator[str]:
+        """生成流式文本完成，命中缓存时回放缓存的回答（不调用on_usage）"""
+        key = make_cache_key(model, prompt, temperature, max_tokens, top_p, system_prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info("响应缓存命中，回放缓存内容")
+            for chunk in replay_chunks(cached, self.replay_chunk_size):
+                yield chunk
+            return
+
+        parts = []
+        failed = False
+        chunks = self.client.chat_stream(prompt=prompt, model=model, max_tokens=max_tokens,
+                                         temperature=temperature, top_p=top_p,
+                                         system_prompt=system_prompt, on_usage=on_usage)
+        try:
+            async for chunk in chunks:
+                if chunk.startswith("\n[API错误:"):
+                    failed = True
+                parts.append(chunk)
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+        text = "".join(parts)
+        if not failed and text.strip():
+            self.cache.set(key, text)
+
+
+# 进程级默认缓存，按环境变量配置
+_default_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    获取进程级默认响应缓存
+
+    返回:
+        ResponseCache实例；环境变量RESPONSE_CACHE_ENABLED为false时返回None，
+        RESPONSE_CACHE_*格式错误时使用默认值
+    """
+    global _default_cache
+    if os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() not in ['true', '1', 'yes']:
+        return None
+    if _default_cache is None:
+        with _cache_lock:
+            if _default_cache is None:
+                _default_cache = ResponseCache(
+                    max_entries=_env_int("RESPONSE_CACHE_SIZE", 256),
+                    ttl=_env_float("RESPONSE_CACHE_TTL", 86400),
+                    disk_dir=os.environ.get("RESPONSE_CACHE_DIR") or None,
+                    disk_max_bytes=int(_env_float("RESPONSE_CACHE_MAX_MB", 100) * 1024 * 1024),
+                )
+    return _default_cache
+
+
+def get_cached_client(api_key: Optional[str] = None):
+    """
+    获取带响应缓存和熔断器的长期复用客户端
+
+    缓存在熔断器之外，熔断器打开时已缓存的回答仍然可以返回。
+
+    返回:
+        启用缓存时为CachedDeepseekClient，否则为（带熔断器的）DeepseekClient
+    """
+    client = guard_client(get_client(api_key=api_key))
+    cache = get_response_cache()
+    if cache is None:
+        return client
+    return CachedDeepseekClient(client, cache)
+
+
+def wrap_async_client(client: AsyncDeepseekClient):
+    """
+    为异步客户端加上与get_cached_client相同的熔断器和响应缓存（用于ASGI模式）
+
+    返回:
+        启用缓存时为AsyncCachedDeepseekClient，否则为（带熔断器的）AsyncDeepseekClient
+    """
+    client = guard_async_client(client)
+    cache = get_response_cache()
+    if cache is None:
+        return client
+    return AsyncCachedDeepseekClient(client, cache)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+访问者会话状态
+每个访问者选定的用户保存在签名Cookie中，服务端不保存会话数据，切换用户也不需要写入存储。
+Cookie值为"<用户ID>.<签名>"：页面脚本可以直接读出用户ID，服务端使用前校验签名，防止被伪造。
+"""
+
+import os
+import hmac
+import base64
+import hashlib
+import secrets
+import threading
+from urllib.parse import quote, unquote
+from typing import Optional
+
+from app_logging import get_logger
+
+logger = get_logger("session_state")
+
+# 保存选定用户的Cookie名称
+SELECTION_COOKIE = "stylist_user"
+
+_generated_secret: Optional[bytes] = None
+_secret_lock = threading.Lock()
+
+
+def _secret() -> bytes:
+    """签名密钥：SESSION_SECRET，未设置时为进程内随机生成（重启或多进程部署后旧Cookie失效）"""
+    global _generated_secret
+    configured = os.environ.get("SESSION_SECRET", "").strip()
+    if configured:
+        return configured.encode('utf-8')
+    if _generated_secret is None:
+        with _secret_lock:
+            if _generated_secret is None:
+                logger.warning("未设置SESSION_SECRET，使用临时密钥签名会话Cookie（多进程部署时应设置）")
+                _generated_secret = secrets.token_bytes(32)
+    return _generated_secret
+
+
+def _signature(value: str) -> str:
+    digest = hmac.new(_secret(), value.encode('utf-8'), hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode('ascii')
+
+
+def sign_selection(user_id: str) -> str:
+    """
+    生成选定用户的Cookie值
+
+    参数:
+        user_id: 用户ID
+
+    返回:
+        "<URL编码的用户ID>.<签名>"
+    """
+    value = quote(user_id, safe='')
+    return f"{value}.{_signature(value)}"
+
+
+def read_selection(cookie: Optional[str]) -> Optional[str]:
+    """
+    校验并读取Cookie中的用户ID
+
+    返回:
+        用户ID；Cookie不存在、格式错误或签名不匹配时返回None
+    """
+    if not cookie or "." not in cookie:
+        return None
+    value, signature = cookie.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _signature(value)):
+        return None
+    return unquote(value)
+
+
+def selection_max_age() -> int:
+    """选定用户Cookie的有效期（秒），默认30天"""
+    try:
+        return int(os.environ.get("SESSION_COOKIE_MAX_AGE", 30 * 86400))
+    except ValueError:
+        return 30 * 86400
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+相同请求合并（single-flight）
+多个客户端同时请求完全相同的提示词时，只向上游发起一次流式请求，
+由后台线程读取上游数据并分发给所有订阅者；中途加入的订阅者先收到已缓冲的内容，再接收实时增量。
+读取过慢、落后超过缓冲区上限的订阅者会被移出合并流，以免单个慢客户端让缓冲区无限增长。
+"""
+
+import os
+import threading
+import contextvars
+from typing import Dict, Any, Optional, Callable, Iterator, Generator
+
+from app_logging import get_logger
+
+logger = get_logger("single_flight")
+
+
+class SubscriberLagError(RuntimeError):
+    """订阅者落后上游过多，已被移出合并流"""
+
+
+class InFlightStream:
+    """一个正在进行的上游流及其订阅者"""
+
+    def __init__(self, key: str, max_buffer_chars: int):
+        """
+        参数:
+            key: 请求的缓存键（见response_cache.make_cache_key）
+            max_buffer_chars: 缓冲区字符数上限，也是每个订阅者允许落后的最大字符数；
+                              超出后移出落后过多的订阅者并丢弃其余订阅者都已读过的内容，
+                              此后新的相同请求不再加入本流，而是发起新的上游请求
+        """
+        self.key = key
+        self.max_buffer_chars = max_buffer_chars
+        self._chunks = []
+        self._starts = []       # 各片段第一个字符在整个流中的偏移
+        self._base = 0          # self._chunks[0]在整个流中的序号
+        self._buffer_chars = 0
+        self._total_chars = 0
+        self._positions: Dict[int, int] = {}  # 订阅者ID -> 下一个要读取的片段序号
+        self._lagged = set()    # 因落后过多被移出的订阅者
+        self._next_subscriber = 0
+        self.on_cancel: Optional[Callable[[], None]] = None  # 最后一个订阅者离开时调用
+        self._cond = threading.Condition()
+        self.joinable = True
+        self.finished = False
+        self.cancelled = False
+        self.error: Optional[Exception] = None
+        self.usage: Dict[str, int] = {}
+
+    def add_subscriber(self) -> Optional[int]:
+        """登记一个订阅者，流已不可加入时返回None"""
+        with self._cond:
+            if not self.joinable or self.finished or self.cancelled:
+                return None
+            subscriber = self._next_subscriber
+            self._next_subscriber += 1
+            self._positions[subscriber] = self._base
+            return subscriber
+
+    def remove_subscriber(self, subscriber: int) -> None:
+        """注销订阅者；最后一个订阅者离开且上游尚未结束时标记为取消"""
+        with self._cond:
+            self._positions.pop(subscriber, None)
+            self._lagged.discard(subscriber)
+            cancelled = self._cancel_if_abandoned()
+            self._cond.notify_all()
+        if cancelled and self.on_cancel is not None:
+            self.on_cancel()
+
+    def _cancel_if_abandoned(self) -> bool:
+        # 调用方需持有self._cond；没有订阅者且上游尚未结束时标记为取消，返回是否为本次取消
+        if self._positions or self.finished or self.cancelled:
+            return False
+        self.cancelled = True
+        self.joinable = False
+        return True
+
+    def append(self, chunk: str) -> bool:
+        """
+        追加一个上游片段
+
+        返回:
+            是否仍有订阅者（为False时生产方应停止读取上游）
+        """
+        cancelled = False
+        with self._cond:
+            if self.cancelled:
+                return False
+            self._chunks.append(chunk)
+            self._starts.append(self._total_chars)
+            self._buffer_chars += len(chunk)
+            self._total_chars += len(chunk)
+            if self._buffer_chars > self.max_buffer_chars:
+                cancelled = self._drop_laggards()
+                self._trim()
+            self._cond.notify_all()
+        if cancelled and self.on_cancel is not None:
+            self.on_cancel()
+        return not cancelled
+
+    def _lag(self, position: int) -> int:
+        # 从片段序号position开始尚未读取的字符数
+        index = position - self._base
+        if index >= len(self._chunks):
+            return 0
+        return self._total_chars - self._starts[index]
+
+    def _drop_laggards(self) -> bool:
+        # 调用方需持有self._cond；移出落后超过上限的订阅者，它们下次读取时收到SubscriberLagError；
+        # 返回是否因此没有订阅者了
+        for subscriber, position in list(self._positions.items()):
+            if self._lag(position) > self.max_buffer_chars:
+                del self._positions[subscriber]
+                self._lagged.add(subscriber)
+                logger.warning("订阅者落后超过%d字符，移出合并流 %s", self.max_buffer_chars, self.key[:12])
+        return self._cancel_if_abandoned()
+
+    def _trim(self) -> None:
+        # 调用方需持有self._cond；丢弃所有剩余订阅者都已读过的片段
+        self.joinable = False
+        keep_from = min(self._positions.values(), default=self._base + len(self._chunks))
+        drop = keep_from - self._base
+        if drop > 0:
+            self._buffer_chars -= sum(len(chunk) for chunk in self._chunks[:drop])
+            del self._chunks[:drop]
+            del self._starts[:drop]
+            self._base = keep_from
+
+    def finish(self, usage: Optional[Dict[str, int]] = None, error: Optional[Exception] = None) -> None:
+        """标记上游已结束；error不为None时订阅者读完已缓冲的内容后会收到该异常"""
+        with self._cond:
+            self.finished = True
+            self.joinable = False
+            self.error = error
+            if usage:
+                self.usage.update(usage)
+            self._cond.notify_all()
+
+    def read(self, subscriber: int) -> Generator[str, None, None]:
+        """
+        按顺序产生该订阅者尚未读取的片段，直到上游结束；上游出错时重新抛出同一个异常，
+        订阅者因落后过多被移出时抛出SubscriberLagError
+        """
+        while True:
+            with self._cond:
+                while (subscriber not in self._lagged and not self.finished
+                       and self._positions[subscriber] >= self._base + len(self._chunks)):
+                    self._cond.wait()
+                if subscriber in self._lagged:
+                    raise SubscriberLagError(f"读取过慢，落后超过{self.max_buffer_chars}字符")
+                position = self._positions[subscriber]
+                pending = self._chunks[position - self._base:]
+                self._positions[subscriber] = position + len(pending)
+                done = self.finished and not pending
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield from pending
+
+
+class StreamCoalescer:
+    """合并相同的进行中流式请求"""
+
+    def __init__(self, max_buffer_chars: int = 200000):
+        """
+        参数:
+            max_buffer_chars: 每个合并流的缓冲区字符数上限
+        """
+        self.max_buffer_chars = max_buffer_chars
+        self._flights: Dict[str, InFlightStream] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "upstream_streams": 0,
+            "coalesced_subscribers": 0,
+            "cancelled_streams": 0,
+            "lagging_subscribers": 0,
+        }
+
+    def stream(self, key: str, factory: Callable[[Callable[[Dict[str, int]], None]], Iterator[str]],
+               on_usage: Optional[Callable[[Dict[str, int]], None]] = None, ticket=None,
+               admit: Optional[Callable[[], Any]] = None) -> Generator[str, None, None]:
+        """
+        订阅键为key的流，没有进行中的相同请求时通过factory发起上游请求
+
+        参数:
+            key: 请求的缓存键，相同的键表示完全相同的请求
+            factory: 接收一个usage回调并返回上游片段迭代器的函数，如
+                     lambda on_usage: client.chat_stream(prompt, on_usage=on_usage)
+            on_usage: 上游结束后收到usage统计时调用
+            ticket: 调用方已获得的上游并发名额（见admission.AdmissionTicket）；发起上游请求时转交给后台线程，
+                    上游结束后才归还，加入进行中的流时立即归还；已被归还时由admit重新申请
+            admit: 需要发起上游请求但没有ticket时，后台线程调用它获取名额（返回带release()的对象或None）
+
+        返回:
+            一个生成器，产生与直接读取上游相同的片段序列
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            subscriber = flight.add_subscriber() if flight is not None else None
+            if subscriber is not None:
+                self._stats["coalesced_subscribers"] += 1
+                if ticket is not None:
+                    ticket.release()  # 不会发起新的上游请求
+            else:
+                flight = InFlightStream(key, self.max_buffer_chars)
+                flight.on_cancel = lambda: self._cancelled(flight)
+                subscriber = flight.add_subscriber()
+                self._flights[key] = flight
+                self._stats["upstream_streams"] += 1
+                # 后台线程沿用发起请求者的上下文，上游阶段记入其请求链路
+                context = contextvars.copy_context()
+                owned = ticket.transfer() if ticket is not None else None
+                threading.Thread(target=context.run, args=(self._produce, flight, factory, owned, admit),
+                                 daemon=True).start()
+
+        try:
+            yield from flight.read(subscriber)
+        except SubscriberLagError:
+            with self._lock:
+                self._stats["lagging_subscribers"] += 1
+            raise
+        finally:
+            flight.remove_subscriber(subscriber)
+        if on_usage is not None and flight.usage:
+            on_usage(dict(flight.usage))
+
+    def is_joinable(self, key: str) -> bool:
+        """是否有可以加入的相同进行中请求（只是当前的状态，调用stream()时该流可能已不可加入）"""
+        with self._lock:
+            flight = self._flights.get(key)
+            return flight is not None and flight.joinable and not flight.finished and not flight.cancelled
+
+    def _cancelled(self, flight: InFlightStream) -> None:
+        """最后一个订阅者离开：立即注销该流，后台线程在下一个片段到达时关闭上游连接"""
+        logger.info("所有订阅者已断开，取消上游请求 %s", flight.key[:12])
+        with self._lock:
+            self._stats["cancelled_streams"] += 1
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def _produce(self, flight: InFlightStream, factory, ticket=None, admit=None) -> None:
+        """后台线程：读取上游并分发；没有订阅者时关闭上游连接，上游结束后归还并发名额"""
+        usage = {}
+        upstream = None
+        error = None
+        try:
+            if flight.cancelled:
+                return  # 后台线程启动前订阅者就已离开，不再发起上游请求
+            if ticket is None and admit is not None:
+                ticket = admit()  # 拒绝时抛出的异常转交给所有订阅者
+            upstream = factory(usage.update)
+            for chunk in upstream:
+                if not flight.append(chunk):
+                    break
+        except Exception as e:
+            logger.warning("合并请求的上游流出错: %s", e)
+            error = e
+        finally:
+            if upstream is not None and hasattr(upstream, "close"):
+                upstream.close()  # 中途停止时释放上游连接
+            if ticket is not None:
+                ticket.release()
+            flight.finish(usage, error)
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回上游请求数、合并的订阅者数、被移出的慢订阅者数和正在进行的流数"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._flights)
+        return stats
+
+
+# 进程级默认合并器，按环境变量配置
+_default_coalescer: Optional[StreamCoalescer] = None
+_coalescer_lock = threading.Lock()
+
+
+def get_stream_coalescer() -> Optional[StreamCoalescer]:
+    """
+    获取进程级默认合并器
+
+    返回:
+        StreamCoalescer实例；环境变量REQUEST_COALESCING_ENABLED为false时返回None
+    """
+    global _default_coalescer
+    if os.environ.get("REQUEST_COALESCING_ENABLED", "true").lower() not in ['true', '1', 'yes']:
+        return None
+    if _default_coalescer is None:
+        with _coalescer_lock:
+            if _default_coalescer is None:
+                try:
+                    max_chars = int(os.environ.get("COALESCE_MAX_BUFFER_CHARS", 200000))
+                except ValueError:
+                    max_chars = 200000
+                _default_coalescer = StreamCoalescer(max_buffer_chars=max_chars)
+    return _default_coalescer
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+增量SSE解析器
+直接处理网络上收到的原始字节块，按text/event-stream规范解析事件：支持\\n、\\r\\n和\\r三种换行、
+多行data、注释行、event/id/retry字段，以及跨数据块被截断的行和多字节字符。
+只在一个事件完整到达时才复制并解码其data（通过memoryview直接解码，不为每一行创建bytes/str）。
+
+另外提供从Chat Completions流式数据块中快速提取choices[0].delta.content的方法，
+常见的纯文本增量不必构建完整的JSON对象。
+"""
+
+import json
+from typing import List, Optional
+
+# 事件未指定event字段时的类型
+DEFAULT_EVENT = "message"
+
+
+class SSEEvent:
+    """一个完整的SSE事件"""
+
+    __slots__ = ("event", "data", "id", "retry")
+
+    def __init__(self, event: str, data: str, id: Optional[str] = None, retry: Optional[int] = None):
+        self.event = event
+        self.data = data
+        self.id = id
+        self.retry = retry
+
+    def __repr__(self) -> str:
+        return f"SSEEvent(event={self.event!r}, data={self.data!r}, id={self.id!r})"
+
+
+class SSEParser:
+    """
+    增量SSE解析器
+
+    使用示例:
+        parser = SSEParser()
+        for chunk in response.iter_content(chunk_size=None):
+            for event in parser.feed(chunk):
+                ...
+        for event in parser.close():
+            ...
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0            # 下一行在缓冲区中的起始位置
+        self._event_start = 0    # 当前事件第一行的起始位置（此前的数据都已处理，可以丢弃）
+        self._data_spans = []    # 当前事件各data行的值在缓冲区中的(起点, 终点)
+        self._event_type = None
+        self._retry = None
+        self._seen_cr = False    # 出现过\r后不再使用只认\n的快速路径
+        self.last_event_id: Optional[str] = None
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """
+        追加一个数据块
+
+        返回:
+            因此变得完整的事件（可能为空）
+        """
+        buf = self._buf
+        buf += chunk
+        if not self._seen_cr and b"\r" in chunk:
+            self._seen_cr = True
+        events = []
+        pos = self._pos
+        size = len(buf)
+        view = memoryview(buf)
+        try:
+            while pos < size:
+                end = buf.find(b"\n", pos)
+                if (not self._seen_cr and end >= 0 and end + 1 < size and buf[end + 1] == 0x0A
+                        and buf.startswith(b"data: ", pos, end) and not self._data_spans
+                        and self._event_type is None and self._retry is None):
+                    # 最常见的事件只有一行"data: ..."，整个事件一次处理，不逐行记录位置
+                    events.append(SSEEvent(DEFAULT_EVENT, str(view[pos + 6:end], "utf-8", "replace"),
+                                           self.last_event_id))
+                    pos = self._event_start = end + 2
+                    continue
+                # 只在本行范围内查找\r；以\r结尾的块要等下一块才能确定是否为\r\n
+                cr = buf.find(b"\r", pos, size if end < 0 else end) if self._seen_cr else -1
+                if cr >= 0:
+                    if cr + 1 == size:
+                        break
+                    end, next_pos = cr, cr + (2 if buf[cr + 1] == 0x0A else 1)
+                elif end >= 0:
+                    next_pos = end + 1
+                else:
+                    break
+                event = self._process_line(pos, end)
+                if event is not None:
+                    events.append(event)
+                pos = next_pos
+                if not self._data_spans:
+                    self._event_start = pos
+        finally:
+            view.release()
+        self._pos = pos
+        self._compact()
+        return events
+
+    def close(self) -> List[SSEEvent]:
+        """
+        数据流结束：处理最后一行没有换行符的数据，并分发尚未以空行结束的事件
+
+        规范要求丢弃不完整的事件；这里为兼容不以空行结尾的服务端而保留。
+        """
+        events = []
+        if self._pos < len(self._buf):
+            end = len(self._buf)
+            if self._buf[end - 1] == 0x0D:
+                end -= 1
+            event = self._process_line(self._pos, end)
+            if event is not None:
+                events.append(event)
+            self._pos = len(self._buf)
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        self._buf.clear()
+        self._pos = self._event_start = 0
+        return events
+
+    def _process_line(self, start: int, end: int) -> Optional[SSEEvent]:
+        buf = self._buf
+        if start == end:
+            return self._dispatch()
+        if buf[start] == 0x3A:  # ":"开头为注释（如保活消息）
+            return None
+
+        # 常见字段先按前缀判断，避免为字段名创建bytes
+        if buf.startswith(b"data:", start, end):
+            value = start + 5
+        elif buf.startswith(b"event:", start, end):
+            value = start + 6
+        elif buf.startswith(b"id:", start, end):
+            value = start + 3
+        elif buf.startswith(b"retry:", start, end):
+            value = start + 6
+        else:
+            colon = buf.find(b":", start, end)
+            name = bytes(buf[start:end if colon < 0 else colon])
+            if name == b"data":
+                self._data_spans.append((end, end))  # 没有冒号的data行表示空值
+            return None  # 其他字段按规范忽略
+
+        field = buf[start]
+        if value < end and buf[value] == 0x20:  # 去掉冒号后的一个空格
+            value += 1
+        if field == 0x64:  # data
+            self._data_spans.append((value, end))
+        elif field == 0x65:  # event
+            self._event_type = self._decode(value, end)
+        elif field == 0x69:  # id
+            ident = self._decode(value, end)
+            if "\0" not in ident:
+                self.last_event_id = ident
+        elif field == 0x72:  # retry
+            digits = bytes(buf[value:end])
+            if digits.isdigit():
+                self._retry = int(digits)
+        return None
+
+    def _decode(self, start: int, end: int) -> str:
+        view = memoryview(self._buf)
+        try:
+            return str(view[start:end], "utf-8", "replace")
+        finally:
+            view.release()
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        spans = self._data_spans
+        event_type = self._event_type or DEFAULT_EVENT
+        retry = self._retry
+        self._data_spans = []
+        self._event_type = None
+        self._retry = None
+        if not spans:
+            return None
+        if len(spans) == 1:
+            data = self._decode(*spans[0])
+        else:
+            view = memoryview(self._buf)
+            try:
+                data = str(b"\n".join(view[start:end] for start, end in spans), "utf-8", "replace")
+            finally:
+                view.release()
+        return SSEEvent(event_type, data, self.last_event_id, retry)
+
+    def _compact(self) -> None:
+        # 丢弃已处理的数据；未完成的事件从其第一行开始保留，data位置相应平移
+        shift = self._event_start
+        if shift == 0:
+            return
+        del self._buf[:shift]
+        self._pos -= shift
+        self._event_start = 0
+        self._data_spans = [(start - shift, end - shift) for start, end in self._data_spans]
+
+
+# Chat Completions数据块中增量文本的位置（紧凑格式和json.dumps默认格式）
+_CONTENT_MARKERS = ('"delta":{"content":"', '"delta": {"content": "')
+
+
+def fast_delta_content(data: str) -> Optional[str]:
+    """
+    不解析完整JSON，直接取出choices[0].delta.content
+
+    参数:
+        data: 一个流式数据块的JSON文本
+
+    返回:
+        增量文本；数据块不是只含文本增量的常见形式（如带usage、role或非字符串content）时返回None，
+        调用方应改用json.loads
+    """
+    for marker in _CONTENT_MARKERS:
+        start = data.find(marker)
+        if start >= 0:
+            break
+    else:
+        return None
+    if '"usage":' in data and '"usage":null' not in data and '"usage": null' not in data:
+        return None
+
+    start += len(marker)
+    end = data.find('"', start)
+    while end >= 0:
+        # 前面有奇数个反斜杠时这个引号是被转义的
+        backslashes = 0
+        while data[end - 1 - backslashes] == "\\":
+            backslashes += 1
+        if backslashes % 2 == 0:
+            break
+        end = data.find('"', end + 1)
+    if end < 0:
+        return None
+    content = data[start:end]
+    if "\\" in content:
+        try:
+            content = json.loads(f'"{content}"')
+        except ValueError:
+            return None
+    return content
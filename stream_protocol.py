@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+穿搭建议流式传输协议
+把推荐过程中的事件（status/delta/usage/timing/error/done）编码为带事件ID的
+text/event-stream（SSE）或换行分隔的JSON（NDJSON），并保留每个流的事件记录。
+事件由后台生产方生成，不随连接断开而停止，客户端断线后可以携带Last-Event-ID从断点继续接收。
+"""
+
+import json
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Iterable, Generator, Tuple, List, AsyncIterable, AsyncIterator
+
+# 事件类型
+EVENT_STATUS = "status"   # 进度提示，不属于穿搭建议正文
+EVENT_DELTA = "delta"     # 正文增量文本
+EVENT_USAGE = "usage"     # 用量统计
+EVENT_ERROR = "error"     # 错误信息
+EVENT_TIMING = "timing"   # 各阶段耗时汇总（见tracing.RequestTrace.summary）
+EVENT_DONE = "done"       # 流结束
+
+
+def format_sse(event_id: str, event: str, data: Dict[str, Any]) -> str:
+    """编码为一个SSE事件"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n"
+
+
+def format_ndjson(event_id: str, event: str, data: Dict[str, Any]) -> str:
+    """编码为一行NDJSON"""
+    return json.dumps({"id": event_id, "event": event, "data": data}, ensure_ascii=False) + "\n"
+
+
+# 格式名称 -> (Content-Type, 编码函数)
+STREAM_FORMATS = {
+    "sse": ("text/event-stream; charset=utf-8", format_sse),
+    "ndjson": ("application/x-ndjson; charset=utf-8", format_ndjson),
+}
+
+# 心跳帧：长时间没有事件（如等待首个令牌）时发送，客户端忽略（SSE注释行、NDJSON空行）；
+# 让代理不因空闲关闭连接，写入失败时也能及早发现客户端已断开
+HEARTBEAT_FRAMES = {
+    "sse": ": ping\n\n",
+    "ndjson": "\n",
+}
+
+
+def negotiate_format(accept: Optional[str], requested: Optional[str] = None) -> str:
+    """
+    选择输出格式
+
+    参数:
+        accept: 请求的Accept头
+        requested: 显式指定的格式（如查询参数format=ndjson），优先于Accept头
+
+    返回:
+        "sse"或"ndjson"，默认为"sse"
+    """
+    if requested in STREAM_FORMATS:
+        return requested
+    if accept and ("application/x-ndjson" in accept or "application/jsonl" in accept):
+        return "ndjson"
+    return "sse"
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[Tuple[str, int]]:
+    """
+    解析Last-Event-ID（格式为"<stream_id>:<序号>"）
+
+    返回:
+        (流ID, 序号)，格式不正确时返回None
+    """
+    if not value or ":" not in value:
+        return None
+    stream_id, _, seq = value.strip().rpartition(":")
+    try:
+        return stream_id, int(seq)
+    except ValueError:
+        return None
+
+
+class StreamSession:
+    """
+    单个流的事件记录
+    事件由后台的生产方写入，当前响应和断线重连的请求都是读取方；最后一个读取方离开后，
+    生产方继续运行resume_grace秒等待重连，期间没有读取方回来才停止（关闭上游请求）。
+    读取方只在流结束后才结束，等待再久（如上游重试、等待首个令牌）也不会提前中断。
+    """
+
+    def __init__(self, stream_id: str, max_events: int = 5000, resume_grace: float = 10.0):
+        """
+        参数:
+            stream_id: 流ID
+            max_events: 最多保留的事件数，超出后丢弃最早的事件
+            resume_grace: 没有读取方后生产方继续运行、等待重连的秒数
+        """
+        self.stream_id = stream_id
+        self.max_events = max_events
+        self.resume_grace = resume_grace
+        self.created = time.time()
+        self._events: List[Tuple[int, str, Dict[str, Any]]] = []
+        self._next_seq = 1
+        self.finished = False
+        self.complete = False
+        self._followers = 0
+        self._idle_since: Optional[float] = None  # 最后一个读取方离开的时间
+        self._async_waiters = []  # 等待状态变化的(事件循环, future)
+        self.producer: Optional["asyncio.Future"] = None  # 异步模式的生产方任务
+        self._cond = threading.Condition()
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.stream_id}:{seq}"
+
+    def _notify(self) -> None:
+        # 调用方需持有self._cond；唤醒同步和异步的等待者
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _async_waiter(self, loop: asyncio.AbstractEventLoop) -> "asyncio.Future":
+        # 调用方需持有self._cond；返回在下一次状态变化时完成的future
+        future = loop.create_future()
+        self._async_waiters.append((loop, future))
+        return future
+
+    def append(self, event: str, data: Dict[str, Any]) -> int:
+        """记录一个事件并返回其序号；流已结束（如已被放弃）时不再记录，返回0"""
+        with self._cond:
+            if self.finished:
+                return 0
+            seq = self._next_seq
+            self._next_seq += 1
+            self._events.append((seq, event, data))
+            if len(self._events) > self.max_events:
+                del self._events[:len(self._events) - self.max_events]
+            self._notify()
+        return seq
+
+    def finish(self, complete: bool) -> None:
+        """
+        标记流已结束，只有第一次调用生效
+
+        参数:
+            complete: 正常结束为True；生产方中途停止（如没有客户端重连）为False
+        """
+        with self._cond:
+            if self.finished:
+                return
+            self.finished = True
+            self.complete = complete
+            self._notify()
+
+    def _attach(self) -> None:
+        with self._cond:
+            self._followers += 1
+            self._idle_since = None
+
+    def _detach(self) -> None:
+        with self._cond:
+            self._followers -= 1
+            if self._followers == 0:
+                self._idle_since = time.monotonic()
+            self._notify()
+
+    def _abandon_delay(self) -> Optional[float]:
+        # 调用方需持有self._cond；距离放弃还有多少秒，有读取方（或还没有读取方来过）时返回None
+        if self._followers or self._idle_since is None:
+            return None
+        return max(0.0, self.resume_grace - (time.monotonic() - self._idle_since))
+
+    def _pending(self, seq: int) -> List[Tuple[int, str, Dict[str, Any]]]:
+        # 调用方需持有self._cond；序号seq之后的事件，已被丢弃时抛出LookupError
+        if not self._events:
+            return []
+        first = self._events[0][0]
+        if first > seq + 1:
+            raise LookupError("请求的事件已不在记录中")
+        return self._events[max(0, seq + 1 - first):]
+
+    def follow(self, after_seq: int,
+               heartbeat: Optional[float] = None) -> Generator[Optional[Tuple[int, str, Dict[str, Any]]], None, None]:
+        """
+        从指定序号之后开始回放事件，流仍在生成时继续等待新事件，直到流结束
+
+        参数:
+            after_seq: 客户端已收到的最后一个事件序号
+            heartbeat: 大于0时，每等待这么多秒仍没有新事件就产生一个None，供调用方发送心跳
+
+        返回:
+            一个生成器，产生(序号, 事件类型, 数据)或None
+        """
+        wait = heartbeat if heartbeat and heartbeat > 0 else None
+        self._attach()
+        try:
+            seq = after_seq
+            while True:
+                with self._cond:
+                    pending = self._pending(seq)
+                    if not pending:
+                        if self.finished:
+                            break
+                        changed = self._cond.wait(wait)
+                if not pending:
+                    if not changed:
+                        yield None
+                    continue
+                for entry in pending:
+                    seq = entry[0]
+                    yield entry
+        finally:
+            self._detach()
+
+    async def follow_async(self, after_seq: int) -> AsyncIterator[Tuple[int, str, Dict[str, Any]]]:
+        """follow的异步版本，等待新事件时不占用线程（心跳由响应层发送，见asgi_app.RecommendationStream）"""
+        loop = asyncio.get_running_loop()
+        self._attach()
+        try:
+            seq = after_seq
+            while True:
+                with self._cond:
+                    pending = self._pending(seq)
+                    if not pending:
+                        if self.finished:
+                            break
+                        changed = self._async_waiter(loop)
+                if not pending:
+                    await changed
+                    continue
+                for entry in pending:
+                    seq = entry[0]
+                    yield entry
+        finally:
+            self._detach()
+
+    def produce(self, events: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        生产方（在后台线程中运行）：另一个线程读取事件序列，本线程按resume_grace计时监视读取方，
+        被放弃时立即结束流（即使上游正停顿在等待下一个片段），读取线程随后关闭事件序列
+        """
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._consume, events), daemon=True).start()
+        with self._cond:
+            while not self.finished:
+                delay = self._abandon_delay()
+                if delay == 0.0:
+                    break
+                self._cond.wait(delay)
+        self.finish(False)  # 已正常结束时不生效
+
+    def _consume(self, events: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+        complete = False
+        try:
+            for event, data in events:
+                if not self.append(event, data):
+                    break  # 已被放弃
+            else:
+                complete = True
+        except Exception as e:
+            self.append(EVENT_ERROR, {"message": str(e), "resumable": False})
+        finally:
+            if hasattr(events, "close"):
+                events.close()  # 被放弃时关闭上游流
+            self.finish(complete)
+
+    async def _consume_async(self, events: AsyncIterable[Tuple[str, Dict[str, Any]]]) -> None:
+        complete = False
+        try:
+            async for event, data in events:
+                self.append(event, data)
+            complete = True
+        except Exception as e:
+            self.append(EVENT_ERROR, {"message": str(e), "resumable": False})
+        finally:
+            if hasattr(events, "aclose"):
+                await events.aclose()
+            self.finish(complete)
+
+    async def produce_async(self, events: AsyncIterable[Tuple[str, Dict[str, Any]]]) -> None:
+        """produce的异步版本：被放弃时立即取消，即使还在等待首个令牌"""
+        loop = asyncio.get_running_loop()
+        consumer = asyncio.ensure_future(self._consume_async(events))
+        try:
+            while not consumer.done():
+                with self._cond:
+                    delay = self._abandon_delay()
+                    if delay == 0.0:
+                        consumer.cancel()
+                        break
+                    changed = self._async_waiter(loop)
+                await asyncio.wait({consumer, changed}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not consumer.done():
+                consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+
+
+def _resolve(future: "asyncio.Future") -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class StreamRegistry:
+    """保存最近的流会话，按数量上限和存活时间清理"""
+
+    def __init__(self, max_sessions: int = 1000, ttl: float = 300.0, resume_grace: float = 10.0):
+        """
+        参数:
+            max_sessions: 最多保留的流会话数
+            ttl: 流会话创建后保留的时间（秒）
+            resume_grace: 客户端全部断开后继续生成、等待重连的秒数（不超过ttl）
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.resume_grace = min(resume_grace, ttl)
+        self._sessions: "OrderedDict[str, StreamSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self) -> StreamSession:
+        """创建并登记一个新的流会话"""
+        session = StreamSession(uuid.uuid4().hex, resume_grace=self.resume_grace)
+        with self._lock:
+            self._prune()
+            self._sessions[session.stream_id] = session
+        return session
+
+    def get(self, stream_id: str) -> Optional[StreamSession]:
+        with self._lock:
+            self._prune()
+            return self._sessions.get(stream_id)
+
+    def _prune(self) -> None:
+        # 调用方需持有self._lock
+        now = time.time()
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) < self.max_sessions and now - oldest.created <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
+
+
+def encode_events(session: StreamSession, events: Iterable[Tuple[str, Dict[str, Any]]], formatter,
+                  heartbeat_frame: Optional[str] = None, heartbeat_interval: float = 0.0) -> Generator[str, None, None]:
+    """
+    在后台线程中生成事件并记录到会话，当前响应作为第一个读取方编码输出
+
+    客户端断开后生成继续进行session.resume_grace秒，期间携带Last-Event-ID重连可以接着接收。
+
+    参数:
+        session: 当前流会话
+        events: (事件类型, 数据)序列
+        formatter: format_sse或format_ndjson
+        heartbeat_frame: 心跳帧（见HEARTBEAT_FRAMES），为None时不发送心跳
+        heartbeat_interval: 超过这么多秒没有事件时发送心跳帧
+
+    返回:
+        一个生成器，产生编码后的文本帧
+    """
+    # 生产方沿用当前上下文（链路追踪等）
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(session.produce, events), daemon=True).start()
+    yield from resume_events(session, 0, formatter, heartbeat_frame, heartbeat_interval)
+
+
+async def encode_events_async(session: StreamSession, events: AsyncIterable[Tuple[str, Dict[str, Any]]],
+                              formatter) -> AsyncIterator[str]:
+    """encode_events的异步版本（用于ASGI模式），生产方作为事件循环中的任务运行"""
+    session.producer = asyncio.ensure_future(session.produce_async(events))
+    async for frame in resume_events_async(session, 0, formatter):
+        yield frame
+
+
+def _interrupted(session: StreamSession, last_seq: int, formatter,
+                 message: str = "原始流已中断，请重新获取穿搭建议") -> str:
+    # 使用已送达的最后一个事件的ID，客户端携带它重连时不会重复收到已送达的事件
+    return formatter(session.event_id(last_seq), EVENT_ERROR, {"message": message, "resumable": False})
+
+
+def resume_events(session: StreamSession, after_seq: int, formatter, heartbeat_frame: Optional[str] = None,
+                  heartbeat_interval: float = 0.0) -> Generator[str, None, None]:
+    """
+    按Last-Event-ID回放一个流中尚未送达的事件，原始流仍在生成时继续接收新事件
+
+    原始流中途停止且无法补齐时，以error事件结束，客户端需要重新发起请求。
+    heartbeat_frame不为None时，超过heartbeat_interval秒没有事件就发送一次心跳帧。
+    """
+    last_seq = after_seq
+    last_event = None
+    heartbeat = heartbeat_interval if heartbeat_frame is not None else None
+    try:
+        for entry in session.follow(after_seq, heartbeat):
+            if entry is None:
+                yield heartbeat_frame
+                continue
+            last_seq, last_event, data = entry
+            yield formatter(session.event_id(last_seq), last_event, data)
+    except LookupError as e:
+        yield _interrupted(session, last_seq, formatter, str(e))
+        return
+
+    if last_event != EVENT_DONE and not session.complete:
+        yield _interrupted(session, last_seq, formatter)
+
+
+async def resume_events_async(session: StreamSession, after_seq: int, formatter) -> AsyncIterator[str]:
+    """resume_events的异步版本"""
+    last_seq = after_seq
+    last_event = None
+    events = session.follow_async(after_seq)
+    try:
+        async for last_seq, last_event, data in events:
+            yield formatter(session.event_id(last_seq), last_event, data)
+    except LookupError as e:
+        yield _interrupted(session, last_seq, formatter, str(e))
+        return
+    finally:
+        await events.aclose()
+
+    if last_event != EVENT_DONE and not session.complete:
+        yield _interrupted(session, last_seq, formatter)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+流式输出工具
+把上游逐个到达的细小文本片段按大小或时间窗口合并成较大的帧再发送，
+减少下游的写入次数和帧开销，同时不引入额外延迟。
+"""
+
+import os
+import time
+import queue
+import asyncio
+import threading
+import contextvars
+from typing import Iterable, Generator, AsyncIterable, AsyncIterator, Optional, List, Tuple, Any
+
+
+def get_flush_settings():
+    """
+    从环境变量读取合并参数
+
+    返回:
+        (STREAM_FLUSH_BYTES 字节阈值, STREAM_FLUSH_INTERVAL_MS 转换成的秒数)
+    """
+    try:
+        max_bytes = int(os.environ.get("STREAM_FLUSH_BYTES", 256))
+    except ValueError:
+        max_bytes = 256
+    try:
+        max_delay = float(os.environ.get("STREAM_FLUSH_INTERVAL_MS", 30)) / 1000.0
+    except ValueError:
+        max_delay = 0.03
+    return max_bytes, max_delay
+
+
+def get_resume_grace() -> float:
+    """
+    从环境变量读取断线重连的等待时间
+
+    返回:
+        STREAM_RESUME_GRACE_SECONDS 秒数：客户端全部断开后继续生成、等待携带Last-Event-ID重连的时间，
+        0表示断开后立即停止生成
+    """
+    try:
+        return max(0.0, float(os.environ.get("STREAM_RESUME_GRACE_SECONDS", 10)))
+    except ValueError:
+        return 10.0
+
+
+def get_heartbeat_interval() -> float:
+    """
+    从环境变量读取心跳间隔
+
+    返回:
+        STREAM_HEARTBEAT_SECONDS 秒数，不大于0表示不发送心跳
+    """
+    try:
+        return float(os.environ.get("STREAM_HEARTBEAT_SECONDS", 15))
+    except ValueError:
+        return 15.0
+
+
+# 上游结束的标记
+_END = object()
+
+
+class _BackgroundReader:
+    """在后台线程中读取同步片段迭代器，使读取方可以带超时等待下一个片段"""
+
+    def __init__(self, chunks: Iterable[str]):
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        # 后台线程沿用当前上下文（链路追踪等）
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run, chunks), daemon=True).start()
+
+    def _run(self, chunks: Iterable[str]) -> None:
+        try:
+            for chunk in chunks:
+                if self._stopped.is_set():
+                    break
+                self._queue.put((chunk, None))
+            self._queue.put((_END, None))
+        except Exception as e:
+            self._queue.put((_END, e))
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()  # 读取方已停止时释放上游连接
+
+    def get(self, timeout: Optional[float]) -> Tuple[Any, Optional[Exception]]:
+        """
+        等待下一个片段
+
+        返回:
+            (片段, None)；上游结束时为(_END, None)，出错时为(_END, 异常)
+
+        异常:
+            queue.Empty: timeout秒内没有新片段
+        """
+        return self._queue.get(timeout=timeout)
+
+    def stop(self) -> None:
+        """读取方不再需要后续片段，后台线程在下一个片段到达时关闭上游"""
+        self._stopped.set()
+
+
+def _flush_timeout(buffer: List[str], last_flush: float, max_delay: float) -> Optional[float]:
+    # 缓冲区有内容时距离本次时间窗口结束的秒数，缓冲区为空时无需限时等待
+    if not buffer:
+        return None
+    return max(0.0, last_flush + max_delay - time.monotonic())
+
+
+def coalesce_chunks(chunks: Iterable[str], max_bytes: int = 256,
+                    max_delay: float = 0.03) -> Generator[str, None, None]:
+    """
+    合并细小的文本片段
+
+    缓冲区达到max_bytes字节，或距离上一次发送已满max_delay秒时立即发送；时间窗口按截止时间计算，
+    上游在窗口内停顿时缓冲的内容也会按时发出，上游停顿一段时间后到达的第一个片段则直接发出。
+    max_delay不大于0时不做合并，原样转发。上游在后台线程中读取，以便在等待下一个片段时按时发送。
+
+    参数:
+        chunks: 上游文本片段
+        max_bytes: 按UTF-8编码计算的缓冲区大小阈值，不大于0时只按时间合并
+        max_delay: 两次发送之间的最长间隔（秒）
+
+    返回:
+        一个生成器，产生合并后的文本帧
+    """
+    if max_delay <= 0:
+        yield from chunks
+        return
+
+    reader = _BackgroundReader(chunks)
+    buffer = []
+    size = 0
+    last_flush = time.monotonic()
+    try:
+        while True:
+            try:
+                chunk, error = reader.get(_flush_timeout(buffer, last_flush, max_delay))
+            except queue.Empty:
+                chunk, error = "", None  # 时间窗口已满，发送缓冲的内容
+            if chunk is _END:
+                if buffer:
+                    yield "".join(buffer)
+                if error is not None:
+                    raise error
+                return
+            if chunk:
+                buffer.append(chunk)
+                size += len(chunk.encode('utf-8'))
+            now = time.monotonic()
+            if buffer and ((max_bytes > 0 and size >= max_bytes) or now - last_flush >= max_delay):
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                last_flush = now
+    finally:
+        reader.stop()
+
+
+async def coalesce_chunks_async(chunks: AsyncIterable[str], max_bytes: int = 256,
+                                max_delay: float = 0.03) -> AsyncIterator[str]:
+    """coalesce_chunks的异步版本（用于ASGI模式），等待下一个片段时按截止时间发送，退出时关闭上游异步迭代器"""
+    iterator = chunks.__aiter__()
+    pending = None
+    try:
+        if max_delay <= 0:
+            async for chunk in iterator:
+                yield chunk
+            return
+
+        buffer = []
+        size = 0
+        last_flush = time.monotonic()
+        while True:
+            # 取下一个片段放在单独的任务中，等待超时只发送缓冲的内容，不会打断正在进行的上游读取
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=_flush_timeout(buffer, last_flush, max_delay))
+            chunk = ""
+            if done:
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    if buffer:
+                        yield "".join(buffer)
+                    raise
+            if chunk:
+                buffer.append(chunk)
+                size += len(chunk.encode('utf-8'))
+            now = time.monotonic()
+            if buffer and ((max_bytes > 0 and size >= max_bytes) or now - last_flush >= max_delay):
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                last_flush = now
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+
+def split_text(text: str, chunk_size: int = 256) -> Generator[str, None, None]:
+    """把一段完整文本按固定长度切分成帧（用于示例回答等本地内容）"""
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
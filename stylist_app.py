@@ -14,41 +14,60 @@ from typing import Optional
 from dotenv import load_dotenv
 
 # 导入 Deepseek API 客户端
-from deepseek_client import DeepseekClient
+from response_cache import get_cached_client
+from example_responses import get_outfit_example
+from file_cache import file_cache
+from wardrobe import filter_wardrobe, filter_settings
+from prompt_budget import (
+    PromptSection, apply_budget, estimate_tokens, input_token_budget, adaptive_max_tokens,
+    format_report, summarize_markdown, summarize_weather,
+)
+
+from app_logging import get_logger
 
 # 加载环境变量
 load_dotenv()
 
+logger = get_logger("stylist_app")
+
 def load_file_content(file_path):
-    """加载指定文件的内容"""
+    """加载指定文件的内容（文件未修改时直接使用内存缓存）"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return file.read()
+        return file_cache.read(file_path)
     except Exception as e:
-        print(f"无法加载文件 {file_path}: {str(e)}")
+        logger.error("无法加载文件 %s: %s", file_path, e)
         return None
 
-def create_prompt(user_query, body_data, wardrobe_data, weather_data, stylist_template):
-    """创建发送给AI模型的提示词"""
-    prompt = f"""
-你是一位专业的穿搭顾问，请根据以下信息为用户提供穿搭建议：
-
-# 用户需求
-{user_query}
-
-# 用户个人信息
-{body_data}
-
-# 用户衣橱数据
-{wardrobe_data}
+def load_user_specific_data(user_id):
+    """
+    加载指定用户的数据（users/<用户ID>/下的文件），缺少的文件使用根目录的默认数据
 
-# 天气数据
-{weather_data}
+    返回:
+        包含body_data、weather_data和wardrobe_data的字典
+    """
+    body_data = load_file_content(f'users/{user_id}/body_data.md')
+    weather_data = load_file_content(f'users/{user_id}/weather_forecast.md')
+    wardrobe_data = load_file_content(f'users/{user_id}/wardrobe.md')
+    
+    # 如果用户特定数据不存在，使用默认数据
+    if not body_data:
+        body_data = load_file_content('body_data.md')
+    if not weather_data:
+        weather_data = load_file_content('weather_forecast.md')
+    if not wardrobe_data:
+        wardrobe_data = load_file_content('wardrobe.md')
+    
+    return {
+        "body_data": body_data,
+        "weather_data": weather_data,
+        "wardrobe_data": wardrobe_data
+    }
 
-# 穿搭顾问角色
-{stylist_template}
+# 提示词开头的角色说明
+PROMPT_INTRO = "你是一位专业的穿搭顾问，请根据以下信息为用户提供穿搭建议："
 
-请提供一套完整的穿搭方案，包括：
+# 输出格式要求（附在提示词末尾）
+OUTPUT_FORMAT_SPEC = """请提供一套完整的穿搭方案，包括：
 1. 用户衣橱内已有的单品（必须标记为"[衣橱已有]"）
 2. 用户衣橱中不存在但推荐搭配的单品（必须标记为"[建议购买]"）
 
@@ -114,18 +133,127 @@ def create_prompt(user_query, body_data, wardrobe_data, weather_data, stylist_te
 ━━━━━━━━━━ 总结 ━━━━━━━━━━
 
 ✓ 已有单品利用：[解释如何充分利用用户已有的衣物]
-✓ 推荐购买理由：[解释为什么推荐购买特定单品，以及它们将如何提升整体衣橱价值]
-"""
-    return prompt
+✓ 推荐购买理由：[解释为什么推荐购买特定单品，以及它们将如何提升整体衣橱价值]"""
+
+# 提示词各部分的标题
+SECTION_TITLES = {
+    "query": "用户需求",
+    "body_data": "用户个人信息",
+    "wardrobe": "用户衣橱数据",
+    "weather": "天气数据",
+    "stylist_template": "穿搭顾问角色",
+}
+
+def build_prompt_sections(user_query, body_data, wardrobe_data, weather_data, stylist_template):
+    """
+    按提示词中的顺序构建各部分
+
+    优先级决定超出令牌预算时的压缩顺序（数值小的先压缩）：
+    通用的穿搭顾问模板 < 天气 < 衣橱 < 个人信息；用户需求和输出格式要求不压缩。
+    """
+    return [
+        PromptSection("query", user_query, priority=100, required=True),
+        PromptSection("body_data", body_data, priority=80),
+        PromptSection("wardrobe", wardrobe_data, priority=60),
+        PromptSection("weather", weather_data, priority=50, summarizer=summarize_weather),
+        PromptSection("stylist_template", stylist_template, priority=40, summarizer=summarize_markdown),
+        PromptSection("output_format", OUTPUT_FORMAT_SPEC, priority=100, required=True),
+    ]
+
+def render_prompt(sections):
+    """把各部分拼接成完整的提示词"""
+    parts = ["\n", PROMPT_INTRO, "\n\n"]
+    for section in sections:
+        if section.name == "output_format":
+            continue
+        parts.append(f"# {SECTION_TITLES[section.name]}\n{section.text}\n\n")
+    parts.append(OUTPUT_FORMAT_SPEC)
+    parts.append("\n")
+    return "".join(parts)
+
+# 稳定布局中各部分的顺序：越靠前的内容越少变化
+# 系统消息对所有用户相同；用户消息按 个人信息 → 衣橱 → 天气 → 需求 排列，同一用户的多次请求共享前缀
+STABLE_SYSTEM_SECTIONS = ("stylist_template", "output_format")
+STABLE_USER_SECTIONS = ("body_data", "wardrobe", "weather", "query")
+
+def prompt_layout():
+    """
+    提示词布局（环境变量PROMPT_LAYOUT）
+
+    返回:
+        "stable"（默认）：拆分为系统消息和用户消息，内容按从稳定到易变排列，
+        使Deepseek的上下文硬盘缓存能够命中相同的前缀；
+        "legacy"：与旧版本相同的单条用户消息，用户需求在最前面
+    """
+    layout = os.environ.get("PROMPT_LAYOUT", "stable").lower()
+    return layout if layout in ("stable", "legacy") else "stable"
+
+def render_messages(sections):
+    """
+    按稳定布局拼接提示词
+
+    返回:
+        (系统消息, 用户消息)
+    """
+    by_name = {section.name: section for section in sections}
+    system_parts = [PROMPT_INTRO, "\n\n"]
+    for name in STABLE_SYSTEM_SECTIONS:
+        if name == "output_format":
+            system_parts.append(OUTPUT_FORMAT_SPEC)
+            system_parts.append("\n")
+        elif name in by_name:
+            system_parts.append(f"# {SECTION_TITLES[name]}\n{by_name[name].text}\n\n")
+    user_parts = [f"# {SECTION_TITLES[name]}\n{by_name[name].text}\n\n"
+                  for name in STABLE_USER_SECTIONS if name in by_name]
+    return "".join(system_parts), "".join(user_parts).rstrip("\n") + "\n"
+
+def create_prompt(user_query, body_data, wardrobe_data, weather_data, stylist_template):
+    """创建发送给AI模型的提示词"""
+    return render_prompt(build_prompt_sections(user_query, body_data, wardrobe_data, weather_data, stylist_template))
 
-def generate_outfit_recommendation(prompt, use_api: bool = True, api_key: Optional[str] = None):
+def create_prompt_with_budget(user_query, body_data, wardrobe_data, weather_data, stylist_template, budget=None,
+                              layout=None):
+    """
+    创建提示词并控制令牌预算
+
+    参数:
+        budget: 输入令牌预算，为None时使用环境变量PROMPT_TOKEN_BUDGET
+        layout: 提示词布局（"stable"或"legacy"），为None时使用环境变量PROMPT_LAYOUT
+
+    返回:
+        (系统消息, 用户消息, 统计报告)；legacy布局下系统消息为None。
+        报告包含各部分令牌数、是否被压缩，以及自适应的max_tokens
+    """
+    layout = layout or prompt_layout()
+    sections = build_prompt_sections(user_query, body_data, wardrobe_data, weather_data, stylist_template)
+
+    def render():
+        if layout == "legacy":
+            return None, render_prompt(sections)
+        return render_messages(sections)
+
+    # 标题、连接文字等固定部分的令牌数
+    system_prompt, prompt = render()
+    overhead = max(0, estimate_tokens(prompt) + estimate_tokens(system_prompt or "") -
+                   sum(section.tokens for section in sections))
+    report = apply_budget(sections, input_token_budget() if budget is None else budget, overhead_tokens=overhead)
+    report["max_tokens"] = adaptive_max_tokens(report["total_tokens"], report["sections"]["output_format"]["tokens"])
+    report["layout"] = layout
+    logger.info(format_report(report))
+    system_prompt, prompt = render()
+    return system_prompt, prompt, report
+
+def generate_outfit_recommendation(prompt, use_api: bool = True, api_key: Optional[str] = None,
+                                   max_tokens: int = 2000, system_prompt: Optional[str] = None):
     """
     生成穿搭建议
     
     参数:
-        prompt: 提示词
+        prompt: 提示词（用户消息）
         use_api: 是否使用API，如果为False则返回示例回答
         api_key: API密钥，如果为None则从环境变量获取
+        max_tokens: 最大生成的令牌数
+        system_prompt: 系统消息（稳定布局时由create_prompt_with_budget生成）
     
     返回:
         穿搭建议文本
@@ -133,28 +261,21 @@ def generate_outfit_recommendation(prompt, use_api: bool = True, api_key: Option
     # 使用API生成回答
     if use_api:
         try:
-            print(f"API使用设置: {use_api}")
-            if api_key:
-                masked_key = api_key[:4] + "*" * (len(api_key) - 8) + api_key[-4:] if len(api_key) > 8 else "***"
-                print(f"API密钥提供: {masked_key}, 长度: {len(api_key)}")
-            else:
-                print("未直接提供API密钥，将尝试从环境变量获取")
-            
-            # 初始化客户端
-            client = DeepseekClient(api_key=api_key)
+            # 获取复用的客户端（共享连接池，带响应缓存）
+            client = get_cached_client(api_key=api_key)
             
             # 检查API密钥
             if not client.api_key:
-                print("警告: 未设置API密钥，将使用示例回答")
-                return generate_outfit_recommendation(prompt, use_api=False)
+                logger.warning("未设置API密钥，将使用示例回答")
+                return get_outfit_example(prompt)
             
             # 调用API
-            print("正在调用Deepseek API生成穿搭建议...")
             response = client.generate_completion(
                 prompt=prompt,
                 model="deepseek-chat",  # 或其他适合的模型
-                max_tokens=2000,
-                temperature=0.7
+                max_tokens=max_tokens,
+                temperature=0.7,
+                system_prompt=system_prompt
             )
             
             # 提取回答文本
@@ -162,89 +283,18 @@ def generate_outfit_recommendation(prompt, use_api: bool = True, api_key: Option
             
             # 检查是否有错误
             if recommendation.startswith("错误:"):
-                print(f"API调用出错: {recommendation}")
-                print("将使用示例回答...")
-                return generate_outfit_recommendation(prompt, use_api=False)
+                logger.warning("API调用出错，将使用示例回答: %s", recommendation)
+                return get_outfit_example(prompt)
             
-            print("成功获取API回答")
             return recommendation
             
         except Exception as e:
-            import traceback
-            print(f"调用API时出错: {str(e)}")
-            print(traceback.format_exc())
-            print("将使用示例回答...")
-            return generate_outfit_recommendation(prompt, use_api=False)
+            logger.exception("调用API时出错，将使用示例回答: %s", e)
+            return get_outfit_example(prompt)
     
     # 使用示例回答
-    print("使用示例回答...")
-    response = """
-【穿搭设计方案】#001
-
-▶ 场景定位：工作日通勤
-▶ 风格基调：极简都市风 + 法式优雅元素
-▶ 体型优化：强调腰线、平衡梨形身材比例
-▶ 季节适应：春季 | 5-20℃ | 多云转晴
-
-━━━━━━━━━━ 单品组合 ━━━━━━━━━━
-
-➊ 上装：真丝飘带衬衫 + 优质真丝 + 浅蓝色 + 立领设计 [衣橱已有]
-   • 亮点：飘带元素增添女性柔美气质
-   • 搭配理由：立领修饰颈部线条，飘带可多种系法变化造型
-   • 衣橱状态：用户衣橱中有一件浅蓝色真丝立领衬衫，带有可拆卸飘带，是去年购买的高质量单品
-
-➋ 下装：高腰九分烟管裤 + 挺括面料 + 黑色 + 直筒剪裁 [衣橱已有]
-   • 亮点：高腰设计拉长腿部比例
-   • 搭配理由：修身但不紧绷的剪裁平衡下半身比例，黑色显瘦
-   • 衣橱状态：用户衣橱中有两条高腰黑色直筒裤，选择那条九分款更适合春季穿着
-
-➌ 外套：收腰短款西装 + 精致羊毛混纺 + 黑色 + 短款设计 [建议购买]
-   • 亮点：收腰设计强调腰线
-   • 搭配理由：短款西装与高腰裤搭配创造黄金比例，增添专业感
-   • 衣橱状态：用户衣橱中有一件常规版型的黑色西装，但缺少收腰设计的短款西装，建议购买以更好地突出腰线
-
-➍ 鞋履：裸色尖头高跟鞋 + 优质皮革 + 肤色 + 7cm粗跟 [衣橱已有]
-   • 亮点：视觉延伸腿部线条
-   • 搭配理由：粗跟设计兼顾稳定性和舒适度，肤色增加腿部延伸感
-   • 衣橱状态：用户衣橱中有一双与描述完全匹配的裸色粗跟高跟鞋，状态良好
-
-➎ 包袋：结构化通勤托特包 + 小牛皮 + 深酒红色 + 金属五金 [建议购买]
-   • 亮点：专业大气，实用性强，酒红色增添高级感
-   • 搭配理由：容量适中可容纳电脑，色彩为黑蓝基础搭配注入活力
-   • 衣橱状态：用户衣橱中有黑色和米色托特包，但缺少能为穿搭增添色彩的款式，深酒红色是安全但有品味的选择
-
-➏ 配饰：18K金珍珠锁骨链 + 优雅珍珠 + 金白搭配 + 简约设计 [衣橱已有]
-   • 亮点：低调优雅的点缀
-   • 搭配理由：珍珠元素与飘带衬衫呼应，增添女性柔美气质
-   • 衣橱状态：用户珠宝盒中有一条珍珠锁骨链，为家传饰品，品质优良且具有情感价值
-
-━━━━━━━━━━ 穿搭解析 ━━━━━━━━━━
-
-⚡ 色彩和谐：浅蓝+黑色基础配色 | 肤色鞋履温和过渡 | 金色饰品点缀 | 酒红包袋提亮整体
-⚡ 比例构建：高腰裤+短款外套应用3:7黄金比例 | 视觉重心在腰部
-⚡ 材质互动：硬挺西装+柔软真丝+皮革形成质感层次 | 正式感与柔美平衡
-⚡ 风格统一：都市极简为基调 | 飘带与珍珠增添法式风情 | 整体简约大气
-⚡ 与用户喜好匹配：根据用户个人信息，她偏爱简约优雅的风格，且对法式元素有好感。这套穿搭使用她喜欢的蓝色系作为主色调，并通过立领、飘带等细节呼应她对精致细节的欣赏
-
-━━━━━━━━━━ 实用建议 ━━━━━━━━━━
-
-✓ 穿着顺序：内搭衬衫 → 高腰裤 → 短款西装 → 配饰点缀
-✓ 变体拓展：
-  1. 天气转暖可脱去西装，领口飘带换系法增添变化 [全部为衣橱已有]
-  2. 下班约会可更换真丝裹身中长裙 [建议购买]，保留相同上装与配饰 [衣橱已有]
-  3. 周末休闲版本：将上装换为白色棉质T恤 [衣橱已有]，配同色系休闲夹克 [建议购买]
-✓ 注意事项：真丝衬衫避免使用普通洗衣粉，建议手洗或干洗
-✓ 购买建议：
-  - 收腰短款西装：建议关注季末折扣，预算2000-3000元，优先选择羊毛含量高的款式
-  - 酒红色托特包：可考虑二线轻奢品牌，预算1500-2500元，注意选择结构挺括、有内部分隔的款式
-  - 真丝裹身裙：建议选择可调节腰带的设计，预算800-1500元
-
-━━━━━━━━━━ 总结 ━━━━━━━━━━
-
-✓ 已有单品利用：本套穿搭充分利用了用户已有的高质量基础单品（真丝衬衫、高腰裤、珍珠配饰和裸色高跟鞋），这些单品都是经典款式，组合起来已具备职场优雅感
-✓ 推荐购买理由：建议购买的三件单品（收腰西装、酒红包袋和真丝裹身裙）都是能够提升整体衣橱价值的投资款。收腰西装强调用户优势腰线；酒红包袋为多套穿搭增添色彩活力；真丝裹身裙则增加了下装选择，使工作-约会的场景切换更为顺畅。这三件单品都具有较高的性价比和多种搭配可能性。
-"""
-    return response
+    logger.info("使用示例回答")
+    return get_outfit_example(prompt)
 
 def main():
     """主函数"""
@@ -253,8 +303,23 @@ def main():
     parser.add_argument('--api-key', type=str, help='Deepseek API密钥')
     parser.add_argument('--use-api', action='store_true', help='使用API生成回答，而非示例回答')
     parser.add_argument('--no-api', action='store_true', help='强制不使用API，使用示例回答')
+    parser.add_argument('--batch', type=str, metavar='MANIFEST',
+                        help='批量模式：按清单文件（或"all"表示全部用户×全部场景）生成穿搭建议')
+    parser.add_argument('--output', type=str, default='batch_results.jsonl', help='批量模式的JSONL输出文件')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get("BATCH_WORKERS", 8)),
+                        help='批量模式的并发任务数')
+    parser.add_argument('--rate-limit', type=float, default=float(os.environ.get("BATCH_RATE_LIMIT", 0)),
+                        help='批量模式每秒最多发送的API请求数（0表示不限速）')
+    parser.add_argument('--resume', action='store_true', help='批量模式跳过输出文件中已成功完成的任务')
     args = parser.parse_args()
     
+    if args.batch:
+        from batch import run_batch_cli
+        env_use_api = os.environ.get("USE_DEEPSEEK_API", "").lower() in ['true', '1', 'yes']
+        sys.exit(run_batch_cli(args.batch, args.output, args.workers, args.rate_limit, args.resume,
+                               use_api=args.use_api or (env_use_api and not args.no_api),
+                               api_key=args.api_key or os.environ.get("DEEPSEEK_API_KEY")))
+    
     # 加载必要文件
     body_data = load_file_content('body_data.md')
     wardrobe_data = load_file_content('wardrobe.md')
@@ -268,6 +333,12 @@ def main():
     # 获取用户查询
     user_query = args.query if args.query else input("请描述你需要什么场合的穿搭建议: ")
     
+    # 只保留与需求和天气相关的衣橱单品，缩短提示词
+    filter_enabled, top_n, token_budget = filter_settings()
+    if filter_enabled:
+        wardrobe_data = filter_wardrobe(wardrobe_data, weather_data=weather_data, query=user_query,
+                                        top_n=top_n, token_budget=token_budget)
+    
     # 创建提示词
     # 参数说明：
     # user_query: 用户查询
@@ -275,7 +346,8 @@ def main():
     # wardrobe_data: 用户衣橱数据
     # weather_data: 天气数据
     # stylist_template: 穿搭顾问角色
-    prompt = create_prompt(user_query, body_data, wardrobe_data, weather_data, stylist_template)
+    system_prompt, prompt, prompt_report = create_prompt_with_budget(user_query, body_data, wardrobe_data,
+                                                                     weather_data, stylist_template)
     
     # 是否使用API - 命令行参数优先，其次是环境变量
     env_use_api = os.environ.get("USE_DEEPSEEK_API", "").lower() in ['true', '1', 'yes']
@@ -289,14 +361,12 @@ def main():
     
     # 获取API密钥 - 命令行参数优先，其次是环境变量
     api_key = args.api_key or os.environ.get("DEEPSEEK_API_KEY")
-    if api_key:
-        masked_key = api_key[:4] + "*" * (len(api_key) - 8) + api_key[-4:] if len(api_key) > 8 else "***"
-        print(f"- API密钥: {masked_key} (长度: {len(api_key)})")
-    else:
-        print("- API密钥: 未提供")
+    print(f"- API密钥: {'已提供' if api_key else '未提供'}")
     
     # 生成穿搭建议
-    recommendation = generate_outfit_recommendation(prompt, use_api=use_api, api_key=api_key)
+    recommendation = generate_outfit_recommendation(prompt, use_api=use_api, api_key=api_key,
+                                                    max_tokens=prompt_report["max_tokens"],
+                                                    system_prompt=system_prompt)
     
     # 输出结果
     print("\n==== 你的个性化穿搭建议 ====\n")
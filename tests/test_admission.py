@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""上游并发控制：FIFO排队、拒绝、名额转交，以及合并流对名额的占用"""
+
+import time
+import queue
+import asyncio
+import threading
+
+import pytest
+
+from admission import AdmissionController, QueueFullError, QueueTimeoutError
+from single_flight import StreamCoalescer
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待条件超时")
+        time.sleep(0.005)
+
+
+def test_admits_up_to_limit_then_rejects_when_queue_full():
+    controller = AdmissionController(max_concurrent=2, max_queue=0)
+    first = controller.acquire()
+    second = controller.acquire()
+    with pytest.raises(QueueFullError) as excinfo:
+        controller.acquire()
+    assert excinfo.value.retry_after >= 1
+
+    first.release()
+    third = controller.acquire()
+    assert controller.stats()["active"] == 2
+    second.release()
+    third.release()
+    stats = controller.stats()
+    assert stats["active"] == 0
+    assert stats["admitted"] == 3
+    assert stats["rejected_full"] == 1
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    controller = AdmissionController(max_concurrent=1, max_queue=10, queue_timeout=5.0)
+    held = controller.acquire()
+    order = []
+    threads = []
+
+    def worker(index):
+        with controller.acquire():
+            order.append(index)
+
+    for index in range(4):
+        thread = threading.Thread(target=worker, args=(index,))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: controller.stats()["queue_depth"] == index + 1)
+
+    held.release()
+    for thread in threads:
+        thread.join(5.0)
+    assert order == [0, 1, 2, 3]
+    assert controller.stats()["active"] == 0
+
+
+def test_queue_timeout_leaves_queue():
+    controller = AdmissionController(max_concurrent=1, max_queue=5)
+    held = controller.acquire()
+    with pytest.raises(QueueTimeoutError):
+        controller.acquire(timeout=0.05)
+    stats = controller.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["rejected_timeout"] == 1
+    held.release()
+    assert controller.stats()["active"] == 0
+
+
+def test_release_is_idempotent_and_transfer_moves_ownership():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    ticket = controller.acquire()
+    moved = ticket.transfer()
+    assert moved is not None
+    ticket.release()  # 已转交，不再归还名额
+    assert controller.stats()["active"] == 1
+    assert ticket.transfer() is None
+
+    moved.release()
+    moved.release()
+    assert controller.stats()["active"] == 0
+    assert controller.stats()["completed"] == 1
+
+
+def test_acquire_async_waits_for_released_slot():
+    controller = AdmissionController(max_concurrent=1, max_queue=5, queue_timeout=5.0)
+
+    async def run():
+        held = controller.acquire()
+        waiting = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        threading.Thread(target=held.release).start()  # 名额由其他线程归还
+        ticket = await asyncio.wait_for(waiting, 2.0)
+        ticket.release()
+
+    asyncio.run(run())
+    assert controller.stats()["active"] == 0
+
+
+def test_cancelled_async_waiter_leaves_queue():
+    controller = AdmissionController(max_concurrent=1, max_queue=5, queue_timeout=5.0)
+
+    async def run():
+        held = controller.acquire()
+        waiting = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert controller.stats()["queue_depth"] == 0
+        held.release()
+
+    asyncio.run(run())
+    assert controller.stats()["active"] == 0
+
+
+def blocking_upstream(chunks):
+    """从队列读取片段的上游，放入None表示结束"""
+    def factory(on_usage):
+        while True:
+            item = chunks.get(timeout=5)
+            if item is None:
+                return
+            yield item
+    return factory
+
+
+def test_coalesced_upstream_holds_slot_until_upstream_ends():
+    controller = AdmissionController(max_concurrent=2, max_queue=0)
+    coalescer = StreamCoalescer()
+    chunks = queue.Queue()
+    factory = blocking_upstream(chunks)
+
+    first = coalescer.stream("k", factory, ticket=controller.acquire())
+    chunks.put("a")
+    assert next(first) == "a"
+    second = coalescer.stream("k", factory, ticket=controller.acquire())
+    assert next(second) == "a"
+    assert controller.stats()["active"] == 1  # 加入进行中的流，立即归还名额
+
+    first.close()
+    second.close()
+    assert controller.stats()["active"] == 1  # 订阅者都已离开，上游仍在读取
+
+    chunks.put("b")
+    wait_until(lambda: controller.stats()["active"] == 0)
+
+
+def test_coalesced_upstream_admits_when_ticket_already_released():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    coalescer = StreamCoalescer()
+    chunks = queue.Queue()
+    ticket = controller.acquire()
+    ticket.release()
+
+    subscriber = coalescer.stream("k", blocking_upstream(chunks), ticket=ticket, admit=controller.acquire)
+    chunks.put("a")
+    assert next(subscriber) == "a"
+    assert controller.stats()["active"] == 1
+    chunks.put(None)
+    assert list(subscriber) == []
+    wait_until(lambda: controller.stats()["active"] == 0)
+
+
+def test_coalesced_upstream_rejection_reaches_subscriber():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    coalescer = StreamCoalescer()
+    held = controller.acquire()
+
+    subscriber = coalescer.stream("k", blocking_upstream(queue.Queue()), admit=controller.acquire)
+    with pytest.raises(QueueFullError):
+        next(subscriber)
+    held.release()
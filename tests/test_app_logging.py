@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+"""结构化日志与运行指标：采样过滤、密钥遮蔽和Prometheus文本导出"""
+
+import logging
+
+from app_logging import SamplingFilter, sampled, fields, mask_key
+from metrics import MetricsRegistry
+
+
+def make_record(extra):
+    record = logging.LogRecord("stylist.test", logging.DEBUG, __file__, 1, "消息", (), None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_sampling_filter_only_drops_sampled_records():
+    drop_all = SamplingFilter(0.0)
+    assert not drop_all.filter(make_record(sampled(step=1)))
+    assert drop_all.filter(make_record(fields(step=1)))
+    assert SamplingFilter(1.0).filter(make_record(sampled(step=1)))
+
+
+def test_mask_key():
+    assert mask_key("sk-1234567890abcdef") == "sk-***ef"
+    assert mask_key("short") == "***"
+    assert mask_key("") == ""
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    requests = registry.counter("demo_requests_total", "请求数", ("outcome",))
+    duration = registry.histogram("demo_duration_seconds", "耗时", buckets=(0.1, 1.0))
+    registry.register_collector(lambda: [("demo_queue_depth", "gauge", "队列长度", {}, 3)])
+
+    requests.inc(outcome="ok")
+    requests.inc(2, outcome="ok")
+    duration.observe(0.5)
+    text = registry.render()
+
+    assert 'demo_requests_total{outcome="ok"} 3' in text
+    assert 'demo_duration_seconds_bucket{le="0.1"} 0' in text
+    assert 'demo_duration_seconds_bucket{le="1"} 1' in text
+    assert 'demo_duration_seconds_bucket{le="+Inf"} 1' in text
+    assert "demo_duration_seconds_count 1" in text
+    assert "# TYPE demo_queue_depth gauge\ndemo_queue_depth 3" in text
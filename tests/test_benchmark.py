@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+"""基准测试工具：最近秩法百分位数"""
+
+import pytest
+
+from benchmark import percentile
+
+
+@pytest.mark.parametrize("values, p, expected", [
+    (list(range(1, 11)), 50, 5),
+    (list(range(1, 11)), 90, 9),
+    (list(range(1, 11)), 100, 10),
+    (list(range(1, 101)), 95, 95),
+    (list(range(1, 101)), 99, 99),
+    (list(range(1, 101)), 0, 1),
+    ([3.0], 99, 3.0),
+])
+def test_percentile_nearest_rank(values, p, expected):
+    assert percentile(values, p) == expected
+
+
+def test_percentile_ignores_input_order_and_empty_input():
+    assert percentile([5, 1, 4, 2, 3], 50) == 3
+    assert percentile([], 50) is None
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""熔断器状态机：按失败率和慢调用比例打开、冷却后半开探测、探测结果决定关闭或重新打开"""
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import (
+    CircuitBreaker, CircuitOpenError, GuardedDeepseekClient, STATE_CLOSED, STATE_OPEN, STATE_HALF_OPEN,
+)
+
+
+class FakeClock:
+    """替代circuit_breaker模块中的time，由测试推进时间"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(circuit_breaker, "time", fake)
+    return fake
+
+
+def make_breaker(**kwargs):
+    options = dict(failure_rate=0.5, slow_call_rate=0.8, slow_call_seconds=10.0,
+                   min_calls=4, window=60.0, open_seconds=30.0, half_open_probes=1)
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+
+def call(breaker, success=True, latency=0.1):
+    assert breaker.allow()
+    breaker.record(success, latency)
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        call(breaker, success=False)
+    assert breaker.state == STATE_OPEN
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        call(breaker, success=False)
+    assert breaker.state == STATE_CLOSED
+
+
+def test_opens_when_failure_rate_reached(clock):
+    breaker = make_breaker()
+    call(breaker)
+    call(breaker)
+    call(breaker, success=False)
+    assert breaker.state == STATE_CLOSED
+    call(breaker, success=False)  # 2/4 = 50%
+    assert breaker.state == STATE_OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == pytest.approx(30.0)
+    stats = breaker.stats()
+    assert stats["opened"] == 1 and stats["rejected"] == 1
+
+
+def test_opens_when_slow_calls_dominate(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        call(breaker, latency=12.0)
+    assert breaker.state == STATE_OPEN
+    assert breaker.stats()["slow_calls"] == 4
+
+
+def test_old_calls_leave_window(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        call(breaker, success=False)
+    clock.advance(61)
+    call(breaker, success=False)
+    assert breaker.state == STATE_CLOSED
+    assert breaker.stats()["window_calls"] == 1
+
+
+def test_half_open_admits_limited_probes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(29)
+    assert breaker.state == STATE_OPEN
+    clock.advance(1)
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()  # 只放行一个探测请求
+
+
+def test_successful_probe_closes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(30)
+    call(breaker)
+    assert breaker.state == STATE_CLOSED
+    assert breaker.stats()["window_calls"] == 0
+
+
+@pytest.mark.parametrize("success, latency", [(False, 0.1), (True, 12.0)])
+def test_failed_or_slow_probe_reopens(clock, success, latency):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(30)
+    call(breaker, success=success, latency=latency)
+    assert breaker.state == STATE_OPEN
+    assert breaker.stats()["opened"] == 2
+
+
+def test_release_returns_probe_slot(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.release()  # 探测请求未得出结果就被放弃
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.allow()
+
+
+def test_results_of_calls_admitted_before_opening_are_ignored(clock):
+    breaker = make_breaker()
+    assert breaker.allow()  # 打开前放行、尚未结束的调用
+    open_breaker(breaker)
+    breaker.record(True, 0.1)
+    assert breaker.state == STATE_OPEN
+
+
+class FakeClient:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def chat_stream(self, *args, **kwargs):
+        yield from self.chunks
+
+    def generate_completion(self, *args, **kwargs):
+        return {"error": "超时"}
+
+
+def test_guarded_stream_records_outcome_by_first_chunk(clock):
+    breaker = make_breaker(min_calls=1)
+    client = GuardedDeepseekClient(FakeClient(["\n[API错误: 502]"]), breaker)
+    assert list(client.chat_stream("提示")) == ["\n[API错误: 502]"]
+    assert breaker.state == STATE_OPEN
+
+    with pytest.raises(CircuitOpenError):
+        next(client.chat_stream("提示"))
+
+
+def test_guarded_completion_returns_error_when_open(clock):
+    breaker = make_breaker(min_calls=1)
+    client = GuardedDeepseekClient(FakeClient([]), breaker)
+    assert client.generate_completion("提示") == {"error": "超时"}
+    response = client.generate_completion("提示")
+    assert response["circuit_open"] is True
+
+
+def test_abandoned_stream_releases_probe(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(30)
+    client = GuardedDeepseekClient(FakeClient([]), breaker)
+    stream = client.chat_stream("提示")
+    with pytest.raises(StopIteration):
+        next(stream)  # 上游没有产生任何片段，按成功处理
+    assert breaker.state == STATE_CLOSED
+
+    open_breaker(breaker)
+    clock.advance(30)
+
+    def broken_stream(*args, **kwargs):
+        raise ConnectionResetError("连接被重置")
+        yield
+
+    client = GuardedDeepseekClient(FakeClient([]), breaker)
+    client.client.chat_stream = broken_stream
+    with pytest.raises(ConnectionResetError):
+        next(client.chat_stream("提示"))  # 首个片段之前中断，不计结果并归还探测名额
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.allow()
+
+
+def test_get_circuit_breaker_reads_environment(monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "_default_breaker", None)
+    monkeypatch.setenv("CIRCUIT_BREAKER_ENABLED", "true")
+    monkeypatch.setenv("CIRCUIT_HALF_OPEN_PROBES", "3")
+    monkeypatch.setenv("CIRCUIT_MIN_CALLS", "十")
+    monkeypatch.setenv("CIRCUIT_OPEN_SECONDS", "")
+    breaker = circuit_breaker.get_circuit_breaker()
+    assert (breaker.half_open_probes, breaker.min_calls, breaker.open_seconds) == (3, 5, 30)
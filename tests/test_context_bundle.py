@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""用户上下文包：源文件变化后重建、磁盘载入与数量上限、未知用户，以及与逐次拼接的提示词一致"""
+
+import os
+
+import pytest
+
+from context_bundle import ContextBundleCache, create_prompt_from_bundle, normalize_text
+from stylist_app import create_prompt_with_budget
+
+WARDROBE = """# 衣橱
+
+## 上装
+
+| 二级分类 | 衣服名称 | 主色调 | 适合季节 | 适合场景 | 特征描述 |
+|----------|----------|--------|---------|----------|----------|
+| 外套 | 羊毛大衣 | 黑■ | 秋冬 | 职场 | 及膝 |
+"""
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def touch_later(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2_000_000_000))
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """与仓库相同的数据布局：根目录的默认数据、共用模板和users/<用户ID>/下的用户数据"""
+    monkeypatch.chdir(tmp_path)
+    write("body_data.md", "# 默认个人信息\n身高170")
+    write("wardrobe.md", WARDROBE)
+    write("weather_forecast.md", "# 天气\n\n## 今日天气\n气温：5-10℃")
+    write("fashion_stylist_agent.md", "# 顾问\n\n\n专业穿搭顾问   \n")
+    for user in ("u1", "u2", "u3"):
+        write(f"users/{user}/body_data.md", f"# {user}的个人信息\n身高16{user[-1]}")
+    return tmp_path
+
+
+def test_normalize_text():
+    assert normalize_text("\n\na  \r\n\r\n\r\nb\rc\n\n") == "a\n\nb\nc"
+
+
+def test_bundle_is_reused_until_source_changes(data_dir):
+    cache = ContextBundleCache(check_interval=0)
+    bundle, origin = cache.get("u1")
+    assert origin == "built"
+    assert "u1的个人信息" in bundle.body_data
+    assert bundle.stylist_template == "# 顾问\n\n专业穿搭顾问"
+    assert cache.get("u1") == (bundle, "memory")
+
+    write("users/u1/body_data.md", "# u1的个人信息\n身高180")
+    touch_later("users/u1/body_data.md")
+    rebuilt, origin = cache.get("u1")
+    assert origin == "rebuilt"
+    assert "身高180" in rebuilt.body_data
+    assert rebuilt.content_hash != bundle.content_hash
+
+
+def test_shared_default_file_change_rebuilds(data_dir):
+    cache = ContextBundleCache(check_interval=0)
+    bundle, _ = cache.get("u1")
+    write("weather_forecast.md", "# 天气\n\n## 今日天气\n气温：28℃")
+    touch_later("weather_forecast.md")
+    rebuilt, origin = cache.get("u1")
+    assert origin == "rebuilt"
+    assert rebuilt.seasons == {"夏"} and bundle.seasons != rebuilt.seasons
+
+
+def test_check_interval_skips_stat(data_dir):
+    cache = ContextBundleCache(check_interval=60)
+    bundle, _ = cache.get("u1")
+    write("users/u1/body_data.md", "# 已修改")
+    assert cache.get("u1") == (bundle, "memory")
+    cache.invalidate("u1")
+    assert cache.get("u1")[1] == "built"
+
+
+def test_disk_bundle_is_loaded_only_while_sources_match(data_dir):
+    disk_dir = str(data_dir / "bundles")
+    first, _ = ContextBundleCache(disk_dir=disk_dir).get("u1")
+
+    loaded, origin = ContextBundleCache(disk_dir=disk_dir).get("u1")
+    assert origin == "disk"
+    assert loaded.content_hash == first.content_hash
+
+    write("users/u1/body_data.md", "# u1的个人信息\n已更新")
+    touch_later("users/u1/body_data.md")
+    assert ContextBundleCache(disk_dir=disk_dir).get("u1")[1] == "built"
+
+
+def test_unknown_users_are_refused_without_touching_disk(data_dir):
+    disk_dir = str(data_dir / "bundles")
+    cache = ContextBundleCache(disk_dir=disk_dir, is_known=lambda user_id: user_id.startswith("u"))
+    assert cache.get("不存在的用户") == (None, "unknown")
+    assert os.listdir(disk_dir) == []
+    assert cache.stats()["unknown"] == 1
+
+
+def test_disk_tier_keeps_most_recently_used(data_dir):
+    disk_dir = str(data_dir / "bundles")
+    cache = ContextBundleCache(disk_dir=disk_dir, max_bundles=1, max_disk_bundles=2)
+    for user in ("u1", "u2", "u3"):
+        cache.get(user)
+        path = os.path.join(disk_dir, f"{user}.json")
+        os.utime(path, (1000 + int(user[-1]), 1000 + int(user[-1])))
+    assert sorted(os.listdir(disk_dir)) == ["u2.json", "u3.json"]
+    stats = cache.stats()
+    assert stats["disk_entries"] == 2 and stats["disk_evictions"] == 1 and stats["entries"] == 1
+
+
+def test_missing_template_is_reported(data_dir):
+    os.remove("fashion_stylist_agent.md")
+    assert ContextBundleCache().get("u1") == (None, "missing")
+
+
+def test_bundle_prompt_matches_direct_rendering(data_dir):
+    bundle, _ = ContextBundleCache().get("u2")
+    expected = create_prompt_with_budget("通勤穿搭", bundle.body_data, bundle.wardrobe_data, bundle.weather_data,
+                                         bundle.stylist_template, budget=100000, layout="stable")
+    actual = create_prompt_from_bundle(bundle, "通勤穿搭", budget=100000, layout="stable")
+    assert actual[:2] == expected[:2]
+    # 令牌数按块分别估算再相加，与整体估算只有取整误差
+    assert abs(actual[2]["total_tokens"] - expected[2]["total_tokens"]) <= 5
+    assert actual[2]["context_hash"] == bundle.content_hash
+
+
+def test_filtered_wardrobe_is_cached_per_bundle(data_dir):
+    bundle, _ = ContextBundleCache().get("u1")
+    first = bundle.filtered_wardrobe("工作场合", "", 8, 3000)
+    assert bundle.filtered_wardrobe("工作场合", "", 8, 3000) is first
+    assert (bundle.filter_hits, bundle.filter_misses) == (1, 1)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""数据文件缓存：未变化时命中内存，修改时间或大小变化后重新加载"""
+
+import os
+
+import pytest
+
+from file_cache import FileCache
+
+
+def test_unchanged_file_is_served_from_memory(tmp_path, monkeypatch):
+    path = tmp_path / "user.md"
+    path.write_text("# 用户信息", encoding="utf-8")
+    cache = FileCache()
+    assert cache.read(str(path)) == "# 用户信息"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("文件未变化时不应重新打开")
+
+    monkeypatch.setattr("builtins.open", fail)
+    assert cache.read(str(path)) == "# 用户信息"
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"], stats["entries"]) == (1, 1, 1)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_changed_file_is_reloaded(tmp_path):
+    path = tmp_path / "weather.md"
+    path.write_text("晴", encoding="utf-8")
+    cache = FileCache()
+    cache.read(str(path))
+
+    path.write_text("多云转阴", encoding="utf-8")  # 大小变化
+    assert cache.read(str(path)) == "多云转阴"
+
+    path.write_text("小雨转阴", encoding="utf-8")  # 大小相同，修改时间变化
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert cache.read(str(path)) == "小雨转阴"
+    assert cache.stats()["reloads"] == 2
+
+
+def test_missing_file_raises_and_is_not_cached(tmp_path):
+    cache = FileCache()
+    path = tmp_path / "missing.md"
+    with pytest.raises(OSError):
+        cache.read(str(path))
+    assert cache.stats()["entries"] == 0
+    path.write_text("后来创建", encoding="utf-8")
+    assert cache.read(str(path)) == "后来创建"
+
+
+def test_invalidate(tmp_path):
+    a, b = tmp_path / "a.md", tmp_path / "b.md"
+    a.write_text("a", encoding="utf-8")
+    b.write_text("b", encoding="utf-8")
+    cache = FileCache()
+    cache.read(str(a))
+    cache.read(str(b))
+    cache.invalidate(str(a))
+    assert cache.stats()["entries"] == 1
+    cache.invalidate()
+    assert cache.stats()["entries"] == 0
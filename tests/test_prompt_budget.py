@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""提示词令牌预算：按优先级先压缩后截断，必需部分不动，以及自适应max_tokens"""
+
+from prompt_budget import (
+    PromptSection, apply_budget, estimate_tokens, truncate_to_tokens, summarize_markdown,
+    summarize_weather, adaptive_max_tokens, input_token_budget,
+)
+
+
+def lines(prefix, count):
+    return "\n".join(f"{prefix}第{i}行内容，这里是一些描述文字" for i in range(count))
+
+
+def sections():
+    template = "# 顾问\n" + lines("模板", 20) + "\n## 风格\n" + lines("风格", 20)
+    return [
+        PromptSection("query", "帮我搭配一套通勤穿搭", priority=100, required=True),
+        PromptSection("body_data", lines("个人", 30), priority=80),
+        PromptSection("wardrobe", lines("衣橱", 60), priority=60),
+        PromptSection("stylist_template", template, priority=40, summarizer=summarize_markdown),
+    ]
+
+
+def test_within_budget_changes_nothing():
+    parts = sections()
+    report = apply_budget(parts, budget=100000)
+    assert report["within_budget"]
+    assert all(info["action"] is None for info in report["sections"].values())
+
+
+def test_low_priority_sections_are_summarized_first():
+    parts = sections()
+    total = sum(part.tokens for part in parts)
+    template = parts[-1]
+    saving = template.original_tokens - estimate_tokens(summarize_markdown(template.text))
+    report = apply_budget(parts, budget=total - saving // 2)
+    actions = {name: info["action"] for name, info in report["sections"].items()}
+    assert actions == {"query": None, "body_data": None, "wardrobe": None, "stylist_template": "summarized"}
+    assert report["within_budget"]
+
+
+def test_truncation_follows_priority_and_spares_required_sections():
+    parts = sections()
+    by_name = {part.name: part for part in parts}
+    query_tokens = by_name["query"].tokens
+    body_tokens = by_name["body_data"].tokens
+    wardrobe_tokens = by_name["wardrobe"].tokens
+    # 模板压缩后仍超出预算：先截断衣橱（优先级60），个人信息（80）保持不变
+    budget = query_tokens + body_tokens + wardrobe_tokens // 2 + 30
+    report = apply_budget(parts, budget=budget)
+    actions = {name: info["action"] for name, info in report["sections"].items()}
+    assert actions["stylist_template"] in ("summarized", "truncated")
+    assert actions["wardrobe"] == "truncated"
+    assert actions["body_data"] is None
+    assert actions["query"] is None and by_name["query"].tokens == query_tokens
+    assert report["within_budget"]
+    assert report["total_tokens"] == sum(part.tokens for part in parts)
+
+
+def test_budget_below_required_sections_reports_overrun():
+    parts = sections()
+    report = apply_budget(parts, budget=1, overhead_tokens=10)
+    assert not report["within_budget"]
+    assert report["sections"]["query"]["action"] is None
+    assert report["total_tokens"] >= 10 + parts[0].tokens
+
+
+def test_zero_budget_means_unlimited():
+    report = apply_budget(sections(), budget=0)
+    assert report["within_budget"]
+    assert all(info["action"] is None for info in report["sections"].values())
+
+
+def test_truncate_keeps_whole_lines():
+    text = lines("行", 50)
+    truncated = truncate_to_tokens(text, 60)
+    assert estimate_tokens(truncated) <= 60
+    assert truncated.endswith("（内容过长，已截断）")
+    assert all(line in text.splitlines() for line in truncated.splitlines()[:-1])
+
+
+def test_summarize_weather_keeps_today():
+    text = "# 北京天气\n\n## 今日天气\n晴，2-8℃\n\n## 明日天气\n小雪\n"
+    assert summarize_weather(text) == "# 北京天气\n\n## 今日天气\n晴，2-8℃"
+
+
+def test_adaptive_max_tokens(monkeypatch):
+    monkeypatch.delenv("OUTPUT_EXPANSION_RATIO", raising=False)
+    monkeypatch.setenv("MIN_OUTPUT_TOKENS", "1000")
+    monkeypatch.setenv("MAX_OUTPUT_TOKENS", "4000")
+    monkeypatch.setenv("MODEL_CONTEXT_WINDOW", "65536")
+    assert adaptive_max_tokens(1000, 100) == 1000
+    assert adaptive_max_tokens(1000, 1000) == 2500
+    assert adaptive_max_tokens(1000, 10000) == 4000
+    assert adaptive_max_tokens(65536 - 256 - 300, 1000) == 300  # 受上下文窗口剩余空间限制
+
+
+def test_bad_environment_values_fall_back_to_defaults(monkeypatch):
+    monkeypatch.setenv("PROMPT_TOKEN_BUDGET", "不限")
+    monkeypatch.setenv("OUTPUT_EXPANSION_RATIO", "")
+    monkeypatch.delenv("MIN_OUTPUT_TOKENS", raising=False)
+    monkeypatch.delenv("MAX_OUTPUT_TOKENS", raising=False)
+    monkeypatch.delenv("MODEL_CONTEXT_WINDOW", raising=False)
+    assert input_token_budget() == 16000
+    assert adaptive_max_tokens(1000, 1000) == 2500
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""响应缓存：内存LRU、有效期、磁盘层的大小统计与淘汰，以及带缓存的客户端"""
+
+import os
+import time
+
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, CachedDeepseekClient, make_cache_key, get_response_cache
+
+
+def disk_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def test_cache_key_covers_all_parameters():
+    base = make_cache_key("m", "提示", 0.7, 100, 0.9)
+    assert base == make_cache_key("m", "提示", 0.7, 100, 0.9)
+    assert base != make_cache_key("m", "提示", 0.8, 100, 0.9)
+    assert base != make_cache_key("m", "提示", 0.7, 100, 0.9, system_prompt="系统")
+
+
+def test_memory_layer_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+    stats = cache.stats()
+    assert stats["memory_evictions"] == 1
+    assert stats["memory_hits"] == 3 and stats["misses"] == 1
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    cache = ResponseCache(ttl=10)
+    cache.set("k", "文本")
+    now[0] += 5
+    assert cache.contains("k") and cache.get("k") == "文本"
+    now[0] += 6
+    assert not cache.contains("k")
+    assert cache.get("k") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_disk_layer_survives_restart(tmp_path):
+    ResponseCache(disk_dir=str(tmp_path)).set("k", "磁盘中的回答")
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    assert cache.contains("k")
+    assert cache.get("k") == "磁盘中的回答"
+    assert cache.get("k") == "磁盘中的回答"
+    stats = cache.stats()
+    assert stats["disk_hits"] == 1 and stats["memory_hits"] == 1
+
+
+def test_rewriting_a_key_does_not_inflate_disk_bytes(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    for i in range(5):
+        cache.set("k", "回答" * (10 + i))
+    assert cache.stats()["disk_bytes"] == disk_size(tmp_path)
+
+
+def test_disk_layer_evicts_oldest_files_over_limit(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), disk_max_bytes=300)
+    for i in range(6):
+        cache.set(f"k{i}", "x" * 80)
+        os.utime(os.path.join(tmp_path, f"k{i}.json"), (1000 + i, 1000 + i))
+    stats = cache.stats()
+    assert stats["disk_evictions"] > 0
+    assert stats["disk_bytes"] == disk_size(tmp_path) <= 300
+    assert os.path.exists(os.path.join(tmp_path, "k5.json"))
+    assert not os.path.exists(os.path.join(tmp_path, "k0.json"))
+
+
+def test_contains_checks_disk_without_reading_files(tmp_path, monkeypatch):
+    ResponseCache(disk_dir=str(tmp_path), ttl=60).set("k", "回答")
+    cache = ResponseCache(disk_dir=str(tmp_path), ttl=60)
+
+    def fail(key):
+        raise AssertionError("contains()不应读取文件内容")
+
+    monkeypatch.setattr(cache, "_read_disk", fail)
+    assert cache.contains("k")
+    assert not cache.contains("missing")
+    old = time.time() - 120
+    os.utime(os.path.join(tmp_path, "k.json"), (old, old))
+    assert not cache.contains("k")
+
+
+def test_bad_environment_values_fall_back_to_defaults(monkeypatch):
+    monkeypatch.setattr(response_cache, "_default_cache", None)
+    monkeypatch.setenv("RESPONSE_CACHE_ENABLED", "true")
+    monkeypatch.setenv("RESPONSE_CACHE_SIZE", "很多")
+    monkeypatch.setenv("RESPONSE_CACHE_TTL", "")
+    monkeypatch.setenv("RESPONSE_CACHE_MAX_MB", "1O0")
+    monkeypatch.delenv("RESPONSE_CACHE_DIR", raising=False)
+    cache = get_response_cache()
+    assert (cache.max_entries, cache.ttl, cache.disk_max_bytes) == (256, 86400, 100 * 1024 * 1024)
+
+
+class FakeClient:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.calls = 0
+
+    def chat_stream(self, **kwargs):
+        self.calls += 1
+        yield from self.chunks
+
+
+def test_cached_client_replays_complete_answers():
+    upstream = FakeClient(["你好", "，", "世界"])
+    client = CachedDeepseekClient(upstream, ResponseCache(), replay_chunk_size=2)
+    assert "".join(client.chat_stream("提示")) == "你好，世界"
+    assert list(client.chat_stream("提示")) == ["你好", "，世", "界"]
+    assert upstream.calls == 1
+
+
+@pytest.mark.parametrize("chunks", [["部分", "\n[API错误: 超时]"], ["  "]])
+def test_cached_client_skips_errors_and_empty_answers(chunks):
+    upstream = FakeClient(chunks)
+    client = CachedDeepseekClient(upstream, ResponseCache())
+    list(client.chat_stream("提示"))
+    list(client.chat_stream("提示"))
+    assert upstream.calls == 2
+
+
+def test_abandoned_stream_is_not_cached():
+    upstream = FakeClient(["a", "b", "c"])
+    client = CachedDeepseekClient(upstream, ResponseCache())
+    stream = client.chat_stream("提示")
+    next(stream)
+    stream.close()
+    list(client.chat_stream("提示"))
+    assert upstream.calls == 2
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""访问者会话状态：签名Cookie的生成与校验，以及按访问者保存选定用户的接口"""
+
+import pytest
+
+import user_store
+from user_store import SqliteUserStore
+from session_state import SELECTION_COOKIE, sign_selection, read_selection
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setenv("SESSION_SECRET", "test-secret")
+
+
+@pytest.mark.parametrize("user_id", ["user1", "张三", "a.b.c", "x y/z"])
+def test_sign_and_read_round_trip(user_id):
+    assert read_selection(sign_selection(user_id)) == user_id
+
+
+def test_tampered_or_malformed_cookie_is_rejected():
+    cookie = sign_selection("user1")
+    value, signature = cookie.rsplit(".", 1)
+    assert read_selection(f"user2.{signature}") is None
+    assert read_selection(f"{value}.{signature[:-1]}x") is None
+    assert read_selection(value) is None
+    assert read_selection("") is None
+    assert read_selection(None) is None
+
+
+def test_secret_change_invalidates_cookie(monkeypatch):
+    cookie = sign_selection("user1")
+    monkeypatch.setenv("SESSION_SECRET", "rotated")
+    assert read_selection(cookie) is None
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    store = SqliteUserStore(str(tmp_path / "users.db"))
+    store.import_users([{"id": "u1", "name": "甲"}, {"id": "u2", "name": "乙"}])
+    monkeypatch.setattr(user_store, "_default_store", store)
+    webapp = pytest.importorskip("webapp")
+    yield webapp.app.test_client()
+    store.close()
+
+
+def test_selection_is_kept_per_visitor(client):
+    revision = user_store.get_user_store().revision()
+    response = client.post('/api/select-user', json={"user_id": "u2"})
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'private, no-store'
+    assert client.get('/api/session').get_json() == {"selected_user": "u2"}
+    assert user_store.get_user_store().revision() == revision  # 选择用户不写入存储
+
+    other = client.application.test_client()
+    assert other.get('/api/session').get_json() == {"selected_user": "u1"}
+
+
+def test_select_unknown_user_is_rejected(client):
+    response = client.post('/api/select-user', json={"user_id": "nobody"})
+    assert response.status_code == 404
+    assert SELECTION_COOKIE not in response.headers.get('Set-Cookie', '')
+
+
+def test_forged_cookie_falls_back_to_default_user(client):
+    client.set_cookie(SELECTION_COOKIE, "u2.forged")
+    assert client.get('/api/session').get_json() == {"selected_user": "u1"}
+
+
+def test_user_list_is_cacheable(client):
+    response = client.get('/api/users')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'].startswith('public')
+    assert "selected_user" not in response.get_json()
+    assert response.get_json()["default_user"] == "u1"
+
+    etag = response.headers['ETag']
+    assert client.get('/api/users', headers={"If-None-Match": etag}).status_code == 304
+
+    user_store.get_user_store().save_user({"id": "u3", "name": "丙"})
+    assert client.get('/api/users', headers={"If-None-Match": etag}).status_code == 200
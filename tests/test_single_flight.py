@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""相同请求合并：共享上游、慢订阅者移出、全部断开后取消上游"""
+
+import queue
+import threading
+
+import pytest
+
+from single_flight import StreamCoalescer, SubscriberLagError
+
+
+class FakeUpstream:
+    """由测试逐个放入片段的上游；放入None表示结束，放入异常表示上游出错"""
+
+    def __init__(self):
+        self.chunks = queue.Queue()
+        self.calls = 0
+        self.closed = threading.Event()
+        self.usage = None
+
+    def factory(self, on_usage):
+        self.calls += 1
+        return self._read(on_usage)
+
+    def _read(self, on_usage):
+        try:
+            while True:
+                item = self.chunks.get(timeout=5)
+                if item is None:
+                    if self.usage:
+                        on_usage(self.usage)
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.closed.set()
+
+    def feed(self, *items):
+        for item in items:
+            self.chunks.put(item)
+
+
+def test_identical_requests_share_one_upstream():
+    coalescer = StreamCoalescer()
+    upstream = FakeUpstream()
+    upstream.usage = {"total_tokens": 7}
+    usages = []
+
+    first = coalescer.stream("k", upstream.factory, on_usage=usages.append)
+    upstream.feed("你好")
+    assert next(first) == "你好"
+    assert coalescer.is_joinable("k")
+
+    second = coalescer.stream("k", upstream.factory, on_usage=usages.append)
+    assert next(second) == "你好"  # 中途加入先收到已缓冲的内容
+    upstream.feed("，世界", None)
+    assert list(first) == ["，世界"]
+    assert list(second) == ["，世界"]
+
+    assert upstream.calls == 1
+    assert usages == [{"total_tokens": 7}, {"total_tokens": 7}]
+    stats = coalescer.stats()
+    assert stats["upstream_streams"] == 1
+    assert stats["coalesced_subscribers"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_upstream_error_reaches_every_subscriber():
+    coalescer = StreamCoalescer()
+    upstream = FakeUpstream()
+    first = coalescer.stream("k", upstream.factory)
+    upstream.feed("a")
+    assert next(first) == "a"
+    second = coalescer.stream("k", upstream.factory)
+    assert next(second) == "a"
+
+    upstream.feed(ConnectionError("断开"))
+    with pytest.raises(ConnectionError):
+        next(first)
+    with pytest.raises(ConnectionError):
+        next(second)
+
+
+def test_lagging_subscriber_is_dropped():
+    coalescer = StreamCoalescer(max_buffer_chars=5)
+    upstream = FakeUpstream()
+    fast = coalescer.stream("k", upstream.factory)
+    upstream.feed("aaa")
+    assert next(fast) == "aaa"
+    slow = coalescer.stream("k", upstream.factory)
+    assert next(slow) == "aaa"
+
+    for _ in range(3):
+        upstream.feed("bbb")
+        assert next(fast) == "bbb"
+
+    with pytest.raises(SubscriberLagError):
+        next(slow)
+    assert not coalescer.is_joinable("k")  # 缓冲区已裁剪，新请求不再加入
+
+    upstream.feed(None)
+    assert list(fast) == []
+    assert coalescer.stats()["lagging_subscribers"] == 1
+
+
+def test_new_request_after_trim_starts_new_upstream():
+    coalescer = StreamCoalescer(max_buffer_chars=4)
+    upstream = FakeUpstream()
+    first = coalescer.stream("k", upstream.factory)
+    upstream.feed("abc")
+    assert next(first) == "abc"
+    upstream.feed("de")
+    assert next(first) == "de"
+    assert not coalescer.is_joinable("k")
+
+    other = FakeUpstream()
+    second = coalescer.stream("k", other.factory)
+    other.feed("abc", None)
+    assert list(second) == ["abc"]
+    assert other.calls == 1
+
+    upstream.feed(None)
+    assert list(first) == []
+
+
+def test_last_subscriber_leaving_cancels_upstream():
+    coalescer = StreamCoalescer()
+    upstream = FakeUpstream()
+    subscriber = coalescer.stream("k", upstream.factory)
+    upstream.feed("a")
+    assert next(subscriber) == "a"
+
+    subscriber.close()
+    # 立即注销：相同的新请求发起新的上游请求，而不是加入已取消的流
+    stats = coalescer.stats()
+    assert stats["cancelled_streams"] == 1
+    assert stats["in_flight"] == 0
+    assert not coalescer.is_joinable("k")
+
+    upstream.feed("b")  # 后台线程收到下一个片段后关闭上游连接
+    assert upstream.closed.wait(2.0)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""增量SSE解析：任意切分的字节块、三种换行、多行data和字段，以及增量文本的快速提取"""
+
+import json
+import random
+
+import pytest
+
+from sse_parser import SSEParser, DEFAULT_EVENT, fast_delta_content
+from deepseek_client import _parse_event_data
+
+
+def chunk_json(content):
+    return json.dumps({"choices": [{"index": 0, "delta": {"content": content}}]}, ensure_ascii=False)
+
+
+QUOTED = '世界，带引号"和换行\n'
+
+STREAM = (
+    ": 保活注释\n"
+    "retry: 3000\n"
+    "\n"
+    f"data: {chunk_json('你好')}\n"
+    "\n"
+    "id: 7\n"
+    "event: ping\n"
+    "data:第一行\n"
+    "data: 第二行\n"
+    "data\n"
+    "\n"
+    f"data: {chunk_json(QUOTED)}\n"
+    "unknown: 被忽略\n"
+    "\n"
+    "data: [DONE]\n"
+    "\n"
+)
+
+EXPECTED = [
+    (DEFAULT_EVENT, chunk_json("你好"), None),
+    ("ping", "第一行\n第二行\n", "7"),
+    (DEFAULT_EVENT, chunk_json(QUOTED), "7"),
+    (DEFAULT_EVENT, "[DONE]", "7"),
+]
+
+
+def parse(data, sizes):
+    """按sizes给出的长度切分data后依次送入解析器"""
+    parser = SSEParser()
+    events = []
+    pos = 0
+    for size in sizes:
+        events.extend(parser.feed(data[pos:pos + size]))
+        pos += size
+    events.extend(parser.feed(data[pos:]))
+    events.extend(parser.close())
+    return [(event.event, event.data, event.id) for event in events]
+
+
+def random_sizes(data, rng):
+    sizes = []
+    remaining = len(data)
+    while remaining > 0:
+        size = min(remaining, rng.randint(1, 12))
+        sizes.append(size)
+        remaining -= size
+    return sizes
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n", "\r"])
+def test_whole_stream(newline):
+    data = STREAM.replace("\n", newline).encode("utf-8")
+    assert parse(data, []) == EXPECTED
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n", "\r"])
+def test_random_chunk_splits(newline):
+    data = STREAM.replace("\n", newline).encode("utf-8")
+    rng = random.Random(newline)
+    for _ in range(200):
+        assert parse(data, random_sizes(data, rng)) == EXPECTED
+
+
+def test_every_single_split_point():
+    for newline in ["\n", "\r\n", "\r"]:
+        data = STREAM.replace("\n", newline).encode("utf-8")
+        for cut in range(1, len(data)):
+            assert parse(data, [cut]) == EXPECTED, (newline, cut)
+
+
+def test_mixed_line_endings():
+    data = "data: a\r\n\r\ndata: b\n\ndata: c\r\rdata: d\r\n\n".encode("utf-8")
+    assert [event[1] for event in parse(data, [1] * len(data))] == ["a", "b", "c", "d"]
+
+
+def test_cr_at_chunk_end_waits_for_next_chunk():
+    parser = SSEParser()
+    assert parser.feed(b"data: a\r") == []
+    assert [event.data for event in parser.feed(b"\n\r\n")] == ["a"]
+
+
+def test_close_dispatches_unterminated_event():
+    parser = SSEParser()
+    assert parser.feed(b"data: tail") == []
+    assert [event.data for event in parser.close()] == ["tail"]
+
+
+def test_retry_is_reported():
+    parser = SSEParser()
+    events = parser.feed(b"retry: 1500\ndata: x\n\n")
+    assert events[0].retry == 1500
+
+
+@pytest.mark.parametrize("content", ["普通文本", 'a"b', "back\\slash", "换行\n制表\t", "\\\"", ""])
+def test_fast_delta_content_matches_json(content):
+    for data in (chunk_json(content), json.dumps(json.loads(chunk_json(content)), separators=(",", ":"))):
+        assert fast_delta_content(data) == content
+
+
+def test_fast_delta_content_falls_back_for_uncommon_chunks():
+    assert fast_delta_content('{"choices":[{"delta":{"role":"assistant"}}]}') is None
+    with_usage = '{"choices":[{"delta":{"content":"x"}}],"usage":{"total_tokens":3}}'
+    assert fast_delta_content(with_usage) is None
+    assert _parse_event_data(with_usage) == (False, "x", {"total_tokens": 3})
+    assert _parse_event_data("[DONE]") == (True, None, None)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+"""流式传输协议：事件编码、Last-Event-ID解析，以及客户端断开后的断点续传"""
+
+import json
+import time
+import asyncio
+import threading
+
+import pytest
+
+from stream_protocol import (
+    EVENT_STATUS, EVENT_DELTA, EVENT_DONE, EVENT_ERROR, StreamSession, StreamRegistry,
+    format_sse, format_ndjson, negotiate_format, parse_last_event_id,
+    encode_events, encode_events_async, resume_events, resume_events_async,
+)
+
+
+def parse_ndjson(frames):
+    return [json.loads(frame) for frame in frames if frame.strip()]
+
+
+def delta_events(count, delay=0.0, closed=None):
+    """产生count个delta事件和done事件；closed为threading.Event时在序列被关闭后设置"""
+    try:
+        for i in range(count):
+            if delay:
+                time.sleep(delay)
+            yield EVENT_DELTA, {"text": str(i)}
+        yield EVENT_DONE, {"message": "完成"}
+    finally:
+        if closed is not None:
+            closed.set()
+
+
+async def delta_events_async(count, delay=0.0, closed=None):
+    try:
+        for i in range(count):
+            await asyncio.sleep(delay)
+            yield EVENT_DELTA, {"text": str(i)}
+        yield EVENT_DONE, {"message": "完成"}
+    finally:
+        if closed is not None:
+            closed.set()
+
+
+def test_format_sse_and_ndjson():
+    assert format_sse("s:1", EVENT_DELTA, {"text": "你好"}) == 'id: s:1\nevent: delta\ndata: {"text": "你好"}\n\n'
+    line = format_ndjson("s:2", EVENT_STATUS, {"message": "x"})
+    assert line.endswith("\n")
+    assert json.loads(line) == {"id": "s:2", "event": "status", "data": {"message": "x"}}
+
+
+@pytest.mark.parametrize("accept, requested, expected", [
+    (None, None, "sse"),
+    ("text/event-stream", None, "sse"),
+    ("application/x-ndjson", None, "ndjson"),
+    ("application/jsonl, */*", None, "ndjson"),
+    ("application/x-ndjson", "sse", "sse"),
+    (None, "unknown", "sse"),
+])
+def test_negotiate_format(accept, requested, expected):
+    assert negotiate_format(accept, requested) == expected
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id("abc:12") == ("abc", 12)
+    assert parse_last_event_id(" abc:3 ") == ("abc", 3)
+    assert parse_last_event_id("abc") is None
+    assert parse_last_event_id("abc:x") is None
+    assert parse_last_event_id(None) is None
+
+
+def test_live_stream_encodes_all_events():
+    session = StreamSession("live")
+    events = parse_ndjson(encode_events(session, delta_events(3), format_ndjson))
+    assert [event["event"] for event in events] == ["delta", "delta", "delta", "done"]
+    assert [event["id"] for event in events] == ["live:1", "live:2", "live:3", "live:4"]
+    assert session.finished and session.complete
+
+
+def test_resume_after_disconnect_receives_remaining_events():
+    session = StreamSession("s", resume_grace=5.0)
+    live = encode_events(session, delta_events(20, delay=0.01), format_ndjson)
+    received = [json.loads(next(live)) for _ in range(3)]
+    live.close()  # 客户端断开，生产方继续生成
+
+    last_seq = parse_last_event_id(received[-1]["id"])[1]
+    resumed = parse_ndjson(resume_events(session, last_seq, format_ndjson))
+    texts = [event["data"]["text"] for event in received + resumed if event["event"] == EVENT_DELTA]
+    assert texts == [str(i) for i in range(20)]
+    assert resumed[-1]["event"] == EVENT_DONE
+    assert session.complete
+
+
+def test_producer_stops_when_nobody_resumes():
+    closed = threading.Event()
+    session = StreamSession("s", resume_grace=0.05)
+    live = encode_events(session, delta_events(1000, delay=0.005, closed=closed), format_ndjson)
+    next(live)
+    live.close()
+
+    assert closed.wait(2.0)
+    assert session.finished and not session.complete
+    late = parse_ndjson(resume_events(session, 1, format_ndjson))
+    assert late[-1]["event"] == EVENT_ERROR
+    assert late[-1]["data"]["resumable"] is False
+
+
+def test_resume_of_dropped_events_reports_error():
+    session = StreamSession("s", max_events=2)
+    for i in range(5):
+        session.append(EVENT_DELTA, {"text": str(i)})
+    session.finish(True)
+    events = parse_ndjson(resume_events(session, 1, format_ndjson))
+    assert len(events) == 1
+    assert events[0]["event"] == EVENT_ERROR and events[0]["data"]["resumable"] is False
+
+
+def test_registry_expires_sessions():
+    registry = StreamRegistry(ttl=0.0, resume_grace=10.0)
+    session = registry.create()
+    assert session.resume_grace == 0.0  # 等待重连的时间不超过流记录的保留时间
+    time.sleep(0.01)
+    assert registry.get(session.stream_id) is None
+
+
+def test_async_resume_after_disconnect():
+    async def run():
+        session = StreamSession("a", resume_grace=5.0)
+        live = encode_events_async(session, delta_events_async(10, delay=0.005), format_ndjson)
+        received = [json.loads(await live.__anext__()) for _ in range(2)]
+        await live.aclose()
+
+        last_seq = parse_last_event_id(received[-1]["id"])[1]
+        resumed = [json.loads(frame) async for frame in resume_events_async(session, last_seq, format_ndjson)]
+        return received + resumed
+
+    events = asyncio.run(run())
+    assert [event["data"]["text"] for event in events if event["event"] == EVENT_DELTA] == \
+        [str(i) for i in range(10)]
+    assert events[-1]["event"] == EVENT_DONE
+
+
+def test_async_producer_cancelled_after_grace():
+    async def run():
+        closed = threading.Event()
+        session = StreamSession("a", resume_grace=0.05)
+        live = encode_events_async(session, delta_events_async(1000, delay=0.01, closed=closed), format_ndjson)
+        await live.__anext__()
+        await live.aclose()
+        await asyncio.wait_for(session.producer, 2.0)
+        return session, closed
+
+    session, closed = asyncio.run(run())
+    assert closed.is_set()
+    assert session.finished and not session.complete
+
+
+def test_stalled_upstream_is_abandoned_on_time():
+    stall = threading.Event()
+    closed = threading.Event()
+
+    def stalled_events():
+        try:
+            yield EVENT_DELTA, {"text": "0"}
+            stall.wait(5)  # 上游停顿，没有新片段
+            yield EVENT_DELTA, {"text": "1"}
+        finally:
+            closed.set()
+
+    session = StreamSession("s", resume_grace=0.05)
+    live = encode_events(session, stalled_events(), format_ndjson)
+    next(live)
+    live.close()
+
+    started = time.monotonic()
+    with session._cond:
+        session._cond.wait_for(lambda: session.finished, 2.0)
+    assert session.finished and not session.complete
+    assert time.monotonic() - started < 1.0  # 不等上游的下一个片段
+
+    stall.set()
+    assert closed.wait(2.0)  # 读取线程随后关闭上游
+    assert [event for _, event, _ in session._events] == [EVENT_DELTA]
+
+
+def test_slow_stream_sends_heartbeats_instead_of_ending():
+    def slow_events():
+        yield EVENT_DELTA, {"text": "0"}
+        time.sleep(0.2)
+        yield EVENT_DONE, {"message": "完成"}
+
+    session = StreamSession("s")
+    frames = list(encode_events(session, slow_events(), format_ndjson, "HB\n", 0.02))
+    assert "HB\n" in frames
+    events = parse_ndjson(frame for frame in frames if frame != "HB\n")
+    assert [event["event"] for event in events] == [EVENT_DELTA, EVENT_DONE]
+
+
+def test_interrupted_frame_carries_last_delivered_id():
+    session = StreamSession("s")
+    session.append(EVENT_DELTA, {"text": "0"})
+    session.append(EVENT_DELTA, {"text": "1"})
+    session.finish(False)
+
+    events = parse_ndjson(resume_events(session, 0, format_ndjson))
+    assert events[-1]["event"] == EVENT_ERROR
+    assert events[-1]["id"] == "s:2"  # 携带它重连不会重复收到已送达的事件
+
+    async def collect():
+        return [json.loads(frame) async for frame in resume_events_async(session, 1, format_ndjson)]
+
+    events = asyncio.run(collect())
+    assert [event["id"] for event in events] == ["s:2", "s:2"]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""流式输出的片段合并：按大小和截止时间发送，上游停顿时缓冲的内容也按时发出"""
+
+import time
+import queue
+import asyncio
+import threading
+
+import pytest
+
+from stream_utils import coalesce_chunks, coalesce_chunks_async, split_text
+
+
+def queued_chunks(source, closed=None):
+    """从队列读取片段的上游，放入None表示结束，放入异常表示上游出错"""
+    try:
+        while True:
+            item = source.get(timeout=5)
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        if closed is not None:
+            closed.set()
+
+
+def test_small_chunks_are_merged_by_size():
+    frames = list(coalesce_chunks(iter(["ab"] * 10), max_bytes=6, max_delay=10.0))
+    assert frames == ["ababab", "ababab", "ababab", "ab"]
+
+
+def test_no_coalescing_when_delay_disabled():
+    assert list(coalesce_chunks(iter(["a", "b"]), max_bytes=256, max_delay=0)) == ["a", "b"]
+
+
+def test_buffered_text_is_flushed_when_upstream_stalls():
+    source = queue.Queue()
+    frames = coalesce_chunks(queued_chunks(source), max_bytes=1000, max_delay=0.05)
+    source.put("首")
+    assert next(frames) == "首"  # 距上次发送已超过时间窗口，直接发出
+
+    source.put("a")
+    source.put("b")
+    started = time.monotonic()
+    assert next(frames) == "ab"  # 上游之后停顿，缓冲的内容在截止时间发出
+    assert time.monotonic() - started < 1.0
+
+    source.put(None)
+    assert list(frames) == []
+
+
+def test_upstream_error_is_raised_after_buffered_text():
+    source = queue.Queue()
+    frames = coalesce_chunks(queued_chunks(source), max_bytes=1000, max_delay=10.0)
+    source.put("a")
+    source.put(ConnectionError("断开"))
+    assert next(frames) == "a"
+    with pytest.raises(ConnectionError):
+        next(frames)
+
+
+def test_closing_stops_background_reader():
+    source = queue.Queue()
+    closed = threading.Event()
+    frames = coalesce_chunks(queued_chunks(source, closed), max_bytes=1, max_delay=10.0)
+    source.put("a")
+    assert next(frames) == "a"
+    frames.close()
+    source.put("b")  # 后台线程在下一个片段到达时关闭上游
+    assert closed.wait(2.0)
+
+
+async def async_chunks(items, pause_after=None, pause=0.0):
+    for index, item in enumerate(items):
+        yield item
+        if index == pause_after:
+            await asyncio.sleep(pause)
+
+
+def test_async_buffered_text_is_flushed_when_upstream_stalls():
+    async def run():
+        frames = coalesce_chunks_async(async_chunks(["首", "a", "b", "c"], pause_after=2, pause=0.3),
+                                       max_bytes=1000, max_delay=0.05)
+        received = []
+        started = time.monotonic()
+        async for frame in frames:
+            received.append((frame, time.monotonic() - started))
+        return received
+
+    received = asyncio.run(run())
+    assert [frame for frame, _ in received] == ["首ab", "c"]
+    assert received[0][1] < 0.25  # 没有等到上游停顿结束
+
+
+def test_async_close_closes_upstream():
+    closed = []
+
+    async def upstream():
+        try:
+            while True:
+                yield "x"
+                await asyncio.sleep(0.01)
+        finally:
+            closed.append(True)
+
+    async def run():
+        frames = coalesce_chunks_async(upstream(), max_bytes=1, max_delay=10.0)
+        assert await frames.__anext__() == "x"
+        await frames.aclose()
+
+    asyncio.run(run())
+    assert closed == [True]
+
+
+def test_split_text():
+    assert list(split_text("abcdefg", 3)) == ["abc", "def", "g"]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""请求链路：span的父子关系、Server-Timing，以及后台导出器"""
+
+import json
+import threading
+
+import pytest
+
+from tracing import RequestTrace, activate, span, propagation_headers, JsonLinesExporter, _BackgroundExporter
+
+
+def test_nested_spans_and_headers():
+    trace = RequestTrace("req-1")
+    with activate(trace):
+        with span("load") as outer:
+            with span("read_file") as inner:
+                headers = propagation_headers()
+    assert inner.parent_id == outer.span_id and outer.parent_id == trace.root.span_id
+    assert headers == {"X-Request-ID": "req-1", "traceparent": f"00-{trace.trace_id}-{inner.span_id}-01"}
+    assert trace.server_timing().startswith("load;dur=")
+    assert set(trace.summary()["stages"]) == {"load", "read_file"}
+
+
+def test_span_without_trace_records_nothing():
+    with span("idle") as current:
+        assert current is None
+    assert propagation_headers() == {}
+
+
+def test_json_lines_exporter_writes_each_span(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    exporter = JsonLinesExporter(str(path))
+    trace = RequestTrace("req-2")
+    trace.record("stage", 0.0, 0.01)
+    trace.finish()
+    exporter.submit(trace)
+    exporter.close()
+    lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [line["name"] for line in lines] == ["request", "stage"]
+
+
+def test_exporter_must_implement_export():
+    class Incomplete(_BackgroundExporter):
+        pass
+
+    before = threading.active_count()
+    with pytest.raises(TypeError):
+        Incomplete()
+    assert threading.active_count() == before  # 不会启动后台线程
+
+
+def test_export_errors_do_not_stop_the_exporter():
+    failed = threading.Event()
+
+    class Flaky(_BackgroundExporter):
+        def __init__(self):
+            self.exported = []
+            super().__init__()
+
+        def export(self, traces):
+            if not failed.is_set():
+                failed.set()
+                raise OSError("写入失败")
+            self.exported.extend(trace.request_id for trace in traces)
+
+    exporter = Flaky()
+    exporter.submit(RequestTrace("a"))
+    assert failed.wait(2.0)
+    exporter.submit(RequestTrace("b"))
+    exporter.close()
+    assert exporter.exported == ["b"]
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""用户存储：连接池上限、按行写入，以及其他实例写入后的增量读取"""
+
+import threading
+
+import pytest
+
+from user_store import UserStore, SqliteUserStore, JsonUserStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SqliteUserStore(str(tmp_path / "users.db"), pool_size=4)
+    store.import_users([{"id": f"u{i}", "name": f"用户{i}"} for i in range(10)])
+    yield store
+    store.close()
+
+
+def test_short_lived_threads_do_not_leak_connections(store):
+    errors = []
+
+    def request(index):
+        try:
+            assert store.get_user(f"u{index % 10}") is not None
+            store.list_users(0, 5)
+            if index % 20 == 0:
+                store.update_user("u0", {"visits": index})
+        except Exception as e:  # 线程中的断言失败交给主线程报告
+            errors.append(e)
+
+    for batch in range(10):
+        threads = [threading.Thread(target=request, args=(batch * 20 + i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+    assert errors == []
+    stats = store.stats()
+    assert stats["connections"] <= 4
+    assert stats["idle_connections"] == stats["connections"]
+
+
+def test_write_updates_single_row(store):
+    revision = store.revision()
+    store.update_user("u3", {"name": "新名字"})
+    assert store.revision() == revision + 1
+    assert store.get_user("u3")["name"] == "新名字"
+    assert store.get_user("u4")["name"] == "用户4"
+    assert [user["id"] for user in store.list_users(0, 3)[0]] == ["u0", "u1", "u2"]
+
+
+def test_other_instance_reads_changes_incrementally(store, tmp_path):
+    other = SqliteUserStore(str(tmp_path / "users.db"))
+    try:
+        assert other.get_user("u1")["name"] == "用户1"
+        store.update_user("u1", {"name": "改名"})
+        store.save_user({"id": "u10", "name": "新用户"})
+        assert other.get_user("u1")["name"] == "改名"
+        assert other.count() == 11
+        assert other.stats()["incremental_reloads"] == 1
+    finally:
+        other.close()
+
+
+def test_json_store_round_trip(tmp_path):
+    store = JsonUserStore(str(tmp_path / "users.json"))
+    store.import_users([{"id": "a", "name": "甲"}])
+    store.set_setting("selected_user", "a")
+    reopened = JsonUserStore(str(tmp_path / "users.json"))
+    assert reopened.get_user("a")["name"] == "甲"
+    assert reopened.get_setting("selected_user") == "a"
+
+
+def test_backend_must_implement_storage_hooks():
+    class Incomplete(UserStore):
+        def _current_revision(self):
+            return 0
+
+        def _load_snapshot(self):
+            return None
+
+    with pytest.raises(TypeError, match="_write"):
+        Incomplete()
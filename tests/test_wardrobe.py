@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""衣橱数据处理：Markdown表格解析、二级索引查询和按场景季节的筛选"""
+
+import os
+
+from wardrobe import Wardrobe, parse_wardrobe, get_wardrobe, filter_wardrobe, filter_settings, season_from_weather
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WARDROBE = """# 测试衣橱
+
+## 1. 上装
+
+| 二级分类 | 衣服名称 | 主色调 | 适合季节 | 适合场景 | 特征描述 |
+|----------|----------|--------|---------|----------|----------|
+| **1.1 外套** | 羊毛大衣 | 黑■ | 秋冬 | 职场/通勤 | 双排扣，及膝长度 |
+| | 牛仔夹克 | 蓝■ | 春秋 | 休闲/街拍 | 水洗做旧 |
+| 1.2 T恤 | 纯棉T恤 | 白■/灰■ | 夏 | 休闲/日常 | 圆领短袖 |
+| | 亚麻衬衫 | 米■ | 夏 | 职场/度假 | 透气
+| | 羊绒毛衣 | 驼■ | 冬 | 职场/约会 | 高领 |
+
+## 2. 下装
+
+| 二级分类 | 衣服名称 | 主色调 | 适合季节 | 适合场景 | 特征描述 |
+|----------|----------|--------|---------|----------|----------|
+| 2.1 长裤 | 直筒西裤 | 深灰■ | 四季 | 商务/职场 | 九分 |
+| 2.2 短裤 | 百慕大短裤 | 卡其■ | 夏 | 休闲/周末 | 及膝 |
+
+## 配饰
+
+| 二级分类 | 配饰名称 | 主色调 | 适合季节 | 适合场景 | 特征描述 |
+|----------|----------|--------|---------|----------|----------|
+| 包袋 | 托特包 | 棕■ | 四季 | 通勤 | 皮革，大容量 |
+| 围巾 | 格纹围巾 | 红■ | 冬 | 日常 | 羊毛 |
+"""
+
+
+def test_parse_wardrobe():
+    items = parse_wardrobe(WARDROBE)
+    assert [item.name for item in items] == [
+        "羊毛大衣", "牛仔夹克", "纯棉T恤", "亚麻衬衫", "羊绒毛衣", "直筒西裤", "百慕大短裤", "托特包", "格纹围巾"]
+    coat = items[0]
+    assert (coat.category, coat.subcategory) == ("上装", "1.1 外套")
+    assert items[1].subcategory == "1.1 外套"  # 空的二级分类沿用上一行
+    assert coat.season_set == {"秋", "冬"}
+    assert coat.scene_tags == ("职场", "通勤")
+    assert items[2].color_tags == ("白", "灰")
+    assert items[3].description == "透气"  # 行尾缺少"|"
+    assert items[5].season_set == {"春", "夏", "秋", "冬"}
+    assert items[7].category == "包袋"
+    assert items[8].category == "配饰"
+
+
+def test_query_intersects_indexes():
+    wardrobe = Wardrobe(parse_wardrobe(WARDROBE))
+    assert [item.name for item in wardrobe.query(category="上装", season="秋冬", scene="职场")] == ["羊毛大衣"]
+    assert [item.name for item in wardrobe.query(color="灰")] == ["纯棉T恤"]  # 有完全相同的标签时只精确匹配
+    assert [item.name for item in wardrobe.query(color="深")] == ["直筒西裤"]
+    assert [item.name for item in wardrobe.query(category="上装", subcategory="外套")] == ["羊毛大衣", "牛仔夹克"]
+    assert [item.name for item in wardrobe.query(category="下装", any_season={"夏"})] == ["直筒西裤", "百慕大短裤"]
+    assert wardrobe.query(category="上装", scene="不存在") == []
+    assert wardrobe.categories() == ["上装", "下装", "包袋", "配饰"]
+
+
+def test_get_wardrobe_parses_each_version_once():
+    assert get_wardrobe(WARDROBE) is get_wardrobe(WARDROBE)
+    assert len(get_wardrobe(WARDROBE + "\n")) == len(get_wardrobe(WARDROBE))
+
+
+def test_season_from_weather():
+    weather = "# 天气\n\n## 今日天气\n气温：2-8℃\n\n## 明日天气\n气温：30℃\n"
+    assert season_from_weather(weather) == {"冬"}
+    assert season_from_weather("气温：28℃") == {"夏"}
+    assert season_from_weather("晴") == set()
+
+
+def test_filter_keeps_most_relevant_items_per_category():
+    text = filter_wardrobe(WARDROBE, scenario="工作场合", query="", top_n=1, seasons={"冬"})
+    assert "羊毛大衣" in text  # 当季且场景匹配
+    assert "直筒西裤" in text
+    assert "百慕大短裤" not in text
+    assert "纯棉T恤" not in text
+    assert "从9件单品中筛选出最相关的4件" in text
+
+
+def test_filter_prefers_in_season_items_over_scene_matches():
+    # 亚麻衬衫的场景匹配（职场）不能让过季单品挤掉当季单品
+    text = filter_wardrobe(WARDROBE, scenario="工作场合", query="", top_n=2, seasons={"冬"})
+    assert "羊毛大衣" in text and "羊绒毛衣" in text
+    assert "亚麻衬衫" not in text
+
+
+def test_filter_fills_category_with_out_of_season_items():
+    text = filter_wardrobe(WARDROBE, scenario="休闲日常", query="", top_n=2, seasons={"冬"})
+    assert "直筒西裤" in text and "百慕大短裤" in text  # 下装只有一件当季单品
+
+
+def test_filter_shrinks_to_token_budget():
+    wide = filter_wardrobe(WARDROBE, scenario="工作场合", top_n=5)
+    narrow = filter_wardrobe(WARDROBE, scenario="工作场合", top_n=5, token_budget=1)
+    assert len(narrow) < len(wide)
+    assert narrow.count("| ") < wide.count("| ")
+
+
+def test_unparseable_wardrobe_is_returned_unchanged():
+    assert filter_wardrobe("没有表格的衣橱") == "没有表格的衣橱"
+
+
+def test_query_text_ranks_matching_items_first():
+    text = filter_wardrobe(WARDROBE, query="想穿牛仔夹克", top_n=1, seasons=set())
+    assert "牛仔夹克" in text and "羊毛大衣" not in text
+
+
+def test_query_scene_keywords_apply_without_scenario():
+    text = filter_wardrobe(WARDROBE, query="周末休闲", top_n=1, seasons=set())
+    assert "百慕大短裤" in text and "直筒西裤" not in text
+
+
+def test_real_wardrobes_fit_budget_and_keep_every_category():
+    for user in ["user1", "user2", "user3", "user4", "user5"]:
+        with open(os.path.join(ROOT, "users", user, "wardrobe.md"), encoding="utf-8") as file:
+            data = file.read()
+        wardrobe = get_wardrobe(data)
+        text = filter_wardrobe(data, scenario="工作场合", seasons={"秋"}, top_n=8, token_budget=3000)
+        assert len(text) < len(data)
+        for category in wardrobe.categories():
+            assert f"## {category}" in text
+
+
+def test_filter_settings_fall_back_on_bad_values(monkeypatch):
+    monkeypatch.setenv("WARDROBE_FILTER_ENABLED", "no")
+    monkeypatch.setenv("WARDROBE_TOP_N", "八")
+    monkeypatch.setenv("WARDROBE_TOKEN_BUDGET", "2000")
+    assert filter_settings() == (False, 8, 2000)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+请求链路追踪
+把一次穿搭建议请求拆分为若干阶段（span）：加载用户数据、构建提示词、排队、连接上游、
+等待首个令牌、SSE解析、向客户端推送等，记录每个阶段的耗时、字节数和令牌数。
+请求ID和W3C traceparent会随上游请求一起发送，完成的链路可以写入JSON Lines文件，
+或以OTLP/HTTP JSON格式发送到本地的OpenTelemetry Collector。
+
+环境变量:
+    TRACE_EXPORTER: none（默认）、jsonl或otlp
+    TRACE_FILE: jsonl导出的文件路径，默认traces.jsonl
+    OTEL_EXPORTER_OTLP_ENDPOINT: otlp导出的Collector地址，默认http://localhost:4318
+"""
+
+import os
+import abc
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Generator
+
+from app_logging import get_logger
+
+logger = get_logger("tracing")
+
+SERVICE_NAME = "stylist4deepseek"
+
+# 当前线程（或协程）正在处理的请求链路和活动的span
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("stylist_trace", default=None)
+_current_span: contextvars.ContextVar = contextvars.ContextVar("stylist_span", default=None)
+
+
+class Span:
+    """一个阶段的耗时和属性"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "wall_start", "attributes", "status")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 start: Optional[float] = None, attributes: Optional[Dict[str, Any]] = None):
+        """
+        参数:
+            name: 阶段名称，如"upstream.connect"
+            trace_id: 所属链路ID（32位十六进制）
+            parent_id: 父span的ID
+            start: 开始时间（time.monotonic()），为None时取当前时间
+            attributes: 初始属性
+        """
+        now = time.monotonic()
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = now if start is None else start
+        # 导出时需要的墙钟时间，按单调时钟的差值换算
+        self.wall_start = time.time() - (now - self.start)
+        self.end: Optional[float] = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = "ok"
+
+    def set(self, **attributes) -> "Span":
+        """设置属性"""
+        self.attributes.update(attributes)
+        return self
+
+    def finish(self, end: Optional[float] = None, error: Optional[BaseException] = None) -> None:
+        """结束span，重复调用时保留第一次的结束时间"""
+        if self.end is not None:
+            return
+        self.end = time.monotonic() if end is None else end
+        if error is not None:
+            self.status = "error"
+            self.attributes["error"] = f"{type(error).__name__}: {error}"
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end if self.end is not None else time.monotonic()
+        return round((end - self.start) * 1000, 1)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.wall_start, 6),
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class RequestTrace:
+    """一个请求的全部span"""
+
+    def __init__(self, request_id: Optional[str] = None, name: str = "request"):
+        """
+        参数:
+            request_id: 请求ID，为None时生成；客户端通过X-Request-ID传入时沿用
+            name: 根span的名称
+        """
+        self.trace_id = uuid.uuid4().hex
+        self.request_id = (request_id or self.trace_id[:16])[:64]
+        self.root = Span(name, self.trace_id, attributes={"request_id": self.request_id})
+        self._spans: List[Span] = [self.root]
+        self._lock = threading.Lock()
+        self.exported = False
+
+    def start_span(self, name: str, parent: Optional[Span] = None, start: Optional[float] = None,
+                   **attributes) -> Span:
+        """
+        开始一个span（不会成为当前span，适合在生成器中手动结束）
+
+        参数:
+            name: 阶段名称
+            parent: 父span，为None时取当前活动的span或根span
+            start: 开始时间（time.monotonic()），用于补记已经发生的阶段
+        """
+        if parent is None:
+            parent = _current_span.get()
+            if parent is None or parent.trace_id != self.trace_id:
+                parent = self.root
+        span = Span(name, self.trace_id, parent.span_id, start, attributes)
+        with self._lock:
+            self._spans.append(span)
+        return span
+
+    def record(self, name: str, start: float, end: float, parent: Optional[Span] = None, **attributes) -> Span:
+        """补记一个已经结束的阶段"""
+        span = self.start_span(name, parent, start, **attributes)
+        span.finish(end)
+        return span
+
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        汇总各阶段耗时（同名阶段相加），用于流末尾的timing事件
+
+        返回:
+            {"request_id", "total_ms", "stages": {阶段名: 毫秒}}，以及根span上记录的属性
+        """
+        stages: Dict[str, float] = {}
+        for span in self.spans():
+            if span is self.root:
+                continue
+            stages[span.name] = round(stages.get(span.name, 0.0) + span.duration_ms, 1)
+        summary = {key: value for key, value in self.root.attributes.items() if key != "request_id"}
+        summary.update({"request_id": self.request_id, "total_ms": self.root.duration_ms, "stages": stages})
+        return summary
+
+    def server_timing(self) -> str:
+        """已结束阶段的Server-Timing响应头"""
+        parts = []
+        for span in self.spans():
+            if span is not self.root and span.end is not None:
+                parts.append(f"{span.name.replace('.', '-')};dur={span.duration_ms}")
+        return ", ".join(parts)
+
+    def finish(self, error: Optional[BaseException] = None, **attributes) -> None:
+        """结束根span并导出整条链路（只导出一次）"""
+        self.root.set(**attributes)
+        self.root.finish(error=error)
+        with self._lock:
+            if self.exported:
+                return
+            self.exported = True
+        exporter = get_exporter()
+        if exporter is not None:
+            exporter.submit(self)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    """当前的请求链路，没有时返回None"""
+    return _current_trace.get()
+
+
+@contextmanager
+def activate(trace: Optional[RequestTrace]) -> Generator[Optional[RequestTrace], None, None]:
+    """在代码块内把trace设为当前链路"""
+    token = _current_trace.set(trace)
+    span_token = _current_span.set(trace.root if trace is not None else None)
+    try:
+        yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Generator[Optional[Span], None, None]:
+    """
+    记录一个阶段，代码块内的子阶段自动以它为父span
+
+    没有当前链路时不做任何记录，返回None；在代码块中可以通过返回的span设置属性:
+        with span("load_user_data") as s:
+            ...
+            if s: s.set(bytes=total)
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.finish(error=e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.finish()
+
+
+def propagation_headers(parent: Optional[Span] = None) -> Dict[str, str]:
+    """
+    发往上游的请求头：X-Request-ID和W3C traceparent，没有当前链路时为空
+
+    需要在发起请求的线程中调用（对冲请求的工作线程没有调用方的上下文）
+
+    参数:
+        parent: 作为上游父span的span，为None时取当前活动的span
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return {}
+    parent = parent or _current_span.get() or trace.root
+    return {
+        "X-Request-ID": trace.request_id,
+        "traceparent": f"00-{trace.trace_id}-{parent.span_id}-01",
+    }
+
+
+class _BackgroundExporter(abc.ABC):
+    """在后台线程中导出完成的链路，请求线程只负责放入队列；子类实现export"""
+
+    def __init__(self, max_queue: int = 1000):
+        self._queue: "queue.Queue[Optional[RequestTrace]]" = queue.Queue(max_queue)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, trace: RequestTrace) -> None:
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            traces = [trace for trace in batch if trace is not None]
+            if traces:
+                try:
+                    self.export(traces)
+                except Exception as e:
+                    logger.warning("导出链路失败: %s", e)
+            if stop:
+                return
+
+    @abc.abstractmethod
+    def export(self, traces: List[RequestTrace]) -> None:
+        """在后台线程中导出一批链路，抛出的异常只记录日志"""
+
+    def close(self) -> None:
+        """导出队列中剩余的链路后停止"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+
+class JsonLinesExporter(_BackgroundExporter):
+    """每个span写为一行JSON"""
+
+    def __init__(self, path: str):
+        self.path = path
+        super().__init__()
+
+    def export(self, traces: List[RequestTrace]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for trace in traces:
+                for span in trace.spans():
+                    f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpExporter(_BackgroundExporter):
+    """以OTLP/HTTP JSON格式发送到OpenTelemetry Collector（/v1/traces）"""
+
+    def __init__(self, endpoint: str):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        super().__init__()
+
+    def export(self, traces: List[RequestTrace]) -> None:
+        import requests  # 仅otlp导出需要
+
+        spans = []
+        for trace in traces:
+            for span in trace.spans():
+                start_ns = int(span.wall_start * 1e9)
+                end_ns = start_ns + int(span.duration_ms * 1e6)
+                entry = {
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    "name": span.name,
+                    "kind": 2 if span.parent_id is None else 1,  # SERVER / INTERNAL
+                    "startTimeUnixNano": str(start_ns),
+                    "endTimeUnixNano": str(end_ns),
+                    "attributes": [{"key": key, "value": _otlp_value(value)}
+                                   for key, value in span.attributes.items() if value is not None],
+                    "status": {"code": 2 if span.status == "error" else 1},
+                }
+                if span.parent_id:
+                    entry["parentSpanId"] = span.parent_id
+                spans.append(entry)
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "stylist.tracing"}, "spans": spans}],
+        }]}
+        response = requests.post(self.url, json=body, timeout=5)
+        if response.status_code >= 300:
+            logger.warning("Collector返回%d: %s", response.status_code, response.text[:200])
+
+
+# 进程级导出器，按环境变量配置
+_exporter: Optional[_BackgroundExporter] = None
+_exporter_configured = False
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> Optional[_BackgroundExporter]:
+    """
+    获取进程级链路导出器
+
+    返回:
+        JsonLinesExporter或OtlpExporter；TRACE_EXPORTER为none（默认）时返回None
+    """
+    global _exporter, _exporter_configured
+    if not _exporter_configured:
+        with _exporter_lock:
+            if not _exporter_configured:
+                kind = os.environ.get("TRACE_EXPORTER", "none").lower()
+                if kind == "jsonl":
+                    _exporter = JsonLinesExporter(os.environ.get("TRACE_FILE", "traces.jsonl"))
+                elif kind == "otlp":
+                    _exporter = OtlpExporter(os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"))
+                _exporter_configured = True
+    return _exporter
@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+用户存储
+保存用户资料（users.json中的users列表）和少量全局设置（如默认用户selected_user），提供分页查询和按用户的原子更新。
+
+两种后端:
+    sqlite  嵌入式SQLite数据库（默认，USER_DB_PATH），WAL模式下读写互不阻塞，多个进程可以同时使用；
+            首次使用且数据库为空时自动从users.json和users/<用户ID>/目录迁移
+    json    原有的users.json文件，写入时整体替换（先写临时文件再重命名），只适合单进程和少量用户
+
+两种后端的读取都走内存快照：每次写入都会增加数据修订号，读取时只比较修订号（SQLite为一次按主键的查询，
+json为一次stat），没有变化就直接使用内存中的列表，不重新解析。SQLite的每一行也记录最后修改它的修订号，
+写入只在快照上替换修改过的行，其他进程写入后也只读取修订号更大的行，写入的开销与用户总数无关。
+
+用法:
+    python user_store.py migrate --db users.db --users-json users.json
+    python user_store.py stats
+"""
+
+import os
+import abc
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Tuple, Iterable, Iterator
+
+from app_logging import get_logger, fields
+
+logger = get_logger("user_store")
+
+# /api/users默认每页返回的用户数和允许的最大值
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class _Snapshot:
+    """某个修订号下的全部用户和设置；写入和增量加载通过apply()原地替换修改过的行"""
+
+    __slots__ = ("revision", "users", "index", "settings")
+
+    def __init__(self, revision: int, users: List[Dict[str, Any]], settings: Dict[str, Any]):
+        self.revision = revision
+        self.users = users
+        self.index = {user["id"]: position for position, user in enumerate(users)}
+        self.settings = settings
+
+    def apply(self, revision: int, users: Iterable[Dict[str, Any]], settings: Dict[str, Any]) -> None:
+        """替换已有用户、按顺序追加新用户并更新设置，修订号更新为revision（调用方需持有存储的锁）"""
+        for user in users:
+            position = self.index.get(user["id"])
+            if position is None:
+                self.index[user["id"]] = len(self.users)
+                self.users.append(user)
+            else:
+                self.users[position] = user
+        self.settings.update(settings)
+        self.revision = revision
+
+
+class _Changes:
+    """一次写入中的修改：按ID读取当前的用户，记录新增或替换的用户和修改的设置"""
+
+    def __init__(self, snapshot: _Snapshot):
+        self.snapshot = snapshot
+        self.users: Dict[str, Dict[str, Any]] = {}
+        self.settings: Dict[str, Any] = {}
+
+    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        if user_id in self.users:
+            return self.users[user_id]
+        position = self.snapshot.index.get(user_id)
+        return None if position is None else self.snapshot.users[position]
+
+    def put_user(self, user: Dict[str, Any]) -> None:
+        self.users[user["id"]] = user
+
+    def set_setting(self, key: str, value: Any) -> None:
+        self.settings[key] = value
+
+
+class UserStore(abc.ABC):
+    """
+    用户存储接口
+
+    读取方法返回的用户字典来自内存快照，调用方不应修改；需要修改时使用update_user或save_user。
+    """
+
+    backend = ""
+
+    def __init__(self):
+        self._snapshot_cache: Optional[_Snapshot] = None
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "reloads": 0, "incremental_reloads": 0, "writes": 0}
+
+    # 以下三个方法由各后端实现
+    @abc.abstractmethod
+    def _current_revision(self) -> int:
+        """读取存储中的当前修订号"""
+
+    @abc.abstractmethod
+    def _load_snapshot(self) -> _Snapshot:
+        """从存储中读取全部用户和设置"""
+
+    @abc.abstractmethod
+    def _write(self, mutate) -> Any:
+        """
+        在一次原子写入中执行mutate(changes)，changes为基于最新快照的_Changes
+
+        返回:
+            mutate的返回值
+        """
+
+    def _load_changes(self, since: int) -> Optional[Tuple[int, List[Dict[str, Any]], Dict[str, Any]]]:
+        """
+        读取修订号since之后修改过的用户（按加入顺序）和设置，不支持增量读取的后端返回None
+
+        返回:
+            (当前修订号, 用户列表, 设置)
+        """
+        return None
+
+    def _snapshot(self) -> _Snapshot:
+        revision = self._current_revision()
+        with self._lock:
+            snapshot = self._snapshot_cache
+            if snapshot is not None and snapshot.revision == revision:
+                self._stats["hits"] += 1
+                return snapshot
+        if snapshot is not None and snapshot.revision < revision:
+            update = self._load_changes(snapshot.revision)
+            if update is not None:
+                with self._lock:
+                    self._stats["incremental_reloads"] += 1
+                    # 并发的增量加载读到的是同一段修改的超集，重复应用结果相同
+                    if self._snapshot_cache is snapshot and update[0] > snapshot.revision:
+                        snapshot.apply(*update)
+                return snapshot
+        snapshot = self._load_snapshot()
+        with self._lock:
+            self._stats["reloads"] += 1
+            if self._snapshot_cache is None or snapshot.revision >= self._snapshot_cache.revision:
+                self._snapshot_cache = snapshot
+        return snapshot
+
+    def revision(self) -> int:
+        """数据修订号，每次写入后增大（可用作用户列表的版本标识）"""
+        return self._snapshot().revision
+
+    def count(self) -> int:
+        return len(self._snapshot().users)
+
+    def list_users(self, offset: int = 0, limit: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        分页查询用户
+
+        参数:
+            offset: 跳过的用户数
+            limit: 最多返回的用户数，为None时返回offset之后的全部用户
+
+        返回:
+            (本页用户列表, 用户总数)
+        """
+        users = self._snapshot().users
+        offset = max(0, offset)
+        end = len(users) if limit is None else offset + max(0, limit)
+        return users[offset:end], len(users)
+
+    def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
+        snapshot = self._snapshot()
+        position = snapshot.index.get(user_id)
+        return None if position is None else snapshot.users[position]
+
+    def get_setting(self, key: str, default: Any = None) -> Any:
+        return self._snapshot().settings.get(key, default)
+
+    def save_user(self, user: Dict[str, Any]) -> None:
+        """新增用户或整体替换同ID用户的资料"""
+        if not user.get("id"):
+            raise ValueError("用户资料缺少id")
+
+        self._write(lambda changes: changes.put_user(dict(user)))
+
+    def update_user(self, user_id: str, changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        原子地修改一个用户的部分字段
+
+        返回:
+            修改后的用户资料；用户不存在时返回None
+        """
+        changes = {key: value for key, value in changes.items() if key != "id"}
+
+        def mutate(pending):
+            existing = pending.get_user(user_id)
+            if existing is None:
+                return None
+            updated = {**existing, **changes}
+            pending.put_user(updated)
+            return updated
+
+        return self._write(mutate)
+
+    def import_users(self, users: Iterable[Dict[str, Any]], overwrite: bool = False) -> int:
+        """
+        批量导入用户（用于迁移）
+
+        参数:
+            users: 用户资料列表
+            overwrite: 为False时跳过已存在的用户
+
+        返回:
+            新增或替换的用户数
+        """
+        incoming = [dict(user) for user in users if user.get("id")]
+
+        def mutate(changes):
+            imported = 0
+            for user in incoming:
+                if overwrite or changes.get_user(user["id"]) is None:
+                    changes.put_user(user)
+                    imported += 1
+            return imported
+
+        return self._write(mutate)
+
+    def set_setting(self, key: str, value: Any) -> None:
+        self._write(lambda changes: changes.set_setting(key, value))
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot()
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(backend=self.backend, users=len(snapshot.users), revision=snapshot.revision)
+        return stats
+
+    def close(self) -> None:
+        pass
+
+
+class JsonUserStore(UserStore):
+    """
+    基于users.json的用户存储（原有格式）
+    修订号为文件的修改时间；写入时在进程内加锁，先写临时文件再替换，其他进程不会读到写了一半的文件。
+    """
+
+    backend = "json"
+
+    def __init__(self, path: str = "users.json"):
+        super().__init__()
+        self.path = path
+        self._write_lock = threading.Lock()
+
+    def _current_revision(self) -> int:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _load_snapshot(self) -> _Snapshot:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                revision = os.fstat(f.fileno()).st_mtime_ns
+                data = json.load(f)
+        except FileNotFoundError:
+            return _Snapshot(0, [], {})
+        users = [user for user in data.pop("users", []) if user.get("id")]
+        return _Snapshot(revision, users, data)
+
+    def _write(self, mutate) -> Any:
+        with self._write_lock:
+            snapshot = self._load_snapshot()
+            changes = _Changes(snapshot)
+            result = mutate(changes)
+            snapshot.apply(snapshot.revision, changes.users.values(), changes.settings)
+            users, settings = snapshot.users, snapshot.settings
+
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"users": users, **settings}, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            with self._lock:
+                self._stats["writes"] += 1
+                self._snapshot_cache = None  # 修改时间的精度有限，不依赖它判断本进程的写入
+        return result
+
+
+class SqliteUserStore(UserStore):
+    """
+    基于SQLite的用户存储
+    连接放在有上限的连接池中，每次读写时借用、用完归还，线程退出不会留下连接；WAL模式下读取不会被写入阻塞。用户资料以JSON保存，按加入顺序排列，id上有唯一索引。
+    每次写入在同一个事务中增加meta表中的修订号，并把修改过的行的rev设为新的修订号：
+    本进程的写入直接替换内存快照中的对应行，其他进程写入后只读取rev大于快照修订号的行。
+    """
+
+    backend = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            seq INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            profile TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            rev INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            rev INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+    """
+
+    def __init__(self, path: str = "users.db", busy_timeout: float = 5.0, pool_size: int = 8):
+        """
+        参数:
+            path: 数据库文件路径
+            busy_timeout: 等待其他进程释放写锁的最长秒数
+            pool_size: 连接池大小，同时使用数据库的线程超过该数量时等待空闲连接
+        """
+        super().__init__()
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.pool_size = max(1, pool_size)
+        self._local = threading.local()
+        self._idle: List[sqlite3.Connection] = []
+        self._created = 0
+        self._closed = False
+        self._pool_cond = threading.Condition()
+        with self._connection() as conn:
+            conn.executescript(self.SCHEMA)
+            # 早期版本创建的数据库没有rev列，补上后原有的行视为修订号0
+            for table in ("users", "settings"):
+                columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if "rev" not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS users_rev ON users (rev)")
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        从连接池借用一个连接，用完归还；同一线程内的嵌套调用（如写事务中读取快照）沿用同一个连接
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._checkin(conn)
+
+    def _checkout(self) -> sqlite3.Connection:
+        with self._pool_cond:
+            while not self._idle and self._created >= self.pool_size:
+                self._pool_cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            # isolation_level=None：不自动开启事务，写入时显式使用BEGIN IMMEDIATE；
+            # 连接会被不同线程借用（同一时间只有一个），因此关闭同线程检查
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        except BaseException:
+            with self._pool_cond:
+                self._created -= 1
+                self._pool_cond.notify()
+            raise
+        return conn
+
+    def _checkin(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")  # 异常中断的读事务
+        with self._pool_cond:
+            if self._closed:
+                self._created -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._pool_cond.notify()
+
+    def _current_revision(self) -> int:
+        with self._connection() as conn:
+            return conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def _load_snapshot(self) -> _Snapshot:
+        with self._connection() as conn:
+            # 在同一个读事务中读取修订号、用户和设置，三者一致（写入时已处于写事务中）
+            own_transaction = not conn.in_transaction
+            if own_transaction:
+                conn.execute("BEGIN")
+            try:
+                revision = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+                users = []
+                for user_id, profile in conn.execute("SELECT id, profile FROM users ORDER BY seq"):
+                    user = json.loads(profile)
+                    user["id"] = user_id
+                    users.append(user)
+                settings = {key: json.loads(value)
+                            for key, value in conn.execute("SELECT key, value FROM settings")}
+            finally:
+                if own_transaction:
+                    conn.execute("COMMIT")
+            return _Snapshot(revision, users, settings)
+
+    def _load_changes(self, since: int) -> Tuple[int, List[Dict[str, Any]], Dict[str, Any]]:
+        with self._connection() as conn:
+            own_transaction = not conn.in_transaction
+            if own_transaction:
+                conn.execute("BEGIN")
+            try:
+                revision = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+                users = []
+                rows = conn.execute("SELECT id, profile FROM users WHERE rev > ? ORDER BY seq", (since,))
+                for user_id, profile in rows:
+                    user = json.loads(profile)
+                    user["id"] = user_id
+                    users.append(user)
+                settings = {key: json.loads(value)
+                            for key, value in conn.execute("SELECT key, value FROM settings WHERE rev > ?", (since,))}
+            finally:
+                if own_transaction:
+                    conn.execute("COMMIT")
+            return revision, users, settings
+
+    def _write(self, mutate) -> Any:
+        # 写事务持有写锁，期间读到的快照就是写入前的最新状态（其他进程的修改已增量加载）
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                snapshot = self._snapshot()
+                changes = _Changes(snapshot)
+                result = mutate(changes)
+                revision = snapshot.revision + 1
+
+                now = time.time()
+                for user in changes.users.values():
+                    profile = json.dumps({key: value for key, value in user.items() if key != "id"}, ensure_ascii=False)
+                    conn.execute("INSERT INTO users (id, profile, updated_at, rev) VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT(id) DO UPDATE SET profile = excluded.profile, "
+                                 "updated_at = excluded.updated_at, rev = excluded.rev",
+                                 (user["id"], profile, now, revision))
+                for key, value in changes.settings.items():
+                    conn.execute("INSERT OR REPLACE INTO settings (key, value, rev) VALUES (?, ?, ?)",
+                                 (key, json.dumps(value, ensure_ascii=False), revision))
+                conn.execute("UPDATE meta SET value = ? WHERE key = 'revision'", (revision,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        with self._lock:
+            self._stats["writes"] += 1
+            # 提交后其他线程可能已增量加载了这次修改，此时不再重复应用
+            if self._snapshot_cache is snapshot and snapshot.revision == revision - 1:
+                snapshot.apply(revision, changes.users.values(), changes.settings)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        with self._pool_cond:
+            stats.update(connections=self._created, idle_connections=len(self._idle))
+        return stats
+
+    def close(self) -> None:
+        """关闭空闲连接；正在使用的连接在归还时关闭"""
+        with self._pool_cond:
+            self._closed = True
+            for conn in self._idle:
+                conn.close()
+            self._created -= len(self._idle)
+            self._idle.clear()
+
+
+def migrate_from_json(store: UserStore, users_path: str = "users.json", users_dir: str = "users",
+                      overwrite: bool = False) -> Dict[str, int]:
+    """
+    把users.json中的用户和设置，以及users/<用户ID>/目录中未登记的用户导入存储
+
+    重复执行是安全的：默认跳过已存在的用户和设置，多个进程同时迁移时结果相同。
+
+    参数:
+        store: 目标存储
+        users_path: users.json路径
+        users_dir: 用户数据目录，其中每个子目录对应一个用户
+        overwrite: 为True时用users.json中的资料替换已存在的用户
+
+    返回:
+        {"imported": 新增或替换的用户数, "directories": 只有数据目录、按目录名登记的用户数}
+    """
+    users: List[Dict[str, Any]] = []
+    settings: Dict[str, Any] = {}
+    if os.path.exists(users_path):
+        with open(users_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        users = [user for user in data.pop("users", []) if user.get("id")]
+        settings = data
+
+    known = {user["id"] for user in users}
+    directories = []
+    if os.path.isdir(users_dir):
+        for name in sorted(os.listdir(users_dir)):
+            if name not in known and os.path.isdir(os.path.join(users_dir, name)):
+                directories.append({"id": name, "name": name})
+
+    imported = store.import_users(users + directories, overwrite=overwrite)
+    for key, value in settings.items():
+        if overwrite or store.get_setting(key) is None:
+            store.set_setting(key, value)
+    logger.info("已迁移用户数据", extra=fields(backend=store.backend, imported=imported,
+                                                directories=len(directories), total=store.count()))
+    return {"imported": imported, "directories": len(directories)}
+
+
+def page_settings(offset: Optional[str], limit: Optional[str]) -> Tuple[int, int]:
+    """
+    解析分页参数（查询字符串中的offset和limit）
+
+    返回:
+        (offset, limit)，limit缺省为USERS_PAGE_SIZE，不超过MAX_PAGE_SIZE
+    """
+    try:
+        offset_value = max(0, int(offset)) if offset else 0
+    except ValueError:
+        offset_value = 0
+    try:
+        default = int(os.environ.get("USERS_PAGE_SIZE", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        default = DEFAULT_PAGE_SIZE
+    try:
+        limit_value = int(limit) if limit else default
+    except ValueError:
+        limit_value = default
+    return offset_value, min(max(1, limit_value), MAX_PAGE_SIZE)
+
+
+# 进程级用户存储，按环境变量配置
+_default_store: Optional[UserStore] = None
+_store_lock = threading.Lock()
+
+
+def get_user_store() -> UserStore:
+    """
+    获取进程级用户存储
+
+    返回:
+        USER_STORE为json时返回JsonUserStore（users.json），否则返回SqliteUserStore（USER_DB_PATH，
+        连接池大小USER_DB_POOL_SIZE）；
+        SQLite数据库为空时先从users.json和users/目录迁移
+    """
+    global _default_store
+    if _default_store is None:
+        with _store_lock:
+            if _default_store is None:
+                if os.environ.get("USER_STORE", "sqlite").lower() == "json":
+                    store = JsonUserStore(os.environ.get("USERS_JSON_PATH", "users.json"))
+                else:
+                    try:
+                        pool_size = int(os.environ.get("USER_DB_POOL_SIZE", 8))
+                    except ValueError:
+                        pool_size = 8
+                    store = SqliteUserStore(os.environ.get("USER_DB_PATH", "users.db"), pool_size=pool_size)
+                    if store.count() == 0:
+                        migrate_from_json(store, os.environ.get("USERS_JSON_PATH", "users.json"))
+                _default_store = store
+    return _default_store
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="用户存储管理")
+    parser.add_argument("command", choices=["migrate", "stats"], help="migrate: 从users.json导入；stats: 查看统计")
+    parser.add_argument("--db", default=os.environ.get("USER_DB_PATH", "users.db"), help="SQLite数据库路径")
+    parser.add_argument("--users-json", default=os.environ.get("USERS_JSON_PATH", "users.json"),
+                        help="users.json路径")
+    parser.add_argument("--users-dir", default="users", help="用户数据目录")
+    parser.add_argument("--overwrite", action="store_true", help="用users.json中的资料替换已存在的用户")
+    args = parser.parse_args()
+
+    store = SqliteUserStore(args.db)
+    try:
+        if args.command == "migrate":
+            result = migrate_from_json(store, args.users_json, args.users_dir, overwrite=args.overwrite)
+            print(f"已导入 {result['imported']} 个用户（其中 {result['directories']} 个只有数据目录），"
+                  f"共 {store.count()} 个用户")
+        else:
+            print(json.dumps(store.stats(), ensure_ascii=False, indent=2))
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+衣橱数据处理
+解析wardrobe.md中的Markdown表格并建立按类别、季节、场景和颜色的索引；
+经索引取出当季单品，按场景、天气季节和用户需求打分，每个类别只保留最相关的若干件，
+在令牌预算内生成精简的衣橱文本用于提示词。
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from file_cache import file_cache
+from prompt_budget import estimate_tokens
+
+# 一级分类标题 -> 筛选时使用的类别
+CATEGORY_ALIASES = {
+    "上装": "上装",
+    "下装": "下装",
+    "连体服饰": "连体",
+    "鞋靴": "鞋履",
+    "鞋履": "鞋履",
+    "配饰": "配饰",
+}
+
+# 输出时的类别顺序
+CATEGORY_ORDER = ["上装", "下装", "连体", "鞋履", "包袋", "配饰"]
+
+# 界面中的场景选项 -> 衣橱"适合场景"列中的相关关键词
+SCENARIO_KEYWORDS = {
+    "工作场合": ["职场", "通勤", "商务", "办公", "正式"],
+    "约会": ["约会", "晚宴", "聚会", "浪漫"],
+    "休闲日常": ["休闲", "日常", "居家", "校园", "街拍", "周末"],
+    "重要会议": ["正式", "商务", "职场", "会议", "重要场合"],
+    "户外活动": ["户外", "运动", "旅行", "度假", "露营", "徒步", "骑行"],
+    "派对": ["派对", "晚宴", "聚会", "庆典", "节日"],
+}
+
+SEASONS = ["春", "夏", "秋", "冬"]
+
+
+def _bigrams(text: str) -> Set[str]:
+    text = re.sub(r"\s+", "", text or "")
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class WardrobeItem:
+    """衣橱中的一件单品（使用__slots__减少内存占用，解析时预先计算查询用字段）"""
+
+    __slots__ = ("category", "subcategory", "name", "color", "seasons", "scenes", "description",
+                 "season_set", "scene_tags", "color_tags", "bigrams")
+
+    def __init__(self, category: str, subcategory: str, name: str, color: str, seasons: str,
+                 scenes: str, description: str):
+        self.category = category
+        self.subcategory = subcategory
+        self.name = name
+        self.color = color
+        self.seasons = seasons
+        self.scenes = scenes
+        self.description = description
+        # 适合的季节集合，"四季"展开为全部季节
+        if "四季" in seasons:
+            self.season_set = frozenset(SEASONS)
+        else:
+            self.season_set = frozenset(s for s in SEASONS if s in seasons)
+        self.scene_tags = tuple(tag.strip() for tag in scenes.split("/") if tag.strip())
+        self.color_tags = tuple(tag.replace("■", "").strip() for tag in color.split("/") if tag.replace("■", "").strip())
+        self.bigrams = frozenset(_bigrams(name + color + scenes + description))
+
+    def to_row(self) -> str:
+        """渲染为Markdown表格行"""
+        return f"| {self.subcategory} | {self.name} | {self.color} | {self.seasons} | {self.scenes} | {self.description} |"
+
+    def __repr__(self) -> str:
+        return f"WardrobeItem({self.category}/{self.subcategory}: {self.name}, {self.color}, {self.seasons}, {self.scenes})"
+
+
+class Wardrobe:
+    """
+    带二级索引的衣橱模型
+
+    按类别、季节、场景和颜色建立索引，查询时对索引集合求交集，
+    无需再扫描整份衣橱文本。
+    """
+
+    def __init__(self, items: List[WardrobeItem], title: str = "# 用户衣橱清单"):
+        """
+        参数:
+            items: 单品列表
+            title: 衣橱标题行
+        """
+        self.items = tuple(items)
+        self.title = title
+        self.by_category: Dict[str, Set[int]] = {}
+        self.by_season: Dict[str, Set[int]] = {}
+        self.by_scene: Dict[str, Set[int]] = {}
+        self.by_color: Dict[str, Set[int]] = {}
+        for index, item in enumerate(self.items):
+            self.by_category.setdefault(item.category, set()).add(index)
+            for season in item.season_set:
+                self.by_season.setdefault(season, set()).add(index)
+            for tag in item.scene_tags:
+                self.by_scene.setdefault(tag, set()).add(index)
+            for tag in item.color_tags:
+                self.by_color.setdefault(tag, set()).add(index)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    @staticmethod
+    def _lookup(index: Dict[str, Set[int]], value: str) -> Set[int]:
+        # 先精确匹配；没有时匹配包含该值的索引键（如"职场"匹配"职场/正式场合"拆出的标签）
+        if value in index:
+            return index[value]
+        matched = set()
+        for key, positions in index.items():
+            if value in key:
+                matched |= positions
+        return matched
+
+    def query(self, category: Optional[str] = None, season: Optional[str] = None, scene: Optional[str] = None,
+              color: Optional[str] = None, subcategory: Optional[str] = None,
+              any_season: Optional[Set[str]] = None) -> List[WardrobeItem]:
+        """
+        按条件查询单品，多个条件之间为"且"的关系
+
+        参数:
+            category: 类别（上装/下装/连体/鞋履/包袋/配饰）
+            season: 季节，可以是多个季节字符（如"秋冬"表示同时适合秋季和冬季）
+            scene: 场景关键词（如"职场"）
+            color: 颜色关键词（如"黑"）
+            subcategory: 二级分类关键词（如"外套"）
+            any_season: 季节集合，适合其中任一季节即可（如根据天气推断出的{"春", "秋"}）
+
+        返回:
+            符合条件的单品列表，按文件中的顺序排列
+        """
+        candidates: Optional[Set[int]] = None
+
+        def narrow(positions: Set[int]) -> None:
+            nonlocal candidates
+            candidates = set(positions) if candidates is None else candidates & positions
+
+        if category:
+            narrow(self.by_category.get(category, set()))
+        if season:
+            for char in season:
+                if char in SEASONS:
+                    narrow(self.by_season.get(char, set()))
+        if scene:
+            narrow(self._lookup(self.by_scene, scene))
+        if color:
+            narrow(self._lookup(self.by_color, color))
+        if any_season:
+            narrow(set().union(*(self.by_season.get(char, set()) for char in any_season)))
+
+        positions = range(len(self.items)) if candidates is None else sorted(candidates)
+        result = [self.items[i] for i in positions]
+        if subcategory:
+            result = [item for item in result if subcategory in item.subcategory]
+        return result
+
+    def categories(self) -> List[str]:
+        """按输出顺序列出衣橱中出现的类别"""
+        return [c for c in CATEGORY_ORDER if c in self.by_category] + \
+            [c for c in self.by_category if c not in CATEGORY_ORDER]
+
+
+def _split_row(line: str) -> List[str]:
+    # 兼容行尾缺少"|"的情况
+    cells = line.strip().strip("|").split("|")
+    return [cell.strip() for cell in cells]
+
+
+def parse_wardrobe(text: str) -> List[WardrobeItem]:
+    """
+    解析衣橱Markdown文本
+
+    参数:
+        text: wardrobe.md的内容
+
+    返回:
+        单品列表，按文件中的顺序排列
+    """
+    items = []
+    category = None
+    subcategory = ""
+    for line in text.splitlines():
+        line = line.strip()
+        heading = re.match(r"^##\s*(?:\d+\.\s*)?(.+)$", line)
+        if heading:
+            title = heading.group(1).strip()
+            category = CATEGORY_ALIASES.get(title, title)
+            subcategory = ""
+            continue
+        if not line.startswith("|") or category is None:
+            continue
+
+        cells = _split_row(line)
+        # 跳过表头和分隔行
+        if len(cells) < 6 or cells[1] in ("衣服名称", "鞋靴名称", "配饰名称") or re.fullmatch(r"[-: ]+", cells[1]):
+            continue
+        if cells[0]:
+            subcategory = cells[0].replace("*", "").strip()
+
+        item_category = category
+        if category == "配饰" and "包" in subcategory:
+            item_category = "包袋"
+        items.append(WardrobeItem(item_category, subcategory, cells[1], cells[2], cells[3], cells[4],
+                                  "|".join(cells[5:]).strip()))
+    return items
+
+
+# 已解析的衣橱模型，以衣橱文本为键：文件未变化时FileCache返回同一个字符串对象，
+# 其哈希值已被缓存，查找开销与文本长度无关
+_wardrobe_cache: "OrderedDict[str, Wardrobe]" = OrderedDict()
+_wardrobe_cache_size = 32
+_wardrobe_lock = threading.Lock()
+
+
+def get_wardrobe(text: str) -> Wardrobe:
+    """
+    获取衣橱文本对应的索引模型，每个文件版本只解析一次
+
+    参数:
+        text: wardrobe.md的内容
+
+    返回:
+        Wardrobe对象
+    """
+    with _wardrobe_lock:
+        wardrobe = _wardrobe_cache.get(text)
+        if wardrobe is not None:
+            _wardrobe_cache.move_to_end(text)
+            return wardrobe
+
+    title = next((line for line in text.splitlines() if line.startswith("# ")), "# 用户衣橱清单")
+    wardrobe = Wardrobe(parse_wardrobe(text), title=title)
+    with _wardrobe_lock:
+        _wardrobe_cache[text] = wardrobe
+        while len(_wardrobe_cache) > _wardrobe_cache_size:
+            _wardrobe_cache.popitem(last=False)
+    return wardrobe
+
+
+def load_wardrobe(file_path: str) -> Wardrobe:
+    """读取衣橱文件（经由文件缓存）并返回索引模型"""
+    return get_wardrobe(file_cache.read(file_path))
+
+
+def season_from_weather(weather_data: Optional[str]) -> Set[str]:
+    """
+    根据天气数据推断当前季节
+
+    取"今日"段落（没有时取全文）中的温度，按平均值映射到季节。
+
+    返回:
+        季节集合，无法判断时返回空集合
+    """
+    if not weather_data:
+        return set()
+    section = weather_data
+    match = re.search(r"^##[^\n]*今日[^\n]*\n(.*?)(?=^## |\Z)", weather_data, re.S | re.M)
+    if match:
+        section = match.group(1)
+    temps = [int(t) for t in re.findall(r"(-?\d+)(?:-\d+)?℃", section)]
+    if not temps:
+        return set()
+
+    average = sum(temps) / len(temps)
+    if average >= 26:
+        return {"夏"}
+    if average >= 16:
+        return {"春", "秋"}
+    if average >= 6:
+        return {"秋", "冬"}
+    return {"冬"}
+
+
+def score_item(item: WardrobeItem, scene_keywords: List[str], seasons: Set[str], query_bigrams: Set[str]) -> float:
+    """
+    为单品打分，分数越高越相关
+
+    参数:
+        item: 单品
+        scene_keywords: 场景关键词
+        seasons: 当前季节
+        query_bigrams: 用户需求文本的二元字组
+    """
+    score = 0.0
+    if scene_keywords:
+        score += 3.0 * sum(1 for keyword in scene_keywords if keyword in item.scenes)
+
+    if seasons:
+        if item.season_set & seasons:
+            score += 2.0 if "四季" not in item.seasons else 1.0
+        else:
+            score -= 5.0
+
+    if query_bigrams:
+        score += min(4.0, 0.5 * len(query_bigrams & item.bigrams))
+    return score
+
+
+def _render(title: str, groups: Dict[str, List[WardrobeItem]], total: int) -> str:
+    kept = sum(len(items) for items in groups.values())
+    lines = [title, "", f"（已按场景、天气和需求从{total}件单品中筛选出最相关的{kept}件）", ""]
+    for category in CATEGORY_ORDER + [c for c in groups if c not in CATEGORY_ORDER]:
+        items = groups.get(category)
+        if not items:
+            continue
+        lines.append(f"## {category}")
+        lines.append("")
+        lines.append("| 二级分类 | 名称 | 主色调 | 适合季节 | 适合场景 | 特征描述 |")
+        lines.append("|----------|------|--------|---------|----------|----------|")
+        lines.extend(item.to_row() for item in items)
+        lines.append("")
+    return "\n".join(lines)
+
+
+def filter_wardrobe(wardrobe_data: str, scenario: str = "", weather_data: Optional[str] = None,
+                    query: str = "", top_n: int = 8, token_budget: int = 3000,
+                    seasons: Optional[Set[str]] = None) -> str:
+    """
+    生成只包含相关单品的精简衣橱文本
+
+    参数:
+        wardrobe_data: wardrobe.md的内容
+        scenario: 界面选择的场景（如"工作场合"）
+        weather_data: 天气数据，用于推断季节
+        query: 用户的具体需求
+        top_n: 每个类别最多保留的单品数
+        token_budget: 精简后衣橱文本的令牌预算，超出时逐步减少每类保留数
+        seasons: 已推断出的当前季节，为None时根据weather_data推断
+
+    返回:
+        精简后的衣橱Markdown文本；无法解析出单品时原样返回
+    """
+    wardrobe = get_wardrobe(wardrobe_data)
+    if not wardrobe.items:
+        return wardrobe_data
+
+    scene_keywords = list(SCENARIO_KEYWORDS.get(scenario, []))
+    if not scene_keywords:
+        # 没有选择已知场景时（如命令行），使用需求文本中出现的场景关键词
+        all_keywords = {keyword for keywords in SCENARIO_KEYWORDS.values() for keyword in keywords}
+        scene_keywords = sorted(keyword for keyword in all_keywords if keyword in query)
+    if seasons is None:
+        seasons = season_from_weather(weather_data)
+    query_bigrams = _bigrams(f"{scenario}{query}")
+
+    # 每个类别内按分数从高到低排序，同分时保持文件中的顺序；当季单品足够时经索引只为当季单品打分，
+    # 不足top_n件时整个类别参与排序，由过季单品补位
+    n = max(1, top_n)
+    ranked: Dict[str, list] = {}
+    for category in wardrobe.categories():
+        candidates = wardrobe.query(category=category, any_season=seasons) if seasons else []
+        if len(candidates) < n:
+            candidates = wardrobe.query(category=category)
+        entries = [(score_item(item, scene_keywords, seasons, query_bigrams), position, item)
+                   for position, item in enumerate(candidates)]
+        entries.sort(key=lambda entry: (-entry[0], entry[1]))
+        ranked[category] = entries
+
+    while True:
+        groups = {category: [entry[2] for entry in entries[:n]] for category, entries in ranked.items()}
+        text = _render(wardrobe.title, groups, len(wardrobe))
+        if n == 1 or estimate_tokens(text) <= token_budget:
+            return text
+        n -= 1
+
+
+def filter_settings():
+    """
+    从环境变量读取衣橱筛选配置
+
+    返回:
+        (是否启用 WARDROBE_FILTER_ENABLED, 每类保留数 WARDROBE_TOP_N, 令牌预算 WARDROBE_TOKEN_BUDGET)
+    """
+    enabled = os.environ.get("WARDROBE_FILTER_ENABLED", "true").lower() in ['true', '1', 'yes']
+    try:
+        top_n = int(os.environ.get("WARDROBE_TOP_N", 8))
+    except ValueError:
+        top_n = 8
+    try:
+        token_budget = int(os.environ.get("WARDROBE_TOKEN_BUDGET", 3000))
+    except ValueError:
+        token_budget = 3000
+    return enabled, top_n, token_budget
@@ -6,74 +6,103 @@ Stylist4deepseek - Web应用界面
 提供基于Web的穿搭顾问交互界面
 """
 
-from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 import os
 import sys
-import json
+import re
 import time
+import gzip
+import hashlib
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 # 加载环境变量
 load_dotenv()
 
 # 导入我们的穿搭推荐模块
-from stylist_app import load_file_content, create_prompt, generate_outfit_recommendation
+from stylist_app import (
+    load_file_content, load_user_specific_data, create_prompt_with_budget,
+)
+from response_cache import get_cached_client, get_response_cache, make_cache_key
+from single_flight import get_stream_coalescer
+from admission import get_admission_controller, AdmissionRejected
+from circuit_breaker import get_circuit_breaker, CircuitOpenError, STATE_OPEN
+from example_responses import get_outfit_example
+from file_cache import file_cache
+from user_store import get_user_store, page_settings
+from context_bundle import get_context_bundles, create_prompt_from_bundle
+from session_state import SELECTION_COOKIE, sign_selection, read_selection, selection_max_age
+from wardrobe import filter_wardrobe, filter_settings
+from stream_utils import coalesce_chunks, get_flush_settings, get_resume_grace, get_heartbeat_interval, split_text
+from stream_protocol import (
+    EVENT_STATUS, EVENT_DELTA, EVENT_USAGE, EVENT_ERROR, EVENT_DONE, EVENT_TIMING, STREAM_FORMATS, HEARTBEAT_FRAMES,
+    StreamRegistry, negotiate_format, parse_last_event_id, encode_events, resume_events,
+)
+from app_logging import get_logger, fields, sampled, elapsed_ms
+from tracing import RequestTrace, activate, span
+from metrics import (
+    REGISTRY, RECOMMENDATIONS, RECOMMENDATION_DURATION, RECOMMENDATION_FRAMES, RECOMMENDATIONS_CANCELLED,
+    HTTP_REQUESTS, HTTP_DURATION,
+)
 
 app = Flask(__name__)
+logger = get_logger("webapp")
+
+# 最近的流会话记录，用于断线重连
+stream_registry = StreamRegistry(resume_grace=get_resume_grace())
 
 # 确保templates目录存在
 if not os.path.exists('templates'):
     os.makedirs('templates')
 
-# 用户数据加载函数
-def load_users_data():
-    try:
-        with open('users.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"加载用户数据出错: {str(e)}")
-        return {"users": [], "selected_user": ""}
+# 用户列表的一页及其ETag（ASGI模式共用），offset和limit为查询参数的原始值
+# 列表与访问者无关（选定的用户保存在各自的Cookie中，由页面脚本应用），可以被浏览器和CDN缓存
+def users_page(offset=None, limit=None):
+    store = get_user_store()
+    offset, limit = page_settings(offset, limit)
+    revision = store.revision()
+    users, total = store.list_users(offset, limit)
+    end = offset + len(users)
+    page = {
+        "users": users,
+        "default_user": default_user_id(),
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "next_offset": end if end < total else None,
+    }
+    return page, f"users-{revision}-{offset}-{limit}"
 
-# 用户数据保存函数
-def save_users_data(data):
+# 用户列表的Cache-Control，USERS_CACHE_MAX_AGE秒内不必重新验证
+def users_cache_control():
     try:
-        with open('users.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        return True
-    except Exception as e:
-        print(f"保存用户数据出错: {str(e)}")
-        return False
-
-# 加载指定用户的数据
-def load_user_specific_data(user_id):
-    body_data = load_file_content(f'users/{user_id}/body_data.md')
-    weather_data = load_file_content(f'users/{user_id}/weather_forecast.md')
-    wardrobe_data = load_file_content(f'users/{user_id}/wardrobe.md')
-    
-    # 如果用户特定数据不存在，使用默认数据
-    if not body_data:
-        body_data = load_file_content('body_data.md')
-    if not weather_data:
-        weather_data = load_file_content('weather_forecast.md')
-    if not wardrobe_data:
-        wardrobe_data = load_file_content('wardrobe.md')
-    
-    return {
-        "body_data": body_data,
-        "weather_data": weather_data,
-        "wardrobe_data": wardrobe_data
-    }
+        max_age = int(os.environ.get("USERS_CACHE_MAX_AGE", 60))
+    except ValueError:
+        max_age = 60
+    return f"public, max-age={max_age}"
 
-# 创建简单的HTML模板
-@app.route('/create_template')
-def create_template():
-    print("\n==== 开始创建/更新HTML模板 ====")
-    
-    # 检查模板目录是否存在
-    if not os.path.exists('templates'):
-        print("创建templates目录")
-        os.makedirs('templates')
-    
+# 没有选择过用户的访问者默认使用的用户：存储中的selected_user（从users.json迁移），否则为第一个用户
+def default_user_id():
+    store = get_user_store()
+    user_id = store.get_setting("selected_user")
+    if user_id and store.get_user(user_id) is not None:
+        return user_id
+    users, _ = store.list_users(0, 1)
+    return users[0]["id"] if users else ""
+
+# 访问者当前选定的用户：Cookie签名有效且用户存在时使用Cookie中的用户，否则为默认用户
+def session_user(cookie):
+    user_id = read_selection(cookie)
+    if user_id and get_user_store().get_user(user_id) is not None:
+        return user_id
+    return default_user_id()
+
+# 检查用户是否存在（选择用户时只校验，不写入存储）
+def user_exists(user_id):
+    return bool(user_id) and get_user_store().get_user(user_id) is not None
+
+# 生成主页HTML内容
+def build_index_html():
     html_content = r"""
 <!DOCTYPE html>
 <!-- 此模板由create_template函数生成 - 生成时间: """ + time.strftime("%Y-%m-%d %H:%M:%S") + r""" -->
@@ -142,6 +171,12 @@ def create_template():
             font-family: 'PingFang SC', 'Microsoft YaHei', sans-serif;
             line-height: 1.6;
         }
+        .stream-status {
+            margin-top: 20px;
+            color: #666;
+            font-size: 14px;
+            text-align: center;
+        }
         .result mark.existing {
             background-color: #d1f0d1;
             border-radius: 4px;
@@ -313,6 +348,8 @@ def create_template():
             <p>正在为您生成穿搭方案...</p>
         </div>
         
+        <div class="stream-status" id="stream-status"></div>
+        
         <div class="result" id="result" style="display:none;">
             <span id="content"></span><span class="cursor" id="typing-cursor"></span>
         </div>
@@ -355,15 +392,34 @@ def create_template():
                 updateUserInfo();
                 // 加载用户特定数据
                 fetchUserData(selectedUserId);
+                // 记住选择（保存在本访问者的Cookie中）
+                fetch('/api/select-user', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({user_id: selectedUserId})
+                }).catch(error => console.error('保存用户选择失败:', error));
             });
         });
         
+        // 读取Cookie中上次选定的用户（值为"用户ID.签名"）
+        function savedUserId() {
+            const cookie = document.cookie.split('; ').find(item => item.startsWith('stylist_user='));
+            if (!cookie) return '';
+            const value = cookie.substring('stylist_user='.length);
+            const dot = value.lastIndexOf('.');
+            return dot > 0 ? decodeURIComponent(value.substring(0, dot)) : '';
+        }
+        
         // 获取所有用户数据
         function fetchUsers() {
             fetch('/api/users')
                 .then(response => response.json())
                 .then(data => {
                     usersData = data;
+                    // 用户列表对所有访问者相同，选中的用户取自本访问者的Cookie，没有时使用默认用户
+                    const saved = savedUserId();
+                    selectedUserId = data.users.some(user => user.id === saved) ? saved : data.default_user;
+                    
                     // 填充用户选择下拉框
                     const userSelect = document.getElementById('user');
                     userSelect.innerHTML = '';
@@ -372,13 +428,8 @@ def create_template():
                         const option = document.createElement('option');
                         option.value = user.id;
                         option.textContent = `${user.name} (${user.profession})`;
+                        option.selected = user.id === selectedUserId;
                         userSelect.appendChild(option);
-                        
-                        // 设置默认选中的用户
-                        if (user.id === data.selected_user) {
-                            option.selected = true;
-                            selectedUserId = user.id;
-                        }
                     });
                     
                     // 更新用户信息显示
@@ -425,6 +476,21 @@ def create_template():
                 });
         }
         
+        // 转义HTML特殊字符
+        function escapeHtml(text) {
+            return text
+                .replace(/&/g, '&amp;')
+                .replace(/</g, '&lt;')
+                .replace(/>/g, '&gt;');
+        }
+        
+        // 高亮[衣橱已有]和[建议购买]标签
+        function highlightTags(html) {
+            return html
+                .replace(/\[衣橱已有\]/g, '<mark class="existing">[衣橱已有]</mark>')
+                .replace(/\[建议购买\]/g, '<mark class="recommended">[建议购买]</mark>');
+        }
+        
         // 提交获取穿搭建议
         document.getElementById('submit').addEventListener('click', function() {
             const scenario = document.getElementById('scenario').value;
@@ -433,74 +499,145 @@ def create_template():
             const contentElement = document.getElementById('content');
             const cursorElement = document.getElementById('typing-cursor');
             const loadingElement = document.getElementById('loading');
+            const statusElement = document.getElementById('stream-status');
             
             // 显示加载动画
             loadingElement.style.display = 'block';
             resultElement.style.display = 'none';
             contentElement.textContent = '';
+            statusElement.textContent = '';
+            cursorElement.style.display = '';
             
-            // 使用fetch API的流式响应功能
-            fetch('/get_recommendation', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    user_id: selectedUserId,
-                    scenario: scenario,
-                    query: query
-                }),
-            })
-            .then(response => {
-                // 隐藏加载动画，显示结果区域
-                loadingElement.style.display = 'none';
-                resultElement.style.display = 'block';
-                
-                const reader = response.body.getReader();
-                const decoder = new TextDecoder();
-                
-                // 读取流式数据
-                function readStream() {
-                    return reader.read().then(({ value, done }) => {
-                        if (done) {
-                            // 流结束后的处理
-                            cursorElement.style.display = 'none';
-                            return;
-                        }
-                        
-                        // 解码接收到的数据
-                        const text = decoder.decode(value, { stream: true });
-                        
-                        try {
-                            // 尝试解析JSON并提取推荐文本
-                            const jsonData = JSON.parse(text);
-                            if (jsonData.chunk) {
-                                // 处理文本片段，添加到内容区
-                                let chunk = jsonData.chunk;
-                                
-                                // 高亮[衣橱已有]和[建议购买]标签
-                                chunk = chunk
-                                    .replace(/\[衣橱已有\]/g, '<mark class="existing">[衣橱已有]</mark>')
-                                    .replace(/\[建议购买\]/g, '<mark class="recommended">[建议购买]</mark>');
-                                
-                                contentElement.innerHTML += chunk;
-                            }
-                        } catch (e) {
-                            // 不是有效的JSON，直接显示文本
-                            contentElement.textContent += text;
-                        }
-                        
-                        // 继续读取下一块数据
-                        return readStream();
+            // 打字效果：收到的文本先放入缓冲区，再按动画帧逐步显示，积压越多显示越快
+            let receivedText = '';
+            let shownLength = 0;
+            let streamDone = false;
+            
+            function renderTyping() {
+                if (shownLength < receivedText.length) {
+                    const pending = receivedText.length - shownLength;
+                    shownLength += Math.max(2, Math.ceil(pending / 30));
+                    contentElement.innerHTML = highlightTags(escapeHtml(receivedText.slice(0, shownLength)));
+                }
+                if (streamDone && shownLength >= receivedText.length) {
+                    cursorElement.style.display = 'none';
+                    return;
+                }
+                requestAnimationFrame(renderTyping);
+            }
+            requestAnimationFrame(renderTyping);
+            
+            // 按SSE格式增量解析：数据块可能在任意位置被切分或合并，只处理完整的事件
+            let buffer = '';
+            let lastEventId = '';
+            let retries = 0;
+            
+            function parseEvents(text) {
+                buffer += text.replace(/\r\n?/g, '\n');
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const block = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    
+                    let eventType = 'message';
+                    const dataLines = [];
+                    block.split('\n').forEach(line => {
+                        if (!line || line.startsWith(':')) return;  // 空行或注释
+                        const colon = line.indexOf(':');
+                        const field = colon === -1 ? line : line.slice(0, colon);
+                        let value = colon === -1 ? '' : line.slice(colon + 1);
+                        if (value.startsWith(' ')) value = value.slice(1);
+                        if (field === 'event') eventType = value;
+                        else if (field === 'data') dataLines.push(value);
+                        else if (field === 'id') lastEventId = value;
                     });
+                    if (dataLines.length) {
+                        handleEvent(eventType, JSON.parse(dataLines.join('\n')));
+                    }
+                }
+            }
+            
+            function handleEvent(eventType, data) {
+                if (eventType === 'delta') {
+                    receivedText += data.text;
+                } else if (eventType === 'status') {
+                    statusElement.textContent = data.message;
+                } else if (eventType === 'error') {
+                    statusElement.textContent = data.message;
+                    if (data.resumable === false) streamDone = true;
+                } else if (eventType === 'done') {
+                    statusElement.textContent = data.message;
+                    streamDone = true;
                 }
+            }
+            
+            // 发起请求；断线后携带Last-Event-ID从断点继续
+            function startStream() {
+                const headers = {
+                    'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream',
+                };
+                if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+                buffer = '';
                 
-                return readStream();
-            })
+                return fetch('/get_recommendation', {
+                    method: 'POST',
+                    headers: headers,
+                    body: JSON.stringify({
+                        user_id: selectedUserId,
+                        scenario: scenario,
+                        query: query
+                    }),
+                })
+                .then(response => {
+                    // 服务繁忙（排队已满或等待超时）：按Retry-After提示用户稍后再试
+                    if (response.status === 429) {
+                        const busy = new Error(`当前请求较多，请${response.headers.get('Retry-After') || '稍'}秒后再试。`);
+                        busy.busy = true;
+                        throw busy;
+                    }
+                    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                    
+                    // 隐藏加载动画，显示结果区域
+                    loadingElement.style.display = 'none';
+                    resultElement.style.display = 'block';
+                    
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    
+                    // 读取流式数据
+                    function readStream() {
+                        return reader.read().then(({ value, done }) => {
+                            if (done) {
+                                parseEvents(decoder.decode());
+                                if (!streamDone) throw new Error('连接提前结束');
+                                return;
+                            }
+                            parseEvents(decoder.decode(value, { stream: true }));
+                            return readStream();
+                        });
+                    }
+                    
+                    return readStream();
+                })
+                .catch(error => {
+                    // 已收到部分事件时尝试断点续传
+                    if (!error.busy && !streamDone && lastEventId && retries < 3) {
+                        retries += 1;
+                        statusElement.textContent = `连接中断，正在重连（${retries}/3）...`;
+                        return new Promise(resolve => setTimeout(resolve, 500 * retries)).then(startStream);
+                    }
+                    throw error;
+                });
+            }
+            
+            startStream()
             .catch((error) => {
+                streamDone = true;
+                receivedText = '';
                 loadingElement.style.display = 'none';
                 resultElement.style.display = 'block';
-                contentElement.textContent = '获取穿搭建议时出错，请稍后再试。';
+                contentElement.textContent = error.busy ? error.message : '获取穿搭建议时出错，请稍后再试。';
                 cursorElement.style.display = 'none';
                 console.error('Error:', error);
             });
@@ -509,58 +646,114 @@ def create_template():
 </body>
 </html>
     """
+    return html_content
+
+# 把主页HTML写入templates/index.html
+def write_index_template(html_content):
+    # 检查模板目录是否存在
+    if not os.path.exists('templates'):
+        logger.info("创建templates目录")
+        os.makedirs('templates')
     
-    # 写入HTML模板到静态文件
+    # 先写临时文件再原子替换，避免并发读取到不完整的模板
     try:
-        with open('templates/index.html', 'w', encoding='utf-8') as f:
+        tmp_path = 'templates/index.html.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             f.write(html_content)
-        print(f"模板文件创建成功！长度: {len(html_content)} 字节")
-        print("==== 创建/更新HTML模板完成 ====\n")
-        return "模板创建成功！"
+        os.replace(tmp_path, 'templates/index.html')
+        logger.info("模板文件创建成功，长度 %d 字节", len(html_content))
+        return True, "模板创建成功！"
     except Exception as e:
-        print(f"创建模板文件时出错: {str(e)}")
-        print("==== 创建/更新HTML模板失败 ====\n")
-        return f"创建模板文件时出错: {str(e)}"
+        logger.error("创建模板文件时出错: %s", e)
+        return False, f"创建模板文件时出错: {str(e)}"
+
+# 内存中的页面：预先渲染好的正文、gzip压缩版本和缓存校验信息
+# ETag不包含模板中的生成时间注释，相同内容在重启后和各个工作进程中得到相同的ETag
+GENERATED_AT_PATTERN = re.compile(r"<!-- 此模板由create_template函数生成 - 生成时间: [^>]*-->")
+
+class CachedPage:
+    def __init__(self, html, source_path):
+        self.body = html.encode('utf-8')
+        self.gzip_body = gzip.compress(self.body, compresslevel=6)
+        self.etag = hashlib.sha1(GENERATED_AT_PATTERN.sub("", html).encode('utf-8')).hexdigest()
+        # Last-Modified取页面来源文件的修改时间，而不是进程启动时间
+        try:
+            modified = os.path.getmtime(source_path)
+        except OSError:
+            modified = time.time()
+        self.last_modified = datetime.fromtimestamp(int(modified), timezone.utc)
+
+_pages = {}
+
+# 渲染页面并保存到内存，source_path为页面来源（模板文件，或生成主页的本文件）
+def cache_page(name, html, source_path=__file__):
+    _pages[name] = CachedPage(app.jinja_env.from_string(html).render(), source_path)
+
+# 启动时准备主页和调试页面
+def prepare_pages():
+    # INDEX_TEMPLATE_SOURCE=file 时使用构建阶段生成的templates/index.html，否则在内存中生成
+    if os.environ.get("INDEX_TEMPLATE_SOURCE", "memory").lower() == "file" and os.path.exists('templates/index.html'):
+        cache_page('index', load_file_content('templates/index.html'), 'templates/index.html')
+    else:
+        cache_page('index', build_index_html())
+    cache_page('debug', load_file_content('templates/debug.html') or '', 'templates/debug.html')
+
+# 内存中的页面（ASGI模式共用）
+def get_cached_page(name):
+    return _pages[name]
+
+# 返回内存中的页面，支持ETag/Last-Modified条件请求和gzip压缩
+def serve_page(name):
+    page = _pages[name]
+    use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    
+    response = Response(page.gzip_body if use_gzip else page.body, content_type='text/html; charset=utf-8')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(page.etag + ('-gz' if use_gzip else ''))
+    response.last_modified = page.last_modified
+    return response.make_conditional(request)
+
+# 管理操作 - 重新生成HTML模板文件并刷新内存中的主页
+@app.route('/create_template', methods=['POST'])
+def create_template():
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if admin_token and request.headers.get('X-Admin-Token') != admin_token:
+        return jsonify({"success": False, "error": "无权执行此操作"}), 403
+    
+    html_content = build_index_html()
+    success, message = write_index_template(html_content)
+    if success:
+        cache_page('index', html_content, 'templates/index.html')
+    return jsonify({"success": success, "message": message}), (200 if success else 500)
 
 # 主页路由
 @app.route('/')
 def index():
-    # 强制每次都重新创建模板，确保使用最新版本
-    print("\n==== 访问主页，准备渲染模板 ====")
-    
-    try:
-        # 检查模板是否存在
-        template_exists = os.path.exists('templates/index.html')
-        print(f"模板文件存在: {template_exists}")
-        
-        # 删除旧模板并创建新的
-        if template_exists:
-            os.remove('templates/index.html')
-            print("已删除旧模板文件")
-        
-        # 创建新模板
-        create_template()
-        
-        # 确认模板已创建
-        template_exists = os.path.exists('templates/index.html')
-        print(f"新模板文件创建状态: {template_exists}")
-        
-        # 渲染模板
-        return render_template('index.html')
-    except Exception as e:
-        print(f"主页路由出错: {str(e)}")
-        return f"渲染主页时出错: {str(e)}"
+    return serve_page('index')
 
 # 调试页面路由
 @app.route('/debug')
 def debug():
-    return render_template('debug.html')
+    return serve_page('debug')
 
-# API端点 - 获取所有用户列表
+# API端点 - 分页获取用户列表（查询参数offset、limit），支持ETag条件请求
 @app.route('/api/users')
 def get_users():
-    users_data = load_users_data()
-    return jsonify(users_data)
+    page, etag = users_page(request.args.get('offset'), request.args.get('limit'))
+    response = jsonify(page)
+    response.headers['Cache-Control'] = users_cache_control()
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+# API端点 - 当前访问者选定的用户
+@app.route('/api/session')
+def get_session():
+    response = jsonify({"selected_user": session_user(request.cookies.get(SELECTION_COOKIE))})
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
 
 # API端点 - 获取用户特定数据（身体特征和天气）
 @app.route('/api/user-data/<user_id>')
@@ -575,177 +768,497 @@ def select_user():
         data = request.get_json()
         user_id = data.get('user_id')
         
-        users_data = load_users_data()
-        users_data['selected_user'] = user_id
-        save_users_data(users_data)
+        if not user_exists(user_id):
+            return jsonify({"success": False, "error": "用户不存在"}), 404
         
-        return jsonify({"success": True})
+        # 选择只保存在访问者自己的签名Cookie中
+        response = jsonify({"success": True, "selected_user": user_id})
+        response.set_cookie(SELECTION_COOKIE, sign_selection(user_id), max_age=selection_max_age(),
+                            samesite='Lax', secure=request.is_secure)
+        response.headers['Cache-Control'] = 'private, no-store'
+        return response
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
-# 流式输出生成器函数
-def generate_streaming_response(prompt, use_api):
+# API端点 - 查看缓存统计信息
+@app.route('/api/cache-stats')
+def cache_stats():
+    return jsonify(component_stats())
+
+# 缓存、合并、并发和熔断统计（ASGI模式共用）
+def component_stats():
+    cache = get_response_cache()
+    bundles = get_context_bundles()
+    coalescer = get_stream_coalescer()
+    controller = get_admission_controller()
+    breaker = get_circuit_breaker()
+    return {
+        "response_cache": cache.stats() if cache else None,
+        "file_cache": file_cache.stats(),
+        "context_bundles": bundles.stats() if bundles else None,
+        "user_store": get_user_store().stats(),
+        "coalescing": coalescer.stats() if coalescer else None,
+        "admission": controller.stats() if controller else None,
+        "circuit_breaker": breaker.stats() if breaker else None
+    }
+
+# 导出时读取已有的缓存、合并、并发和熔断统计
+def collect_component_stats():
+    cache = get_response_cache()
+    coalescer = get_stream_coalescer()
+    controller = get_admission_controller()
+    breaker = get_circuit_breaker()
+    if cache:
+        stats = cache.stats()
+        for tier in ("memory", "disk"):
+            yield "stylist_response_cache_hits_total", "counter", "响应缓存命中次数", {"tier": tier}, \
+                stats[f"{tier}_hits"]
+        yield "stylist_response_cache_misses_total", "counter", "响应缓存未命中次数", {}, stats["misses"]
+        yield "stylist_response_cache_entries", "gauge", "响应缓存内存条目数", {}, stats["memory_entries"]
+    stats = file_cache.stats()
+    yield "stylist_file_cache_hits_total", "counter", "文件缓存命中次数", {}, stats["hits"]
+    yield "stylist_file_cache_misses_total", "counter", "文件缓存未命中次数", {}, stats["misses"]
+    if coalescer:
+        stats = coalescer.stats()
+        yield "stylist_coalesced_subscribers_total", "counter", "合并到进行中请求的订阅者数", {}, \
+            stats["coalesced_subscribers"]
+        yield "stylist_coalesced_in_flight", "gauge", "进行中的合并流数", {}, stats["in_flight"]
+        yield "stylist_coalesced_lagging_subscribers_total", "counter", "因读取过慢被移出合并流的订阅者数", {}, \
+            stats["lagging_subscribers"]
+    if controller:
+        stats = controller.stats()
+        yield "stylist_admission_active", "gauge", "进行中的上游调用数", {}, stats["active"]
+        yield "stylist_admission_queue_depth", "gauge", "排队等待的请求数", {}, stats["queue_depth"]
+        for reason in ("full", "timeout"):
+            yield "stylist_admission_rejected_total", "counter", "被拒绝的请求数", {"reason": reason}, \
+                stats[f"rejected_{reason}"]
+    if breaker:
+        stats = breaker.stats()
+        for state in ("closed", "open", "half_open"):
+            yield "stylist_circuit_breaker_state", "gauge", "熔断器当前状态", {"state": state}, \
+                1 if stats["state"] == state else 0
+        yield "stylist_circuit_breaker_opened_total", "counter", "熔断器打开次数", {}, stats["opened"]
+
+REGISTRY.register_collector(collect_component_stats)
+
+# API端点 - Prometheus格式的运行指标
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# 记录每个请求的处理时间和状态码
+@app.before_request
+def start_request_timer():
+    g.request_start = time.monotonic()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        HTTP_DURATION.observe(time.monotonic() - start, endpoint=endpoint)
+        if response.status_code >= 500:
+            logger.warning("请求失败", extra=fields(endpoint=endpoint, status=response.status_code,
+                                                  duration_ms=elapsed_ms(start)))
+    return response
+
+# 示例回答按帧输出（不再人为延迟，打字效果由前端实现）
+def stream_example_events(prompt):
+    """逐帧产出示例回答，结束时返回(帧数, 字符数)供用量统计使用"""
+    example = get_outfit_example(prompt)
+    
+    frame_count = 0
+    full_length = 0
+    for chunk in split_text(example):
+        frame_count += 1
+        full_length += len(chunk)
+        yield EVENT_DELTA, {"text": chunk}
+    return frame_count, full_length
+
+# 上游请求的标识：相同的键表示完全相同的API请求（用于合并请求）
+def recommendation_key(prompt, system_prompt, max_tokens):
+    return make_cache_key("deepseek-chat", prompt, 0.7, max_tokens, 0.9, system_prompt)
+
+# 为键为key的API调用申请名额；未启用并发控制、命中响应缓存或熔断器打开（不会调用API）时返回None
+def admit_upstream(key):
+    controller = get_admission_controller()
+    if controller is None:
+        return None
+    cache = get_response_cache()
+    if cache is not None and cache.contains(key):
+        return None
+    breaker = get_circuit_breaker()
+    if breaker is not None and breaker.state == STATE_OPEN:
+        return None
+    ticket = controller.acquire()
+    if ticket.wait_time > 0:
+        logger.info("排队等待后获得API调用名额", extra=fields(wait_ms=round(ticket.wait_time * 1000)))
+    return ticket
+
+# 为即将发起的API调用申请并发名额；命中响应缓存或可以合并到进行中的相同请求时不占用名额
+# （合并时机不巧而需要发起新的上游请求时，由合并器的后台线程再申请名额）
+def acquire_upstream_slot(prompt, system_prompt, prompt_report):
+    key = recommendation_key(prompt, system_prompt, prompt_report["max_tokens"])
+    coalescer = get_stream_coalescer()
+    if coalescer is not None and coalescer.is_joinable(key):
+        return None
+    return admit_upstream(key)
+
+# 记录链路中的推送阶段（response.stream和response.first_frame），同步和ASGI两种模式共用
+class ResponseStage:
+    def __init__(self, trace):
+        self.trace = trace
+        self.span = trace.start_span("response.stream")
+        self.frames = 0
+        self.bytes = 0
+    
+    # 发送每个事件之前调用；返回需要先发送的(事件类型, 数据)，即done之前的timing事件
+    def before(self, event, data):
+        if event == EVENT_DELTA:
+            if self.frames == 0:
+                now = time.monotonic()
+                self.trace.record("response.first_frame", self.span.start, now, parent=self.span)
+                self.trace.root.set(ttft_ms=round((now - self.trace.root.start) * 1000, 1))
+            self.frames += 1
+            self.bytes += len(data["text"].encode('utf-8'))
+        elif event == EVENT_DONE:
+            self.span.set(frames=self.frames, bytes=self.bytes)
+            self.span.finish()
+            return EVENT_TIMING, self.trace.summary()
+        return None
+    
+    def finish(self, outcome):
+        self.span.set(frames=self.frames, bytes=self.bytes)
+        self.span.finish()
+        self.trace.finish(outcome=outcome)
+        if outcome == "cancelled":
+            # 客户端在建议生成完之前断开（上游流此时已被关闭）
+            phase = "streaming" if self.frames else "before_first_frame"
+            RECOMMENDATIONS_CANCELLED.inc(phase=phase)
+            logger.info("客户端已断开，停止生成穿搭建议", extra=fields(
+                phase=phase, frames=self.frames,
+                duration_ms=round((time.monotonic() - self.trace.root.start) * 1000, 1)))
+
+# 流式输出生成器函数，产生(事件类型, 数据)；传入trace时记录推送阶段并在结束前发送timing事件
+def generate_recommendation_events(prompt, use_api, prompt_report=None, system_prompt=None, trace=None,
+                                   ticket=None):
+    # 事件由后台生产方读取，客户端断开后仍可能继续生成，并发名额改由事件序列持有到结束
+    owned = ticket.transfer() if ticket is not None else None
+    events = recommendation_events(prompt, use_api, prompt_report, system_prompt, owned)
+    if trace is None:
+        try:
+            yield from events
+        finally:
+            if owned is not None:
+                owned.release()
+        return
+    
+    # 只在取下一个事件时激活链路，上下文不会跨越yield
+    stage = ResponseStage(trace)
+    outcome = "cancelled"
+    try:
+        while True:
+            with activate(trace):
+                try:
+                    event, data = next(events)
+                except StopIteration:
+                    break
+            extra = stage.before(event, data)
+            if extra is not None:
+                yield extra
+            yield event, data
+        outcome = "success"
+    finally:
+        with activate(trace):
+            events.close()  # 不再等待重连时关闭上游流，并在链路中记录取消
+        stage.finish(outcome)
+        if owned is not None:
+            owned.release()
+
+# 穿搭建议的事件序列：调用API（或使用示例回答）并产生(事件类型, 数据)；ticket为已获得的上游并发名额
+def recommendation_events(prompt, use_api, prompt_report=None, system_prompt=None, ticket=None):
     api_key = os.environ.get("DEEPSEEK_API_KEY", "").strip()
     
     # 这里不再考虑传入的use_api参数，完全依赖环境变量
     env_use_api = os.environ.get("USE_DEEPSEEK_API", "").lower() in ['true', '1', 'yes']
     use_api = env_use_api  # 强制使用环境变量设置
     
-    print(f"[DEBUG] 流式响应开始 - 使用API: {use_api}")
+    logger.debug("流式响应开始", extra=sampled(use_api=use_api))
+    start = time.monotonic()
     
     # 立即发送一个初始化消息
-    yield json.dumps({"chunk": "正在准备您的穿搭建议...\n\n"})
-    time.sleep(0.5)  # 短暂延迟
+    yield EVENT_STATUS, {"message": "正在准备您的穿搭建议..."}
+    
+    full_length = 0
+    frame_count = 0
+    source = "example"
+    api_usage = {}  # API返回的令牌用量（含上下文缓存命中数）
     
     if use_api and api_key:
-        print(f"- 使用API: {use_api} (环境变量设置)")
-        if api_key:
-            masked_key = api_key[:4] + "*" * (len(api_key) - 8) + api_key[-4:] if len(api_key) > 8 else "***"
-            print(f"- API密钥: {masked_key} (长度: {len(api_key)})")
-        
         try:
-            # 导入API客户端
-            from deepseek_client import DeepseekClient
-            client = DeepseekClient(api_key=api_key)
+            # 复用进程内长期存在的客户端（共享连接池，带响应缓存）
+            client = get_cached_client(api_key=api_key)
             
-            print("正在调用Deepseek API...")
             # 调用API获取流式响应
-            response_generator = client.chat_stream(
-                prompt=prompt,
-                temperature=0.7,
-                top_p=0.9,
-                max_tokens=1500
-            )
+            max_tokens = prompt_report["max_tokens"] if prompt_report else 1500
             
-            # 明确的生成开始标记
-            yield json.dumps({"chunk": "【Deepseek AI 正在生成穿搭建议...】\n\n"})
+            def open_stream(on_usage):
+                return client.chat_stream(
+                    prompt=prompt,
+                    temperature=0.7,
+                    top_p=0.9,
+                    max_tokens=max_tokens,
+                    system_prompt=system_prompt,
+                    on_usage=on_usage
+                )
             
-            full_content = ""
-            chunk_count = 0
+            # 相同的进行中请求共享一个上游流，并发名额由读取上游的后台线程持有到上游结束
+            coalescer = get_stream_coalescer()
+            if coalescer is not None:
+                key = recommendation_key(prompt, system_prompt, max_tokens)
+                response_generator = coalescer.stream(key, open_stream, on_usage=api_usage.update,
+                                                      ticket=ticket, admit=lambda: admit_upstream(key))
+            else:
+                response_generator = open_stream(api_usage.update)
+            
+            # 明确的生成开始标记
+            yield EVENT_STATUS, {"message": "Deepseek AI 正在生成穿搭建议..."}
             
-            for chunk in response_generator:
-                chunk_count += 1
-                full_content += chunk
-                print(f"[DEBUG] 接收到内容片段 #{chunk_count}: 长度={len(chunk)}")
-                yield json.dumps({"chunk": chunk})
-                # 小延迟使输出更自然
-                time.sleep(0.05)
+            has_content = False
+            source = "api"
             
-            print(f"[DEBUG] API响应生成完成，总共片段数: {chunk_count}, 总长度: {len(full_content)}")
+            # 上游片段到达后立即转发，只按大小/时间窗口合并过小的片段
+            max_bytes, max_delay = get_flush_settings()
+            for frame in coalesce_chunks(response_generator, max_bytes=max_bytes, max_delay=max_delay):
+                # 尚未输出内容时API就已出错（重试后仍失败），改用示例回答
+                if not has_content and frame.startswith("\n[API错误:"):
+                    raise RuntimeError(frame.strip()[1:-1])
+                frame_count += 1
+                full_length += len(frame)
+                has_content = has_content or bool(frame.strip())
+                yield EVENT_DELTA, {"text": frame}
             
             # 如果没有内容，返回提示
-            if not full_content.strip():
-                print("[WARNING] API返回了空内容")
-                yield json.dumps({"chunk": "\n\n【API返回了空内容，正在切换到默认示例...】\n\n"})
-                time.sleep(1)
-                
-                # 加载示例回答
-                from example_responses import get_outfit_example
-                example = get_outfit_example(prompt)
-                
-                # 分割示例回答，逐段输出
-                chunks = [example[i:i+20] for i in range(0, len(example), 20)]
-                for chunk in chunks:
-                    yield json.dumps({"chunk": chunk})
-                    time.sleep(0.02)  # 快速输出示例回答
+            if not has_content:
+                logger.warning("API返回了空内容")
+                source = "example"
+                yield EVENT_STATUS, {"message": "API返回了空内容，正在切换到默认示例..."}
+                frame_count, full_length = yield from stream_example_events(prompt)
             
+        except CircuitOpenError as e:
+            # 熔断器打开：不等待连接超时，立即改用示例回答
+            logger.warning(str(e))
+            source = "example"
+            yield EVENT_ERROR, {"message": "AI服务暂时不可用", "recoverable": True, "retry_after": round(e.retry_after)}
+            yield EVENT_STATUS, {"message": "正在切换到默认示例..."}
+            frame_count, full_length = yield from stream_example_events(prompt)
         except Exception as e:
-            import traceback
-            print(f"[ERROR] 调用API时出错: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception("调用API时出错: %s", e)
             # 如果API调用失败，返回错误信息
-            yield json.dumps({"chunk": f"\n\n【API调用出错】: {str(e)}\n\n正在切换到默认示例..."})
-            time.sleep(1)
-            
-            # 加载示例回答
-            from example_responses import get_outfit_example
-            example = get_outfit_example(prompt)
-            
-            # 分割示例回答，逐段输出
-            chunks = [example[i:i+20] for i in range(0, len(example), 20)]
-            for chunk in chunks:
-                yield json.dumps({"chunk": chunk})
-                time.sleep(0.02)  # 快速输出示例回答
+            source = "example"
+            yield EVENT_ERROR, {"message": f"API调用出错: {str(e)}", "recoverable": True}
+            yield EVENT_STATUS, {"message": "正在切换到默认示例..."}
+            frame_count, full_length = yield from stream_example_events(prompt)
     else:
         if not use_api:
-            print("[INFO] 未启用API，使用示例回答")
-            yield json.dumps({"chunk": "【使用默认示例穿搭建议】\n\n"})
+            logger.debug("未启用API，使用示例回答")
+            yield EVENT_STATUS, {"message": "使用默认示例穿搭建议"}
         else:
-            print("[WARNING] 未提供API密钥，使用示例回答")
-            yield json.dumps({"chunk": "【未设置API密钥，使用默认示例】\n\n"})
+            logger.warning("未提供API密钥，使用示例回答")
+            yield EVENT_STATUS, {"message": "未设置API密钥，使用默认示例"}
         
-        time.sleep(0.5)
-        
-        # 加载示例回答
-        from example_responses import get_outfit_example
-        example = get_outfit_example(prompt)
-        
-        # 分割示例回答，逐段输出
-        chunks = [example[i:i+20] for i in range(0, len(example), 20)]
-        print(f"[DEBUG] 示例回答分割为 {len(chunks)} 个部分")
-        
-        for i, chunk in enumerate(chunks):
-            if i % 10 == 0:  # 每10个片段打印一次日志
-                print(f"[DEBUG] 发送示例片段 #{i+1}/{len(chunks)}")
-            yield json.dumps({"chunk": chunk})
-            time.sleep(0.01)  # 快速输出示例回答
+        frame_count, full_length = yield from stream_example_events(prompt)
+    
+    # 传输完成标记（客户端中途断开时不会执行到这里，也不计入指标）
+    yield EVENT_USAGE, finish_recommendation(start, source, frame_count, full_length, prompt_report, api_usage)
+    yield EVENT_DONE, {"message": "穿搭建议生成完毕"}
+
+# 一次穿搭建议完整发送后记录指标和日志，返回usage事件的数据（同步和ASGI两种模式共用）
+def finish_recommendation(start, source, frame_count, full_length, prompt_report, api_usage):
+    duration = time.monotonic() - start
+    RECOMMENDATIONS.inc(source=source)
+    RECOMMENDATION_DURATION.observe(duration, source=source)
+    RECOMMENDATION_FRAMES.inc(frame_count)
+    logger.info("穿搭建议生成完毕", extra=fields(source=source, frames=frame_count, chars=full_length,
+                                                   duration_ms=round(duration * 1000, 1)))
+    usage = {"source": source, "frames": frame_count, "chars": full_length}
+    if prompt_report:
+        usage["prompt_tokens_estimate"] = prompt_report["total_tokens"]
+        usage["max_tokens"] = prompt_report["max_tokens"]
+        usage["prompt_layout"] = prompt_report.get("layout")
+        if prompt_report.get("context_hash"):
+            usage["context_hash"] = prompt_report["context_hash"]
+    usage.update(api_usage)
+    return usage
+
+# 加载用户数据、筛选衣橱并创建提示词，各阶段记入请求链路；所需数据文件缺失时返回None
+def prepare_recommendation(user_id, scenario, query, trace):
+    # 组合用户查询
+    full_query = f"场景：{scenario}\n具体需求：{query}"
+    
+    bundles = get_context_bundles()
+    if bundles is not None:
+        return prepare_from_bundle(bundles, user_id, scenario, query, full_query, trace)
+    
+    # 加载用户特定数据和通用数据
+    with activate(trace), span("load_user_data") as stage:
+        user_data = load_user_specific_data(user_id)
+        body_data = user_data['body_data']
+        weather_data = user_data['weather_data']
+        wardrobe_data = user_data['wardrobe_data']
+        stylist_template = load_file_content('fashion_stylist_agent.md')
+        stage.set(bytes=sum(len(text.encode('utf-8')) for text in
+                            (body_data, weather_data, wardrobe_data, stylist_template) if text))
+    
+    if not all([body_data, wardrobe_data, weather_data, stylist_template]):
+        return None
+    
+    # 只保留与场景、天气和需求相关的衣橱单品，缩短提示词
+    filter_enabled, top_n, token_budget = filter_settings()
+    if filter_enabled:
+        with activate(trace), span("filter_wardrobe", input_chars=len(wardrobe_data)) as stage:
+            wardrobe_data = filter_wardrobe(wardrobe_data, scenario=scenario, weather_data=weather_data,
+                                            query=query, top_n=top_n, token_budget=token_budget)
+            stage.set(output_chars=len(wardrobe_data))
+    
+    # 创建提示词（按令牌预算压缩，并得到自适应的max_tokens）
+    with activate(trace), span("build_prompt") as stage:
+        system_prompt, prompt, prompt_report = create_prompt_with_budget(full_query, body_data, wardrobe_data,
+                                                                         weather_data, stylist_template)
+        stage.set(tokens=prompt_report["total_tokens"], max_tokens=prompt_report["max_tokens"],
+                  bytes=len(prompt.encode('utf-8')) + len((system_prompt or "").encode('utf-8')))
+    return system_prompt, prompt, prompt_report
+
+# 使用预先生成的上下文包：请求时只筛选衣橱（结果按场景和需求缓存）并追加用户需求
+def prepare_from_bundle(bundles, user_id, scenario, query, full_query, trace):
+    with activate(trace), span("load_user_data") as stage:
+        bundle, origin = bundles.get(user_id)
+        stage.set(bundle=origin)
+    if bundle is None:
+        return None
+    
+    wardrobe = None
+    filter_enabled, top_n, token_budget = filter_settings()
+    if filter_enabled:
+        with activate(trace), span("filter_wardrobe", input_chars=len(bundle.wardrobe_data)) as stage:
+            wardrobe = bundle.filtered_wardrobe(scenario, query, top_n, token_budget)
+            stage.set(output_chars=len(wardrobe[0]))
     
-    # 传输完成标记
-    print("[DEBUG] 流式传输完成")
-    yield json.dumps({"chunk": "\n\n【穿搭建议生成完毕】"})
+    with activate(trace), span("build_prompt") as stage:
+        system_prompt, prompt, prompt_report = create_prompt_from_bundle(bundle, full_query, wardrobe)
+        stage.set(tokens=prompt_report["total_tokens"], max_tokens=prompt_report["max_tokens"],
+                  context_hash=bundle.content_hash[:12])
+    return system_prompt, prompt, prompt_report
+
+# 流式响应的公共响应头：禁止缓存，并提示反向代理（如nginx）不要缓冲
+def streaming_headers(stream_id):
+    return {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "X-Stream-ID": stream_id,
+    }
+
+# 断线重连：按Last-Event-ID回放尚未送达的事件
+def resume_recommendation(last_event_id, stream_format):
+    content_type, formatter = STREAM_FORMATS[stream_format]
+    parsed = parse_last_event_id(last_event_id)
+    session = stream_registry.get(parsed[0]) if parsed else None
+    if session is None:
+        return jsonify({"error": "流已过期或不存在，请重新获取穿搭建议"}), 410
+    
+    return Response(
+        stream_with_context(resume_events(session, parsed[1], formatter, HEARTBEAT_FRAMES[stream_format],
+                                          get_heartbeat_interval())),
+        content_type=content_type,
+        headers=streaming_headers(session.stream_id)
+    )
 
 # API端点，处理穿搭建议请求
 @app.route('/get_recommendation', methods=['POST'])
 def get_recommendation():
     try:
         data = request.get_json()
-        user_id = data.get('user_id', '')
+        
+        # 输出格式：text/event-stream（默认）或换行分隔的JSON
+        stream_format = negotiate_format(request.headers.get('Accept'), request.args.get('format'))
+        
+        # 携带Last-Event-ID时从断点继续，不重新生成
+        last_event_id = request.headers.get('Last-Event-ID') or data.get('last_event_id')
+        if last_event_id:
+            return resume_recommendation(last_event_id, stream_format)
+        
+        # 未指定用户时使用访问者选定的用户；指定的用户必须存在
+        user_id = data.get('user_id') or session_user(request.cookies.get(SELECTION_COOKIE))
+        if data.get('user_id') and not user_exists(user_id):
+            return jsonify({"error": "用户不存在"}), 404
         scenario = data.get('scenario', '')
         query = data.get('query', '')
         
         # 仅从环境变量获取API设置
         env_use_api = os.environ.get("USE_DEEPSEEK_API", "").lower() in ['true', '1', 'yes']
         
-        print(f"\nWeb API请求:")
-        print(f"- 用户ID: {user_id}")
-        print(f"- 场景: {scenario}")
-        print(f"- 查询: {query}")
-        print(f"- 使用API: {env_use_api} (环境变量设置)")
-        
-        # 组合用户查询
-        full_query = f"场景：{scenario}\n具体需求：{query}"
+        logger.info("穿搭建议请求", extra=fields(user_id=user_id, scenario=scenario,
+                                                   query_chars=len(query), use_api=env_use_api))
         
-        # 加载用户特定数据
-        user_data = load_user_specific_data(user_id)
-        body_data = user_data['body_data']
-        weather_data = user_data['weather_data']
-        wardrobe_data = user_data['wardrobe_data']
+        # 每个阶段的耗时记入请求链路，请求ID沿用客户端传入的X-Request-ID
+        trace = RequestTrace(request.headers.get('X-Request-ID'), name="get_recommendation")
+        trace.root.set(user_id=user_id, use_api=env_use_api)
         
-        # 加载通用数据
-        stylist_template = load_file_content('fashion_stylist_agent.md')
-        
-        if not all([body_data, wardrobe_data, weather_data, stylist_template]):
+        prepared = prepare_recommendation(user_id, scenario, query, trace)
+        if prepared is None:
+            trace.finish(outcome="error")
             return jsonify({"error": "无法加载所需数据文件。"}), 500
+        system_prompt, prompt, prompt_report = prepared
         
-        # 创建提示词
-        prompt = create_prompt(full_query, body_data, wardrobe_data, weather_data, stylist_template)
+        # 需要调用API时先获取并发名额，排队已满或等待超时则返回429
+        ticket = None
+        if env_use_api and os.environ.get("DEEPSEEK_API_KEY", "").strip():
+            try:
+                with activate(trace), span("admission_wait"):
+                    ticket = acquire_upstream_slot(prompt, system_prompt, prompt_report)
+            except AdmissionRejected as e:
+                trace.finish(outcome="rejected")
+                logger.warning("拒绝请求: %s", e, extra=fields(retry_after=e.retry_after))
+                return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, \
+                    {"Retry-After": str(e.retry_after)}
         
         # 返回流式响应 - 传递环境变量中的API设置，不使用前端传入的参数
-        return Response(
-            stream_with_context(generate_streaming_response(prompt, env_use_api)),
-            content_type='application/json'
-        )
+        try:
+            content_type, formatter = STREAM_FORMATS[stream_format]
+            session = stream_registry.create()
+            events = generate_recommendation_events(prompt, env_use_api, prompt_report, system_prompt, trace,
+                                                    ticket)
+            headers = streaming_headers(session.stream_id)
+            headers["X-Request-ID"] = trace.request_id
+            headers["Server-Timing"] = trace.server_timing()
+            response = Response(
+                stream_with_context(encode_events(session, events, formatter, HEARTBEAT_FRAMES[stream_format],
+                                                  get_heartbeat_interval())),
+                content_type=content_type,
+                headers=headers
+            )
+        except Exception:
+            if ticket is not None:
+                ticket.release()
+            raise
+        # 事件序列未能启动时在响应结束后归还名额（已转交给生产方时不重复归还）
+        if ticket is not None:
+            response.call_on_close(ticket.release)
+        return response
         
     except Exception as e:
-        import traceback
-        print(f"生成穿搭建议时出错: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("生成穿搭建议时出错: %s", e)
         return jsonify({"error": str(e)}), 500
 
+# 启动时生成页面，请求路径上不再读写模板文件
+prepare_pages()
+
 if __name__ == '__main__':
-    # 确保先创建模板
-    if not os.path.exists('templates/index.html'):
-        create_template()
+    # 构建模式：只生成templates/index.html然后退出（配合INDEX_TEMPLATE_SOURCE=file使用）
+    if '--build-templates' in sys.argv:
+        success, _ = write_index_template(build_index_html())
+        sys.exit(0 if success else 1)
     
     # 启动Web应用
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file